@@ -24,9 +24,8 @@ import yaml
 from queue import Queue
 import shutil
 import subprocess
-import requests
 
-from macumba import MacumbaError, ServerError
+from macumba import CharmStore, MacumbaError
 from cloudinstall import async
 from cloudinstall import utils
 from cloudinstall.placement.controller import AssignmentType
@@ -34,6 +33,11 @@ from cloudinstall.placement.controller import AssignmentType
 log = logging.getLogger('cloudinstall.charms')
 
 CHARM_CONFIG_FILENAME = path.expanduser("~/.cloud-install/charmconf.yaml")
+CHARM_STORE_CACHE_FILENAME = path.expanduser(
+    "~/.cloud-install/charmstore-cache.json")
+
+# shared by every JujuClient we create, see Controller.authenticate_juju
+charm_store = CharmStore(cache_file=CHARM_STORE_CACHE_FILENAME)
 
 
 def get_charm_config():
@@ -56,10 +60,7 @@ def query_cs(charm, series='trusty'):
     :param str charm: charm name
     :param str series: series, defaults. trusty
     """
-    charm_store_url = 'https://manage.jujucharms.com/api/3/charm'
-    url = path.join(charm_store_url, series, charm)
-    r = requests.get(url)
-    return r.json()
+    return charm_store.lookup(path.join(series, charm))
 
 
 class DisplayPriorities:
@@ -173,6 +174,23 @@ export OS_REGION_NAME=\"RegionOne\"
         units."""
         return 1
 
+    @staticmethod
+    def _store_name(charm_name, charm_rev):
+        if charm_rev:
+            return "{}-{}".format(charm_name, charm_rev)
+        return charm_name
+
+    @classmethod
+    def charm_store_name(class_):
+        """ Return charm name as deployed from the charm store
+
+        Reads the class attributes; deploy() uses the instance's.
+
+        :returns: name of charm, with revision if one is set
+        :rtype: str
+        """
+        return class_._store_name(class_.charm_name, class_.charm_rev)
+
     @classmethod
     def name(class_):
         """ Return charm name
@@ -209,17 +227,13 @@ export OS_REGION_NAME=\"RegionOne\"
         """
         config_yaml = ""
 
-        _charm_name_rev = self.charm_name
+        _charm_name_rev = self._store_name(self.charm_name, self.charm_rev)
 
         charm_config, charm_config_raw = get_charm_config()
         log.debug("charm_config = {} ".format(charm_config))
         if self.charm_name in charm_config:
             config_yaml = charm_config_raw
 
-        # Set revision
-        if self.charm_rev:
-            _charm_name_rev = "{}-{}".format(self.charm_name, self.charm_rev)
-
         if self.config.getopt('use_nclxd'):
             # nclxd support is only enabled on vivid and later, and we
             # need to deploy from a local repo that has the right
@@ -356,6 +370,21 @@ export OS_REGION_NAME=\"RegionOne\"
             return True
         return False
 
+    def add_units(self, machine_specs):
+        """Add one unit of an already-deployed service onto each of
+        machine_specs, pipelining the requests.
+
+        Returns a list with True for each machine_spec that failed.
+        """
+        errs = []
+        for mspec, (_, err) in zip(machine_specs,
+                                   self.juju.add_units(self.charm_name,
+                                                       machine_specs)):
+            if err:
+                log.error("Error adding unit to {}: {}".format(mspec, err))
+            errs.append(err is not None)
+        return errs
+
     def post_proc(self):
         """ Perform any post processing
 
@@ -432,23 +461,23 @@ class CharmQueue:
             return
         log.debug("Processing relations: {}".format(valid_relations))
         while len(valid_relations) != len(completed_relations):
-            for relation_a, relation_b in valid_relations:
-                async.sleep_until(0)
-                try:
-                    log.debug("Calling juju.add_relation({}, {})".format(
-                        relation_a, relation_b))
-                    self.juju.add_relation(relation_a,
-                                           relation_b)
+            async.sleep_until(0)
+            pending = [r for r in valid_relations
+                       if r not in completed_relations]
+            log.debug("Calling juju.add_relations({})".format(pending))
+            results = self.juju.add_relations(pending)
+            for (relation_a, relation_b), (_, e) in zip(pending, results):
+                if e is None:
                     completed_relations.append((relation_a,
                                                 relation_b))
-                except ServerError as e:
-                    msg = ('Failure in add_relation({}, {}): {}'.format(
-                        relation_a,
-                        relation_b,
-                        e))
-                    log.exception(msg)
-                    self.ui.status_info_message(msg)
-                    raise e
+                    continue
+                msg = ('Failure in add_relation({}, {}): {}'.format(
+                    relation_a,
+                    relation_b,
+                    e))
+                log.error(msg)
+                self.ui.status_info_message(msg)
+                raise e
         self.config.setopt('relations_complete', True)
 
     def _charm_classes(self):
@@ -80,6 +80,64 @@ class Config:
                 INSTALL_TYPE_MULTI,
                 INSTALL_TYPE_SINGLE]
 
+    @property
+    def juju_watcher(self):
+        """ mirror juju status from the AllWatcher instead of polling """
+        return False
+
+    @property
+    def poll_interval_min(self):
+        """ seconds between status polls while things are changing """
+        return 2
+
+    @property
+    def poll_interval_max(self):
+        """ longest wait between status polls once nothing changes """
+        return 60
+
+    @property
+    def poll_backoff(self):
+        """ factor the poll interval grows by per unchanged poll """
+        return 1.5
+
+    @property
+    def maas_pool_size(self):
+        """ connections kept open to the MAAS api """
+        return 10
+
+    @property
+    def maas_retries(self):
+        """ retries for MAAS api reads that fail to connect or get a 5xx """
+        return 3
+
+    @property
+    def maas_timeout(self):
+        """ seconds to wait for a MAAS api response """
+        return 30
+
+    @property
+    def maas_max_rate(self):
+        """ most MAAS api requests per second from bulk operations """
+        return 0
+
+    @property
+    def maas_node_filter(self):
+        """ only use MAAS nodes matching these filters """
+        return {}
+
+    @property
+    def warm_start(self):
+        """ draw the services view from the saved status at launch """
+        return True
+
+    @property
+    def status_cache_filename(self):
+        return os.path.join(self.cfg_path, 'status-cache.json.gz')
+
+    @property
+    def node_details_cache_dir(self):
+        return os.path.join(self.cfg_path, 'node-details')
+
     @property
     def pidfile(self):
         return os.path.join(self.cfg_path, 'openstack.pid')
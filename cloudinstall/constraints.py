@@ -0,0 +1,260 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Charm constraints evaluated over many machines at once
+
+Same rules as cloudinstall.maas.satisfies(), but the constraints are
+parsed once and each one is checked against a whole column of machine
+hardware in a single pass.
+"""
+
+from array import array
+from collections import OrderedDict
+from itertools import compress
+import logging
+import sys
+import threading
+
+from cloudinstall.utils import human_to_mb
+
+log = logging.getLogger('cloudinstall.constraints')
+
+# constraint key -> MAAS node field
+CONSTRAINT_FIELDS = {'mem': 'memory',
+                     'arch': 'architecture',
+                     'storage': 'storage',
+                     'cpu_cores': 'cpu_count',
+                     'root-disk': 'storage'}
+
+NUMBER_FIELDS = ('memory', 'storage', 'cpu_count')
+
+# '*' satisfies any minimum; values that aren't numbers satisfy none
+WILDCARD = float('inf')
+UNKNOWN = float('-inf')
+
+
+def _number(v):
+    if v == '*':
+        return WILDCARD
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return UNKNOWN
+
+
+class StringTable:
+
+    """ Numbers distinct strings, so columns can hold ints """
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def code(self, s):
+        """ The code for s, adding it if it's new """
+        try:
+            return self.codes[s]
+        except KeyError:
+            s = sys.intern(s)
+            c = self.codes[s] = len(self.strings)
+            self.strings.append(s)
+            return c
+
+    def find(self, s):
+        """ The code for s, or None if it isn't in the table """
+        return self.codes.get(s)
+
+
+class CompiledConstraints:
+
+    """ A constraints dict with its sizes parsed, ready to evaluate.
+    Get them from compile_constraints(), which keeps one per distinct
+    dict.
+
+    :param dict constraints: as for satisfies(), or None for none
+    """
+
+    def __init__(self, constraints):
+        # (constraint key, node field, required value), in dict order
+        self.checks = []
+        for k, v in (constraints or {}).items():
+            field = CONSTRAINT_FIELDS[k]
+            if field != 'architecture':
+                v = float(v) if str(v).isdecimal() else human_to_mb(v)
+            self.checks.append((k, field, v))
+        self.key = tuple(self.checks)
+
+    def failures(self, machine):
+        """ Constraint keys machine fails, for one machine that isn't
+        in a MachineTable
+        """
+        failed = []
+        for k, field, v in self.checks:
+            mval = machine.machine.get(field)
+            if field == 'architecture':
+                if mval != '*' and mval != v:
+                    failed.append(k)
+            elif _number(mval) < v:
+                failed.append(k)
+        return failed
+
+    def __repr__(self):
+        return "<CompiledConstraints {}>".format(
+            " ".join("{}={}".format(k, v) for k, _, v in self.checks))
+
+
+_compiled = {}
+
+
+def compile_constraints(constraints):
+    """ The CompiledConstraints for a constraints dict """
+    key = tuple((constraints or {}).items())
+    try:
+        return _compiled[key]
+    except KeyError:
+        c = _compiled[key] = CompiledConstraints(constraints)
+        return c
+    except TypeError:
+        # unhashable values
+        return CompiledConstraints(constraints)
+
+
+class ConstraintMask:
+
+    """ Which rows of a MachineTable satisfy some constraints
+
+    :ivar mask: list of bools, one per row
+    :ivar failed: OrderedDict of constraint key -> list of bools, True
+                  for rows that fail that key
+    """
+
+    def __init__(self, table, compiled, mask, failed):
+        self.table = table
+        self.compiled = compiled
+        self.mask = mask
+        self.failed = failed
+
+    def satisfied(self, machine):
+        """ True if machine satisfies the constraints """
+        row = self.table.row(machine)
+        if row is None:
+            return not self.compiled.failures(machine)
+        return self.mask[row]
+
+    def failures(self, machine):
+        """ Constraint keys machine fails, in constraint order """
+        row = self.table.row(machine)
+        if row is None:
+            return self.compiled.failures(machine)
+        return [k for k, fails in self.failed.items() if fails[row]]
+
+    def machines(self):
+        """ The satisfying machines, in table order """
+        return list(compress(self.table.machines, self.mask))
+
+    def count(self):
+        return self.mask.count(True)
+
+
+class MachineTable:
+
+    """ Hardware of a list of machines held as columns: memory,
+    storage and cpu_count as floats and architecture as StringTable
+    codes, read from each machine's .machine dict.
+
+    Masks from evaluate() are kept per distinct constraints, so a table
+    can be asked about the same charm repeatedly. The machines
+    shouldn't change while it's in use; for_machines() builds a new
+    table whenever the list does.
+    """
+
+    def __init__(self, machines):
+        self.machines = list(machines)
+        self.rows = {id(m): i for i, m in enumerate(self.machines)}
+        self.strings = StringTable()
+        self.any_arch = self.strings.code('*')
+        self.columns = {field: array('d') for field in NUMBER_FIELDS}
+        self.arch = array('I')
+        columns = [(self.columns[f].append, f) for f in NUMBER_FIELDS]
+        code = self.strings.code
+        for m in self.machines:
+            d = m.machine
+            for append, field in columns:
+                append(_number(d.get(field)))
+            arch = d.get('architecture')
+            self.arch.append(code(arch if isinstance(arch, str) else ''))
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.machines)
+
+    def row(self, machine):
+        """ The row of machine, or None if it isn't in the table """
+        return self.rows.get(id(machine))
+
+    def evaluate(self, constraints):
+        """ Checks every machine against constraints
+
+        :param constraints: a constraints dict or CompiledConstraints
+        :rtype: ConstraintMask
+        """
+        if not isinstance(constraints, CompiledConstraints):
+            constraints = compile_constraints(constraints)
+        result = self._masks.get(constraints.key)
+        if result is not None:
+            return result
+
+        failed = OrderedDict()
+        for k, field, v in constraints.checks:
+            if field == 'architecture':
+                want, any_arch = self.strings.find(v), self.any_arch
+                failed[k] = [c != want and c != any_arch
+                             for c in self.arch]
+            else:
+                failed[k] = [x < v for x in self.columns[field]]
+        if not failed:
+            mask = [True] * len(self.machines)
+        elif len(failed) == 1:
+            mask = [not f for f in next(iter(failed.values()))]
+        else:
+            mask = [not any(fs) for fs in zip(*failed.values())]
+        result = self._masks[constraints.key] = ConstraintMask(
+            self, constraints, mask, failed)
+        return result
+
+    # machine ids -> table. tables hold their machines, so the ids
+    # aren't reused while they're in here
+    _cache = OrderedDict()
+    _cache_size = 4
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def for_machines(cls, machines):
+        """ A table for machines, reused while the same machine objects
+        are passed in the same order
+        """
+        key = tuple(map(id, machines))
+        with cls._cache_lock:
+            table = cls._cache.get(key)
+            if table is not None:
+                cls._cache.move_to_end(key)
+                return table
+        table = cls(machines)
+        with cls._cache_lock:
+            cls._cache[key] = table
+            while len(cls._cache) > cls._cache_size:
+                cls._cache.popitem(last=False)
+        return table
@@ -13,7 +13,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
 import logging
+import threading
 import time
 
 from os import path, getenv
@@ -25,11 +27,15 @@ from cloudinstall.config import OPENSTACK_RELEASE_LABELS
 from cloudinstall import utils
 from cloudinstall.alarms import AlarmMonitor
 from cloudinstall.state import ControllerState
-from cloudinstall.juju import JujuState
+from cloudinstall.juju import (JujuState, JujuStatusChanges,
+                               JujuStatusSnapshot)
 from cloudinstall.maas import (connect_to_maas, FakeMaasState,
-                               MaasMachineStatus)
-from cloudinstall.charms import CharmQueue
+                               MaasReadinessWatcher)
+from cloudinstall.charms import CharmQueue, charm_store
 from cloudinstall.log import PrettyLog
+from cloudinstall.statuscache import (CachedJujuState, CachedMaasState,
+                                      StatusCache)
+from cloudinstall.polling import PollingPolicy
 from cloudinstall.placement.controller import (PlacementController,
                                                AssignmentType)
 
@@ -42,6 +48,9 @@ log = logging.getLogger('cloudinstall.core')
 
 class FakeJujuState:
 
+    published = JujuStatusSnapshot({})
+    stale_since = None
+
     @property
     def services(self):
         return []
@@ -49,9 +58,19 @@ class FakeJujuState:
     def machines(self):
         return []
 
-    def invalidate_status_cache(self):
+    def invalidate_status_cache(self, since=None):
+        "does nothing"
+
+    def subscribe(self, callback, kinds=None):
+        "does nothing"
+
+    def unsubscribe(self, callback):
         "does nothing"
 
+    def publish_changes(self):
+        snapshot = JujuStatusSnapshot({})
+        return JujuStatusChanges(snapshot, snapshot)
+
 
 class Controller:
 
@@ -67,9 +86,16 @@ class Controller:
         self.maas = None
         self.maas_state = None
         self.nodes = []
+        # charm classes of deployed services, reloaded when services
+        # are added or removed
+        self.node_charm_classes = None
         self.juju_m_idmap = None  # for single, {instance_id: machine id}
         self.deployed_charm_classes = []
         self.placement_controller = None
+        # copied for each status cache and wait loop that polls juju
+        self.polling = PollingPolicy.from_config(self.config)
+        self.status_cache = StatusCache(self.config.status_cache_filename)
+        self.status_cache_saved = 0
         if not self.config.getopt('current_state'):
             self.config.setopt('current_state',
                                ControllerState.INSTALL_WAIT.value)
@@ -118,41 +144,132 @@ class Controller:
         """
         if not self.juju_state:
             return
-        deployed_services = sorted(self.juju_state.services,
-                                   key=attrgetter('service_name'))
-        deployed_service_names = [s.service_name for s in deployed_services]
-
-        charm_classes = sorted(
-            [m.__charm_class__ for m in
-             utils.load_charms(self.config.getopt('charm_plugin_dir'))
-             if m.__charm_class__.charm_name in
-             deployed_service_names],
-            key=attrgetter('charm_name'))
-
-        self.nodes = list(zip(charm_classes, deployed_services))
+        changes = self.juju_state.publish_changes()
+        if changes and not self.juju_state.stale_since and \
+           time.time() - self.status_cache_saved > 60:
+            # stamp it now so a slow save isn't queued again meanwhile
+            self.status_cache_saved = time.time()
+            async.submit(self.save_status_cache,
+                         self.ui.show_exception_message)
+        if self.node_charm_classes is None:
+            deployed_service_names = [s.service_name for s in
+                                      changes.new.services]
+            self.node_charm_classes = sorted(
+                [m.__charm_class__ for m in
+                 utils.load_charms(self.config.getopt('charm_plugin_dir'))
+                 if m.__charm_class__.charm_name in
+                 deployed_service_names],
+                key=attrgetter('charm_name'))
+            self.nodes = None
+        if changes or self.nodes is None:
+            self.nodes = [(c, changes.new.service(c.charm_name))
+                          for c in self.node_charm_classes]
 
         if len(self.nodes) == 0:
             return
         else:
-            if not self.ui.services_view:
+            view = self.ui.services_view
+            # eg. connected, after drawing from the saved status
+            replaced = view and (view.juju_state is not self.juju_state or
+                                 view.maas_state is not self.maas_state)
+            if not view or replaced:
                 self.ui.render_services_view(
                     self.nodes, self.juju_state,
                     self.maas_state, self.config)
             else:
                 self.ui.refresh_services_view(self.nodes, self.config)
 
+    def _deployed_services_changed(self, changes):
+        self.node_charm_classes = None
+
     def authenticate_juju(self):
-        if not len(self.config.juju_env['state-servers']) > 0:
-            state_server = 'localhost:17070'
-        else:
-            state_server = self.config.juju_env['state-servers'][0]
-        self.juju = JujuClient(
-            url=path.join('wss://', state_server),
-            password=self.config.juju_api_password)
-        self.juju.login()
-        self.juju_state = JujuState(self.juju)
+        self._use_juju(*self.connect_juju())
+
+    def connect_juju(self):
+        """ Logs in to the juju api
+
+        Leaves self alone, so it can run on a worker while the UI shows
+        a warm start.
+
+        :returns: the JujuClient and a JujuState using it
+        """
+        state_servers = self.config.juju_env['state-servers']
+        if not len(state_servers) > 0:
+            state_servers = ['localhost:17070']
+        urls = [path.join('wss://', s) for s in state_servers]
+        juju = JujuClient(
+            url=urls[0],
+            password=self.config.juju_api_password,
+            charm_store=charm_store,
+            alternate_urls=urls[1:])
+        juju.login()
+        juju_state = JujuState(
+            juju, use_watcher=self.config.getopt('juju_watcher'),
+            polling=self.polling.copy())
+        juju_state.subscribe(self._deployed_services_changed,
+                             [JujuStatusChanges.SERVICE_ADDED,
+                              JujuStatusChanges.SERVICE_REMOVED])
+        return juju, juju_state
+
+    def _use_juju(self, juju, juju_state):
+        self.juju = juju
+        self.juju_state = juju_state
+        atexit.register(self.dump_api_stats)
+        atexit.register(self.save_status_cache)
         log.debug('Authenticated against juju api.')
 
+    def dump_api_stats(self):
+        """ Saves per-request Juju API call stats to api-stats.json """
+        filename = path.join(self.config.cfg_path, 'api-stats.json')
+        try:
+            self.juju.api_stats.dump(filename)
+        except OSError as e:
+            log.warning("Unable to save api stats: {}".format(e))
+            return
+        log.debug("Juju API calls:\n{}".format(
+            self.juju.api_stats.summary()))
+        log.debug("status fetches: {}, saved by sharing: {}".format(
+            self.juju_state.status_fetches,
+            self.juju_state.status_fetches_saved))
+
+    def warm_start(self):
+        """ Draws the services view from the status saved by the last
+        run, marked stale, so there's something to show while juju
+        and MAAS are connected.
+
+        :returns: True if there was a saved status to use
+        """
+        if not self.config.getopt('warm_start') or \
+           getenv("FAKE_API_DATA") or \
+           self.config.getopt('current_state') != ControllerState.SERVICES:
+            return False
+        cached = self.status_cache.load()
+        if cached is None:
+            return False
+        juju_status, maas_nodes, saved = cached
+        log.info("Showing status saved at {} until connected".format(
+            time.ctime(saved)))
+        self.juju_state = CachedJujuState(juju_status, saved)
+        if maas_nodes is not None:
+            self.maas_state = CachedMaasState(maas_nodes, saved)
+        return True
+
+    def save_status_cache(self):
+        """ Saves the last status seen, for warm_start() """
+        if self.juju_state is None or self.juju_state.stale_since:
+            return
+        status = self.juju_state.published.status
+        if not status:
+            return
+        nodes = None
+        if self.maas_state:
+            nodes = self.maas_state.known_nodes()
+        try:
+            self.status_cache.save(status, nodes)
+        except OSError as e:
+            log.warning("Unable to save status cache: {}".format(e))
+        self.status_cache_saved = time.time()
+
     def initialize(self):
         """Authenticates against juju/maas and sets up placement controller."""
         if getenv("FAKE_API_DATA"):
@@ -162,8 +279,61 @@ class Controller:
             self.authenticate_juju()
             if self.config.is_multi():
                 creds = self.config.getopt('maascreds')
-                self.maas, self.maas_state = connect_to_maas(creds)
+                self.maas, self.maas_state = connect_to_maas(creds,
+                                                             self.config)
+                self.prefetch_node_details()
+        self.initialize_placement()
+
+    def initialize_after_warm_start(self):
+        """ initialize(), for when the UI loop is already drawing the
+        saved status.
+
+        Runs on an AsyncPool worker: connects and fetches the first juju
+        status and MAAS nodes here, then hands the connections to the UI
+        loop, which swaps them in and sets up placement.
+        """
+        juju, juju_state = self.connect_juju()
+        juju_state.status()
+        maas = maas_state = None
+        if self.config.is_multi():
+            creds = self.config.getopt('maascreds')
+            maas, maas_state = connect_to_maas(creds, self.config)
+            maas_state.machines()
 
+        def connected():
+            try:
+                self._use_juju(juju, juju_state)
+                if maas_state is not None:
+                    self.maas, self.maas_state = maas, maas_state
+                    self.prefetch_node_details()
+                self.initialize_placement()
+            except Exception as e:
+                log.exception("Error setting up after warm start")
+                self.ui.show_exception_message(e)
+        self.loop.call_from_thread(connected)
+
+    def prefetch_node_details(self):
+        """ Fills the MAAS node details cache in the background, for the
+        hardware shown in placement
+
+        Runs on its own thread rather than the AsyncPool worker, so a
+        deployment doesn't queue behind downloading every node's details.
+        """
+        if self.config.getopt('headless'):
+            return
+        maas_state = self.maas_state
+
+        def prefetch():
+            try:
+                maas_state.prefetch_node_details()
+            except Exception as e:
+                log.warning("Couldn't prefetch MAAS node details: "
+                            "{}".format(e))
+        threading.Thread(target=prefetch, name='maas-details-prefetch',
+                         daemon=True).start()
+
+    def initialize_placement(self):
+        """ Sets up the placement controller and starts deploying """
         self.placement_controller = PlacementController(
             self.maas_state, self.config)
 
@@ -235,12 +405,17 @@ class Controller:
         if self.config.is_multi():
 
             # now all machines are added
-            self.maas.tag_fpi(self.maas.nodes)
-            self.maas.nodes_accept_all()
-            self.maas.tag_name(self.maas.nodes)
+            self.maas_state.invalidate_nodes_cache()
+            nodes = self.maas_state.nodes()
+            self.maas.tag_fpi(nodes)
+            if self.maas_state.node_filter:
+                self.maas.nodes_accept([n['system_id'] for n in nodes
+                                        if n['status'] == 0])
+            else:
+                self.maas.nodes_accept_all()
+            self.maas.tag_name(nodes)
 
-            while not self.all_maas_machines_ready():
-                time.sleep(3)
+            self.wait_for_maas_machines_ready()
 
             self.add_machines_to_juju_multi()
 
@@ -248,17 +423,16 @@ class Controller:
             self.add_machines_to_juju_single()
 
         # Quiet out some of the logging
-        _previous_summary = None
+        poll = self.polling.copy()
         while not self.all_juju_machines_started():
             sd = self.juju_state.machines_summary()
             summary = ", ".join(["{} {}".format(v, k) for k, v
                                  in sd.items()])
-            if summary != _previous_summary:
+            if poll.observe(summary):
                 self.ui.status_info_message("Waiting for machines to "
                                             "start: {}".format(summary))
-                _previous_summary = summary
 
-            async.sleep_until(1)
+            async.sleep_until(poll.interval)
 
         if len(self.juju_state.machines()) == 0:
             raise Exception("Expected some juju machines started.")
@@ -281,28 +455,28 @@ class Controller:
         else:
             self.ui.status_info_message("Ready")
 
-    def all_maas_machines_ready(self):
-        self.maas_state.invalidate_nodes_cache()
+    def wait_for_maas_machines_ready(self):
+        """ Returns once every machine placement assigned charms to is
+        READY or ALLOCATED in MAAS, and meets the constraints option
 
-        cons = self.config.getopt('constraints')
-        needed = set([m.instance_id for m in
-                      self.placement_controller.machines_pending()])
-        ready = set([m.instance_id for m in
-                     self.maas_state.machines(MaasMachineStatus.READY,
-                                              constraints=cons)])
-        allocated = set([m.instance_id for m in
-                         self.maas_state.machines(MaasMachineStatus.ALLOCATED,
-                                                  constraints=cons)
-                         ])
+        :raises MaasNodesMissingError: if MAAS no longer knows some of
+                                       the machines
+        """
+        needed = [m.system_id for m in
+                  self.placement_controller.machines_pending()]
+        watcher = MaasReadinessWatcher(
+            self.maas, needed, on_progress=self._maas_readiness_progress,
+            polling=self.polling.copy(),
+            constraints=self.config.getopt('constraints'))
+        watcher.wait(sleep=async.sleep_until)
+        self.maas_state.invalidate_nodes_cache()
 
+    def _maas_readiness_progress(self, watcher):
         summary = ", ".join(["{} {}".format(v, k) for k, v in
-                             self.maas_state.machines_summary().items()])
+                             watcher.summary().items()])
         self.ui.status_info_message("Waiting for {} maas machines to be ready."
-                                    " Machines Summary: {}".format(len(needed),
-                                                                   summary))
-        if not needed.issubset(ready.union(allocated)):
-            return False
-        return True
+                                    " Machines Summary: {}".format(
+                                        len(watcher.pending), summary))
 
     def add_machines_to_juju_multi(self):
         """Adds each of the machines used for the placement to juju, if it
@@ -338,23 +512,19 @@ class Controller:
     def add_machines_to_juju_single(self):
         self.juju_state.invalidate_status_cache()
         self.juju_m_idmap = {}
-        for jm in self.juju_state.machines():
-            response = self.juju.get_annotations(jm.machine_id,
-                                                 'machine')
+        juju_machines = self.juju_state.machines()
+        responses = self.juju.get_annotations_many(
+            [jm.machine_id for jm in juju_machines], 'machine')
+        for jm, (response, err) in zip(juju_machines, responses):
+            if err:
+                raise err
             ann = response['Annotations']
             if 'instance_id' in ann:
                 self.juju_m_idmap[ann['instance_id']] = jm.machine_id
 
         log.debug("existing juju machines: {}".format(self.juju_m_idmap))
 
-        def get_created_machine_id(iid, response):
-            d = response['Machines'][0]
-            if d['Error']:
-                raise Exception("Error adding machine '{}':"
-                                "{}".format(iid, response))
-            else:
-                return d['Machine']
-
+        new_machines = []
         for machine in self.placement_controller.machines_pending():
             if machine.instance_id in self.juju_m_idmap:
                 machine.machine_id = self.juju_m_idmap[machine.instance_id]
@@ -364,13 +534,29 @@ class Controller:
                 continue
             log.debug("adding machine with "
                       "constraints={}".format(machine.constraints))
-            rv = self.juju.add_machine(constraints=machine.constraints)
-            m_id = get_created_machine_id(machine.instance_id, rv)
-            machine.machine_id = m_id
-            rv = self.juju.set_annotations(m_id, 'machine',
-                                           {'instance_id':
-                                            machine.instance_id})
-            self.juju_m_idmap[machine.instance_id] = m_id
+            new_machines.append(machine)
+
+        if len(new_machines) == 0:
+            return
+
+        # one AddMachines call for all of them, then one pipelined
+        # batch of SetAnnotations:
+        rv = self.juju.add_machines(
+            [self.juju.machine_params(constraints=m.constraints)
+             for m in new_machines])
+        for machine, d in zip(new_machines, rv['Machines']):
+            if d['Error']:
+                raise Exception("Error adding machine '{}':"
+                                "{}".format(machine.instance_id, rv))
+            machine.machine_id = d['Machine']
+            self.juju_m_idmap[machine.instance_id] = d['Machine']
+
+        results = self.juju.set_annotations_many(
+            'machine', [(m.machine_id, {'instance_id': m.instance_id})
+                        for m in new_machines])
+        for _, err in results:
+            if err:
+                raise err
 
     def run_apt_go_fast(self, machine_id):
         utils.remote_cp(machine_id,
@@ -408,6 +594,8 @@ class Controller:
         charm_classes = sorted(assigned_ccs,
                                key=attrgetter('deploy_priority'))
 
+        self.prefetch_charm_store(charm_classes)
+
         def undeployed_charm_classes():
             return [c for c in charm_classes
                     if c not in self.deployed_charm_classes]
@@ -417,6 +605,7 @@ class Controller:
                              undeployed_charm_classes()]
             self.ui.set_pending_deploys(pending_names)
 
+        poll = self.polling.copy()
         while len(undeployed_charm_classes()) > 0:
             update_pending_display()
 
@@ -425,10 +614,7 @@ class Controller:
                     "Checking if {c} is deployed".format(
                         c=charm_class.display_name))
 
-                service_names = [s.service_name for s in
-                                 self.juju_state.services]
-
-                if charm_class.charm_name in service_names:
+                if self.juju_state.has_service(charm_class.charm_name):
                     self.ui.status_info_message(
                         "{c} is already deployed, skipping".format(
                             c=charm_class.display_name))
@@ -455,9 +641,21 @@ class Controller:
                 log.debug("deployed_charm_classes={}".format(
                     PrettyLog(self.deployed_charm_classes)))
 
-                async.sleep_until(5)
+                poll.observe(num_remaining)
+                async.sleep_until(poll.interval)
             update_pending_display()
 
+    def prefetch_charm_store(self, charm_classes):
+        """Resolve the charm store entries of all charm_classes at once, so
+        the deploys that follow don't wait on the charm store one by one.
+        """
+        if self.config.getopt('use_nclxd'):
+            return
+        names = [c.charm_store_name() for c in charm_classes
+                 if 'charmstore' in c.available_sources]
+        for name, e in charm_store.prefetch(names).items():
+            log.warning("could not prefetch charm {}: {}".format(name, e))
+
     def try_deploy(self, charm_class):
         "returns True if deploy is deferred and should be tried again."
 
@@ -468,6 +666,7 @@ class Controller:
 
         asts = self.placement_controller.get_assignments(charm_class)
         errs = []
+        add_unit_machines = []
         first_deploy = True
         for atype, ml in asts.items():
             for machine in ml:
@@ -476,27 +675,36 @@ class Controller:
                     errs.append(machine)
                     continue
 
-                if first_deploy:
-                    msg = "Deploying {c}".format(c=charm_class.display_name)
-                    if mspec != '':
-                        msg += " to machine {mspec}".format(mspec=mspec)
-                    self.ui.status_info_message(msg)
-                    deploy_err = charm.deploy(mspec)
-                    if deploy_err:
-                        errs.append(machine)
-                    else:
-                        first_deploy = False
+                if not first_deploy:
+                    # service already deployed, add-unit in one batch below
+                    add_unit_machines.append((machine, atype, mspec))
+                    continue
+
+                msg = "Deploying {c}".format(c=charm_class.display_name)
+                if mspec != '':
+                    msg += " to machine {mspec}".format(mspec=mspec)
+                self.ui.status_info_message(msg)
+                deploy_err = charm.deploy(mspec)
+                if deploy_err:
+                    errs.append(machine)
+                else:
+                    first_deploy = False
+                    self.placement_controller.mark_deployed(machine,
+                                                            charm_class,
+                                                            atype)
+
+        if len(add_unit_machines) > 0:
+            self.ui.status_info_message(
+                "Adding {n} units of {c}".format(
+                    n=len(add_unit_machines),
+                    c=charm_class.display_name))
+            unit_errs = charm.add_units([mspec for _, _, mspec
+                                         in add_unit_machines])
+            for (machine, atype, _), deploy_err in zip(add_unit_machines,
+                                                       unit_errs):
+                if deploy_err:
+                    errs.append(machine)
                 else:
-                    # service already deployed, need to add-unit
-                    msg = ("Adding one unit of "
-                           "{c}".format(c=charm_class.display_name))
-                    if mspec != '':
-                        msg += " to machine {mspec}".format(mspec=mspec)
-                    self.ui.status_info_message(msg)
-                    deploy_err = charm.add_unit(machine_spec=mspec)
-                    if deploy_err:
-                        errs.append(machine)
-                if not deploy_err:
                     self.placement_controller.mark_deployed(machine,
                                                             charm_class,
                                                             atype)
@@ -516,9 +724,10 @@ class Controller:
             # placeholder machines do not use a machine spec
             return ""
 
-        jm = next((m for m in self.juju_state.machines()
-                   if (m.instance_id == maas_machine.instance_id or
-                       m.machine_id == maas_machine.machine_id)), None)
+        snapshot = self.juju_state.snapshot()
+        jm = snapshot.machine_by_instance_id(maas_machine.instance_id)
+        if jm is None or jm.machine_id == '0' or '/' in jm.machine_id:
+            jm = snapshot.machine(maas_machine.machine_id)
         if jm is None:
             log.error("could not find juju machine matching {}"
                       " (instance id {})".format(maas_machine,
@@ -547,18 +756,14 @@ class Controller:
         self.ui.status_info_message(
             "Waiting for deployed services to be in a ready state.")
 
-        not_ready_len = 0
+        poll = self.polling.copy()
         while not self.juju_state.all_agents_started():
             not_ready = [(a, b) for a, b in self.juju_state.get_agent_states()
                          if b != 'started']
-            if len(not_ready) == not_ready_len:
-                async.sleep_until(3)
-                continue
-
-            not_ready_len = len(not_ready)
-            log.info("Checking availability of {} ".format(
-                ", ".join(["{}:{}".format(a, b) for a, b in not_ready])))
-            async.sleep_until(3)
+            if poll.observe(not_ready):
+                log.info("Checking availability of {} ".format(
+                    ", ".join(["{}:{}".format(a, b) for a, b in not_ready])))
+            async.sleep_until(poll.interval)
 
         self.config.setopt('deploy_complete', True)
         self.ui.status_info_message(
@@ -636,7 +841,12 @@ class Controller:
             rel = self.config.getopt('openstack_release')
             label = OPENSTACK_RELEASE_LABELS[rel]
             self.ui.set_openstack_rel(label)
-            self.initialize()
+            if self.warm_start():
+                # reconciles with the live status once connected
+                async.submit(self.initialize_after_warm_start,
+                             self.ui.show_exception_message)
+            else:
+                self.initialize()
             self.loop.register_callback('refresh_display', self.update)
             AlarmMonitor.add_alarm(self.loop.set_alarm_in(0, self.update),
                                    "controller-start")
@@ -38,6 +38,8 @@ class EventLoop:
         self._callback_map = {}
 
         self.loop = None
+        # the asyncio loop under urwid's
+        self._aloop = None
 
         if not self.config.getopt('headless'):
             self.loop = self._build_loop()
@@ -60,7 +62,7 @@ class EventLoop:
         }
         additional_opts['screen'].set_terminal_properties(colors=256)
         additional_opts['screen'].reset_default_terminal_palette()
-        evl = asyncio.get_event_loop()
+        evl = self._aloop = asyncio.get_event_loop()
         return urwid.MainLoop(
             self.ui, STYLES,
             event_loop=urwid.AsyncioEventLoop(loop=evl), **additional_opts)
@@ -113,6 +115,14 @@ class EventLoop:
             return self.loop.set_alarm_in(interval, cb)
         return
 
+    def call_from_thread(self, cb):
+        """ Runs cb() on the UI loop, for handing results back from
+        worker threads. set_alarm_in() is only safe from the UI loop.
+        """
+        if self.config.getopt('headless'):
+            return cb()
+        self._aloop.call_soon_threadsafe(cb)
+
     def remove_alarm(self, handle):
         if not self.config.getopt('headless'):
             return self.loop.remove_alarm(handle)
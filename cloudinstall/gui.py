@@ -192,6 +192,8 @@ class PegasusGUI(WidgetWrap):
         self.frame.set_footer(self.frame.footer)
 
     def render_services_view(self, nodes, juju_state, maas_state, config):
+        if self.services_view:
+            self.services_view.detach()
         self.services_view = ServicesView(nodes, juju_state, maas_state,
                                           config)
         self.frame.body = self.services_view
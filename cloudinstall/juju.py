@@ -16,36 +16,644 @@
 
 """ Represents a juju status """
 
-from collections import Counter
+from collections import Counter, OrderedDict, namedtuple
+from concurrent import futures
 import logging
+import threading
 import time
+from types import MappingProxyType
 
 from cloudinstall.machine import Machine
+from cloudinstall.polling import PollingPolicy
 from cloudinstall.service import Service
 
-from macumba import RequestTimeout
+from macumba import MacumbaError, RequestTimeout
 
 log = logging.getLogger('cloudinstall.juju')
 
 
+def _agent_status(info):
+    """ FullStatus style 'Agent' entry from an AllWatcher delta
+
+    Errors are reported in Status and StatusInfo, eg. 'error' and
+    'hook failed: "install"'; Err is only set by FullStatus when it
+    couldn't read an entity at all.
+    """
+    return {'Status': info.get('Status', ''),
+            'Info': info.get('StatusInfo', ''),
+            'Data': info.get('StatusData') or {},
+            'Err': None}
+
+
+def _machine_status(info):
+    """ FullStatus style machine entry from an AllWatcher machine delta """
+    hw = info.get('HardwareCharacteristics') or {}
+    hardware = []
+    for k, hk in [('Arch', 'arch'), ('CpuCores', 'cpu-cores'),
+                  ('Mem', 'mem'), ('RootDisk', 'root-disk')]:
+        if hw.get(k) is not None:
+            v = hw[k]
+            if hk in ['mem', 'root-disk']:
+                v = "{}M".format(v)
+            hardware.append("{}={}".format(hk, v))
+    addresses = info.get('Addresses') or []
+    public = [a['Value'] for a in addresses
+              if a.get('Scope') == 'public']
+    dns_name = (public or [a['Value'] for a in addresses] or [''])[0]
+    return {'Id': info['Id'],
+            'InstanceId': info.get('InstanceId', ''),
+            'Agent': _agent_status(info),
+            'AgentState': info.get('Status', ''),
+            'AgentStateInfo': info.get('StatusInfo', ''),
+            'Err': None,
+            'Life': info.get('Life', ''),
+            'Series': info.get('Series', ''),
+            'Jobs': info.get('Jobs', []),
+            'DNSName': dns_name,
+            'Hardware': " ".join(hardware),
+            'HasVote': info.get('HasVote'),
+            'WantsVote': info.get('WantsVote'),
+            'Containers': {}}
+
+
+def _unit_status(info):
+    """ FullStatus style unit entry from an AllWatcher unit delta """
+    workload = info.get('WorkloadStatus') or {}
+    agent = info.get('AgentStatus') or {}
+    return {'Agent': _agent_status(info),
+            'AgentState': info.get('Status', ''),
+            'AgentStateInfo': info.get('StatusInfo', ''),
+            'Err': None,
+            'Machine': info.get('MachineId', ''),
+            'PublicAddress': info.get('PublicAddress', ''),
+            'Charm': info.get('CharmURL', ''),
+            'Workload': {'Status': workload.get('Current', ''),
+                         'Info': workload.get('Message', '')},
+            'UnitAgent': {'Status': agent.get('Current', '')}}
+
+
+class JujuWatcher:
+
+    """ In-memory mirror of the juju environment, kept current by the
+    AllWatcher delta stream.
+
+    The mirror is kept in the same shape as a FullStatus response so
+    JujuState can read from it unchanged: subordinate units are listed
+    under their principal unit's 'Subordinates', not in their own
+    service's 'Units'. Each batch of deltas produces a new status dict;
+    only the entries that changed are rebuilt, everything else is
+    shared with the previous one, so readers can hold on to a status
+    without locking.
+    """
+
+    def __init__(self, juju):
+        self.juju = juju
+        self.watcher_id = None
+        self._status = None
+        self._relations = {}
+        self._networks = {}
+        # subordinate unit name -> latest delta
+        self._subordinates = {}
+        self._subordinate_services = set()
+        # principal unit names currently holding 'Subordinates'
+        self._principals = set()
+        self._resync = False
+        self._thread = None
+        self._stop = threading.Event()
+        self.synced = threading.Event()
+        self.n_deltas = 0
+
+    def status(self):
+        """ Latest mirrored status, or None until the first batch of
+        deltas has been applied.
+        """
+        return self._status
+
+    def start(self, networks=None):
+        """ Starts watching in a background thread
+
+        :param dict networks: FullStatus 'Networks', which the
+                              AllWatcher does not report. If None they
+                              are fetched from the watching thread.
+        """
+        self._status = None
+        self._networks = networks
+        self._thread = threading.Thread(target=self._run,
+                                        name='juju-allwatcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops watching. Stopping the AllWatcher on the server also
+        ends a Next call that's waiting for deltas.
+        """
+        self._stop.set()
+        self.synced.clear()
+        if self.watcher_id is None:
+            return
+        try:
+            self.juju.stop_watcher(self.watcher_id)
+        except MacumbaError:
+            log.debug("Couldn't stop AllWatcher {}".format(self.watcher_id))
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def current(self):
+        """ True while the mirror has synced and is still watching """
+        return self.synced.is_set() and self.is_running
+
+    def _run(self):
+        try:
+            self._watch()
+        except Exception:
+            # eg. a delta in a shape apply() doesn't expect
+            log.exception("AllWatcher mirror failed, falling back to "
+                          "polling FullStatus")
+        finally:
+            self.synced.clear()
+
+    def _watch(self):
+        try:
+            if self._networks is None:
+                self._networks = self.juju.status().get('Networks') or {}
+            self.watcher_id = self.juju.get_watcher()['AllWatcherId']
+        except MacumbaError:
+            log.exception("Couldn't start AllWatcher, polling FullStatus")
+            return
+        while not self._stop.is_set():
+            try:
+                rv = self.juju.get_watched_tasks(self.watcher_id)
+            except MacumbaError:
+                if self._stop.is_set():
+                    return
+                # AllWatcher ids don't survive a reconnect, so start a
+                # new one. Its first batch is the whole environment.
+                log.debug("AllWatcher {} failed, "
+                          "re-watching".format(self.watcher_id))
+                try:
+                    self.watcher_id = self.juju.get_watcher()['AllWatcherId']
+                except MacumbaError:
+                    log.exception("AllWatcher stopped, falling back to "
+                                  "polling FullStatus")
+                    return
+                self._resync = True
+                continue
+            if self._stop.is_set():
+                return
+            self.apply(rv.get('Deltas', []))
+
+    def apply(self, deltas):
+        """ Applies a list of [entity, change|remove, info] deltas """
+        prev = self._status
+        if prev is None or self._resync:
+            prev = {'Machines': {}, 'Services': {}, 'Relations': [],
+                    'Networks': self._networks or {}}
+            self._relations = {}
+            self._subordinates = {}
+            self._subordinate_services = set()
+            self._principals = set()
+            self._resync = False
+        machines = dict(prev['Machines'])
+        services = dict(prev['Services'])
+        touched_services = set()
+        relations_changed = False
+        subordinates_changed = False
+
+        def copy_service(name):
+            if name not in touched_services:
+                svc = dict(services.get(name, {'Units': {},
+                                               'Relations': {}}))
+                svc['Units'] = dict(svc.get('Units') or {})
+                services[name] = svc
+                touched_services.add(name)
+            return services[name]
+
+        for entity, change, info in deltas:
+            self.n_deltas += 1
+            removed = change == 'remove'
+            if entity == 'machine':
+                self._apply_machine(machines, info, removed)
+            elif entity == 'service':
+                if removed:
+                    services.pop(info['Name'], None)
+                    self._subordinate_services.discard(info['Name'])
+                    continue
+                if info['Name'] not in services:
+                    relations_changed = True
+                svc = copy_service(info['Name'])
+                svc['Charm'] = info.get('CharmURL', '')
+                svc['Exposed'] = info.get('Exposed', False)
+                svc['Life'] = info.get('Life', '')
+                if info.get('Subordinate'):
+                    self._subordinate_services.add(info['Name'])
+                    subordinates_changed = True
+            elif entity == 'unit':
+                if info.get('Subordinate') or \
+                   info['Service'] in self._subordinate_services:
+                    self._subordinate_services.add(info['Service'])
+                    if removed:
+                        self._subordinates.pop(info['Name'], None)
+                    else:
+                        self._subordinates[info['Name']] = info
+                    subordinates_changed = True
+                    continue
+                svc = copy_service(info['Service'])
+                if removed:
+                    svc['Units'].pop(info['Name'], None)
+                else:
+                    svc['Units'][info['Name']] = _unit_status(info)
+            elif entity == 'relation':
+                relations_changed = True
+                if removed:
+                    self._relations.pop(info['Key'], None)
+                else:
+                    self._relations[info['Key']] = info
+
+        if relations_changed:
+            for name in services:
+                copy_service(name)['Relations'] = {}
+            for rel in self._relations.values():
+                eps = rel.get('Endpoints', [])
+                for ep in eps:
+                    if ep['ServiceName'] not in services:
+                        continue
+                    others = [o['ServiceName'] for o in eps
+                              if o is not ep] or [ep['ServiceName']]
+                    rels = services[ep['ServiceName']]['Relations']
+                    rels.setdefault(ep['Relation']['Name'],
+                                    []).extend(others)
+
+        if subordinates_changed or relations_changed or \
+           (self._principals and touched_services):
+            self._nest_subordinates(services, copy_service)
+
+        self._status = {'Machines': machines,
+                        'Services': services,
+                        'Relations': list(self._relations.values()),
+                        'Networks': prev['Networks']}
+        self.synced.set()
+
+    def _related(self, service_name):
+        """ Names of the services related to service_name """
+        rv = set()
+        for rel in self._relations.values():
+            names = [ep['ServiceName'] for ep in rel.get('Endpoints', [])]
+            if service_name in names:
+                rv.update(n for n in names if n != service_name)
+        return rv
+
+    def _nest_subordinates(self, services, copy_service):
+        """ Lists each subordinate unit under the principal unit on its
+        machine, and sets 'SubordinateTo' on subordinate services, as
+        FullStatus does.
+        """
+        nested = {}
+        for name, info in self._subordinates.items():
+            related = self._related(info['Service'])
+            principal = next(
+                (unit_name
+                 for svc_name in sorted(related) if svc_name in services
+                 for unit_name, unit in
+                 sorted(services[svc_name]['Units'].items())
+                 if unit.get('Machine') == info.get('MachineId')), None)
+            if principal is None:
+                # the principal's delta hasn't arrived yet
+                continue
+            nested.setdefault(principal, {})[name] = _unit_status(info)
+
+        for principal in self._principals | set(nested):
+            svc_name = principal.split('/')[0]
+            units = services.get(svc_name, {}).get('Units') or {}
+            if principal not in units:
+                continue
+            unit = dict(copy_service(svc_name)['Units'][principal])
+            if principal in nested:
+                unit['Subordinates'] = nested[principal]
+            else:
+                unit.pop('Subordinates', None)
+            services[svc_name]['Units'][principal] = unit
+        self._principals = set(nested)
+
+        for svc_name in self._subordinate_services:
+            if svc_name in services:
+                svc = copy_service(svc_name)
+                svc['SubordinateTo'] = sorted(
+                    n for n in self._related(svc_name)
+                    if n not in self._subordinate_services)
+                svc['Units'] = {}
+
+    def _apply_machine(self, machines, info, removed):
+        parts = info['Id'].split('/')
+        if len(parts) == 1:
+            if removed:
+                machines.pop(info['Id'], None)
+                return
+            containers = machines.get(info['Id'], {}).get('Containers', {})
+            m = _machine_status(info)
+            m['Containers'] = containers
+            machines[info['Id']] = m
+            return
+
+        # containers live under their host machine, eg. 1/lxc/0
+        host_id = parts[0]
+        host = dict(machines.get(host_id, {'Id': host_id}))
+        containers = dict(host.get('Containers') or {})
+        if removed:
+            containers.pop(info['Id'], None)
+        else:
+            containers[info['Id']] = _machine_status(info)
+        host['Containers'] = containers
+        machines[host_id] = host
+
+
+class JujuStatusSnapshot:
+
+    """ One status response, wrapped and indexed for lookups
+
+    Machines, containers, services and units are wrapped once, when
+    the snapshot is built, and indexed by machine id, container id,
+    instance id, service name and unit name. The snapshot is never
+    changed afterwards; a new status gets a new snapshot.
+    """
+
+    def __init__(self, status):
+        self.status = status
+        machines = OrderedDict()
+        containers = {}
+        by_instance_id = {}
+        for machine_id, m in (status.get('Machines') or {}).items():
+            machine = Machine(machine_id, m)
+            machines[machine_id] = machine
+            if machine.instance_id:
+                by_instance_id[machine.instance_id] = machine
+            for container in machine.containers:
+                containers[container.machine_id] = container
+                if container.instance_id:
+                    by_instance_id[container.instance_id] = container
+
+        services = OrderedDict()
+        units = {}
+        for name, s in (status.get('Services') or {}).items():
+            service = Service(name, s)
+            services[name] = service
+            for unit in service.units:
+                units[unit.unit_name] = unit
+
+        self.machines_by_id = MappingProxyType(machines)
+        self.containers_by_id = MappingProxyType(containers)
+        self.machines_by_instance_id = MappingProxyType(by_instance_id)
+        self.services_by_name = MappingProxyType(services)
+        self.units_by_name = MappingProxyType(units)
+        # bootstrap node excluded, as JujuState.machines() always has
+        self.machines = tuple(m for machine_id, m in machines.items()
+                              if machine_id != '0')
+        self.services = tuple(services.values())
+
+    def machine(self, machine_id):
+        """ Machine (not container) machine_id, or None """
+        if machine_id == '0':
+            return None
+        return self.machines_by_id.get(machine_id)
+
+    def machine_or_container(self, machine_id):
+        return (self.machine(machine_id) or
+                self.containers_by_id.get(machine_id))
+
+    def machine_by_instance_id(self, instance_id):
+        return self.machines_by_instance_id.get(instance_id)
+
+    def service(self, name):
+        return self.services_by_name.get(name)
+
+    def unit(self, name):
+        return self.units_by_name.get(name)
+
+
+StatusChange = namedtuple('StatusChange', ['kind', 'name', 'old', 'new'])
+
+
+class JujuStatusChanges:
+
+    """ What changed between two JujuStatusSnapshots
+
+    Each change is a StatusChange(kind, name, old, new), where name is
+    a machine or container id, unit name or service name. For added
+    and removed entities, old and new are the Machine, Unit or Service
+    (or None); for transitions they are the before and after values.
+
+    Entities whose status dict is the same object in both snapshots,
+    as the AllWatcher mirror leaves untouched entities, are skipped
+    without comparing fields.
+    """
+
+    MACHINE_ADDED = 'machine-added'
+    MACHINE_REMOVED = 'machine-removed'
+    # (agent_state, agent_state_info)
+    MACHINE_AGENT_STATE = 'machine-agent-state'
+    # dns_name
+    MACHINE_ADDRESS = 'machine-address'
+    SERVICE_ADDED = 'service-added'
+    SERVICE_REMOVED = 'service-removed'
+    # {relation name: [services]}
+    RELATIONS = 'relations'
+    UNIT_ADDED = 'unit-added'
+    UNIT_REMOVED = 'unit-removed'
+    # (agent_state, agent_state_info)
+    UNIT_AGENT_STATE = 'unit-agent-state'
+    # (workload_state, workload_info, extended_agent_state)
+    UNIT_WORKLOAD = 'unit-workload'
+    # public_address
+    UNIT_ADDRESS = 'unit-address'
+
+    MACHINE_KINDS = (MACHINE_ADDED, MACHINE_REMOVED, MACHINE_AGENT_STATE,
+                     MACHINE_ADDRESS)
+    SERVICE_KINDS = (SERVICE_ADDED, SERVICE_REMOVED, RELATIONS)
+    UNIT_KINDS = (UNIT_ADDED, UNIT_REMOVED, UNIT_AGENT_STATE, UNIT_WORKLOAD,
+                  UNIT_ADDRESS)
+
+    def __init__(self, old, new, changes=None):
+        """ Compares snapshots old and new
+
+        :param list changes: use these instead of comparing
+        """
+        self.old = old
+        self.new = new
+        if changes is not None:
+            self.changes = changes
+            return
+        self.changes = []
+        if old is new:
+            return
+        self._diff_machines(old.machines_by_id, new.machines_by_id)
+        self._diff_machines(old.containers_by_id, new.containers_by_id)
+        self._diff_services()
+        self._diff_units()
+
+    def _compare(self, kind, name, old, new):
+        if old != new:
+            self.changes.append(StatusChange(kind, name, old, new))
+
+    def _diff_machines(self, old_machines, new_machines):
+        for machine_id, m in new_machines.items():
+            prev = old_machines.get(machine_id)
+            if prev is None:
+                self.changes.append(StatusChange(self.MACHINE_ADDED,
+                                                 machine_id, None, m))
+                continue
+            if prev.machine is m.machine:
+                continue
+            self._compare(self.MACHINE_AGENT_STATE, machine_id,
+                          (prev.agent_state, prev.agent_state_info),
+                          (m.agent_state, m.agent_state_info))
+            self._compare(self.MACHINE_ADDRESS, machine_id,
+                          prev.dns_name, m.dns_name)
+        for machine_id, prev in old_machines.items():
+            if machine_id not in new_machines:
+                self.changes.append(StatusChange(self.MACHINE_REMOVED,
+                                                 machine_id, prev, None))
+
+    def _diff_services(self):
+        old_services = self.old.services_by_name
+        new_services = self.new.services_by_name
+        for name, svc in new_services.items():
+            prev = old_services.get(name)
+            if prev is None:
+                self.changes.append(StatusChange(self.SERVICE_ADDED,
+                                                 name, None, svc))
+                continue
+            if prev.service is svc.service:
+                continue
+            self._compare(self.RELATIONS, name,
+                          prev.service.get('Relations') or {},
+                          svc.service.get('Relations') or {})
+        for name, prev in old_services.items():
+            if name not in new_services:
+                self.changes.append(StatusChange(self.SERVICE_REMOVED,
+                                                 name, prev, None))
+
+    def _diff_units(self):
+        old_units = self.old.units_by_name
+        new_units = self.new.units_by_name
+        for name, u in new_units.items():
+            prev = old_units.get(name)
+            if prev is None:
+                self.changes.append(StatusChange(self.UNIT_ADDED,
+                                                 name, None, u))
+                continue
+            if prev.unit is u.unit:
+                continue
+            self._compare(self.UNIT_AGENT_STATE, name,
+                          (prev.agent_state, prev.agent_state_info),
+                          (u.agent_state, u.agent_state_info))
+            self._compare(self.UNIT_WORKLOAD, name,
+                          (prev.workload_state, prev.workload_info,
+                           prev.extended_agent_state),
+                          (u.workload_state, u.workload_info,
+                           u.extended_agent_state))
+            self._compare(self.UNIT_ADDRESS, name,
+                          prev.public_address, u.public_address)
+        for name, prev in old_units.items():
+            if name not in new_units:
+                self.changes.append(StatusChange(self.UNIT_REMOVED,
+                                                 name, prev, None))
+
+    def only(self, kinds):
+        """ The changes of the given kinds, as a JujuStatusChanges """
+        return JujuStatusChanges(self.old, self.new,
+                                 [c for c in self.changes
+                                  if c.kind in kinds])
+
+    def of_kind(self, *kinds):
+        """ List of the changes of the given kinds """
+        return [c for c in self.changes if c.kind in kinds]
+
+    def affected_units(self):
+        """ Names of units that changed, or that are on a machine or
+        container that did
+        """
+        names = set()
+        machine_ids = set()
+        for c in self.changes:
+            if c.kind in self.UNIT_KINDS:
+                names.add(c.name)
+            elif c.kind in self.MACHINE_KINDS:
+                machine_ids.add(c.name)
+        if machine_ids:
+            names.update(name for name, u in self.new.units_by_name.items()
+                         if u.machine_id in machine_ids)
+        return names
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __repr__(self):
+        return "<JujuStatusChanges: {}>".format(
+            dict(Counter(c.kind for c in self.changes)))
+
+
 class JujuState:
 
     """ Represents a global Juju state """
 
-    def __init__(self, juju):
+    # most narrow (pattern) statuses kept, least recently fetched go
+    # first
+    STATUS_CACHE_SIZE = 32
+
+    def __init__(self, juju, use_watcher=False, polling=None):
         """ Builds a JujuState
 
         :param juju: Juju API connection
+        :param bool use_watcher: read status from an AllWatcher-driven
+                                 mirror instead of polling FullStatus
+        :param polling: PollingPolicy deciding how long a fetched
+                        status stays current
         """
         self.juju = juju
-        self.start_time = time.time()
-        self._juju_status = None
+        self.polling = polling or PollingPolicy()
+        self._status_lock = threading.Lock()
+        # patterns, or None for the full status -> (fetch start, status),
+        # in the order they were fetched
+        self._status_cache = OrderedDict()
+        # patterns, or None -> (fetch start, Future) for fetches under way
+        self._status_in_flight = {}
+        # statuses fetched before this don't count as current
+        self._not_before = 0
+        self.status_fetches = 0
+        self.status_fetches_saved = 0
+        # most recently used first
+        self._snapshots = []
+        # callback -> set of change kinds, or None for all of them
+        self._subscribers = OrderedDict()
+        # the snapshot last passed to publish_changes() subscribers
+        self.published = JujuStatusSnapshot({})
+        # time the status was last known good, if it isn't current
+        self.stale_since = None
         self.valid_states = ['pending', 'started', 'down']
+        self.watcher = None
+        if use_watcher:
+            self.watcher = JujuWatcher(juju)
+            self.watcher.start()
 
-    def get_agent_states(self):
-        """ Returns list of deployed services and their agent-state """
+    def get_agent_states(self, service_names=None):
+        """ Returns list of deployed services and their agent-state
+
+        :param list service_names: (optional) only these services, which
+                                   only fetches their part of the status
+        """
+        if service_names:
+            snapshot = self.snapshot(service_names)
+            svcs = [s for s in snapshot.services
+                    if s.service_name in service_names]
+        else:
+            svcs = self.services
         states = []
-        for svc in self.services:
+        for svc in svcs:
             for unit in svc.units:
                 states.append((svc.service_name, unit.agent_state))
         return states
@@ -63,34 +671,201 @@ class JujuState:
 
     def status(self):
         """Returns juju status.
-        Caches value for 20 seconds.
+        Caches value for self.polling.interval seconds, which shrinks
+        while status keeps changing and grows while it doesn't.
 
-        Call invalidate_status_cache() to force next status call to
+        Call invalidate_status_cache() to make the next status call
         fetch from server.
 
+        Only one fetch is made at a time: callers that find one already
+        under way wait for its result rather than sending their own.
+
         If request times out (macumba default is 60 seconds), retries
         5 times.
 
+        When the AllWatcher mirror is running, its status is returned
+        instead and no request is made.
+
+        """
+        if self.watcher and self.watcher.current:
+            return self.watcher.status()
+        return self._shared_status(None)
+
+    def _fresh_status(self, key, now):
+        entry = self._status_cache.get(key)
+        if entry is None:
+            return None
+        fetched_at, status = entry
+        if fetched_at < self._not_before or \
+           now - fetched_at > self.polling.interval:
+            return None
+        return status
+
+    def _shared_status(self, key):
+        """ Returns the cached status for key, fetching it if needed.
+
+        A fetch already under way is waited on instead of starting
+        another, provided it was sent after the last invalidation; a
+        full status fetch also serves narrow keys.
         """
-        elapsed_time = time.time() - self.start_time
+        while True:
+            with self._status_lock:
+                now = time.time()
+                status = self._fresh_status(key, now)
+                if status is None and key is not None:
+                    status = self._fresh_status(None, now)
+                if status is not None:
+                    return status
+                flight = self._status_in_flight.get(key)
+                if flight is None and key is not None:
+                    flight = self._status_in_flight.get(None)
+                if flight is None:
+                    started = now
+                    future = futures.Future()
+                    self._status_in_flight[key] = (started, future)
+                    self.status_fetches += 1
+                    break
+                started, future = flight
+                usable = started >= self._not_before
+                if usable:
+                    self.status_fetches_saved += 1
+            if usable:
+                return future.result()
+            # sent before the last invalidation, so wait for it to
+            # finish and go again
+            try:
+                future.result()
+            except Exception:
+                pass
+
+        try:
+            status = self._fetch_status(None if key is None else list(key))
+        except Exception as e:
+            with self._status_lock:
+                self._status_in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        if key is None:
+            self.polling.observe(status)
+        with self._status_lock:
+            self._store_status(key, started, status)
+            self._status_in_flight.pop(key, None)
+        future.set_result(status)
+        return status
+
+    def _store_status(self, key, started, status):
+        cache = self._status_cache
+        if key is None:
+            # a full status answers every narrow query while it's fresh,
+            # so narrow ones fetched before it aren't needed
+            for k in [k for k, (t, _) in cache.items()
+                      if k is not None and t <= started]:
+                del cache[k]
+        cache.pop(key, None)
+        cache[key] = (started, status)
+        narrow = [k for k in cache if k is not None]
+        for k in narrow[:max(0, len(narrow) - self.STATUS_CACHE_SIZE)]:
+            del cache[k]
+
+    def _fetch_status(self, patterns=None):
         n_retries = 0
-        if not self._juju_status or elapsed_time > 20:
-            self._juju_status = None
-            while self._juju_status is None:
-                try:
-                    self._juju_status = self.juju.status()
-                except RequestTimeout:
-                    n_retries += 1
-                    if n_retries == 5:
-                        raise Exception("Connection failure with juju API")
-            self.start_time = time.time()
-        return self._juju_status
-
-    def invalidate_status_cache(self):
+        while True:
+            try:
+                return self.juju.status(patterns=patterns)
+            except RequestTimeout:
+                n_retries += 1
+                if n_retries == 5:
+                    raise Exception("Connection failure with juju API")
+
+    def status_matching(self, patterns):
+        """Returns a status that covers at least the services, units
+        and machines matching patterns.
+
+        This is the cached full status, or the AllWatcher mirror, if
+        either is current. Otherwise only the matching part is fetched,
+        using FullStatus's pattern filter, and cached for as long as
+        status() is. Use it when only a few entities are of interest.
+
+        :param list patterns: service names, unit names, machine ids or
+                              globs of them
+        """
+        if self.watcher and self.watcher.current:
+            return self.watcher.status()
+        return self._shared_status(tuple(sorted(patterns)))
+
+    def snapshot(self, patterns=None):
+        """ Returns the JujuStatusSnapshot of the current status
+
+        Snapshots are built once per fetched status, so repeated
+        lookups between fetches don't rewrap anything.
+
+        :param list patterns: (optional) only needs to cover these,
+                              see status_matching()
+        """
+        if patterns:
+            status = self.status_matching(patterns)
+        else:
+            status = self.status()
+        snapshots = self._snapshots
+        for snapshot in snapshots:
+            if snapshot.status is status:
+                return snapshot
+        snapshot = JujuStatusSnapshot(status)
+        # a few, to cover the full status and recent narrow queries
+        self._snapshots = [snapshot] + snapshots[:3]
+        return snapshot
+
+    def subscribe(self, callback, kinds=None):
+        """ Calls callback(changes) from publish_changes() whenever
+        the status has changed in one of the ways in kinds.
+
+        :param callback: called with a JujuStatusChanges holding only
+                         the changes of the subscribed kinds
+        :param list kinds: JujuStatusChanges kinds, default all of them
+        """
+        self._subscribers[callback] = None if kinds is None \
+            else frozenset(kinds)
+
+    def unsubscribe(self, callback):
+        self._subscribers.pop(callback, None)
+
+    def publish_changes(self):
+        """ Compares the current status with the one from the last call,
+        and passes the changes on to subscribers.
+
+        The first call reports everything as added. Not thread safe;
+        call it from one place, eg. the UI refresh loop.
+
+        :returns: all the changes
+        :rtype: JujuStatusChanges
+        """
+        snapshot = self.snapshot()
+        changes = JujuStatusChanges(self.published, snapshot)
+        self.published = snapshot
+        if not changes:
+            return changes
+        for callback, kinds in list(self._subscribers.items()):
+            selected = changes if kinds is None else changes.only(kinds)
+            if selected:
+                callback(selected)
+        return changes
+
+    def invalidate_status_cache(self, since=None):
         """Invalidates cache of status.  Use this to force fetching from
-        server more often than every 20 seconds.
+        server sooner than the polling policy would.
+
+        Nothing is fetched here; the next read must return a status
+        fetched after 'since' (default: now), and concurrent readers
+        share that fetch.
+
+        Has no effect on reads served by the AllWatcher mirror, which
+        is always current.
         """
-        self._juju_status = None
+        with self._status_lock:
+            self._not_before = max(self._not_before, since or time.time())
+            self._status_cache = OrderedDict(
+                (k, v) for k, v in self._status_cache.items()
+                if v[0] >= self._not_before)
 
     def machines_summary(self):
         """ Returns summary of known machines and their status
@@ -122,10 +897,10 @@ class JujuState:
         :returns: machine
         :rtype: :class:`~cloudinstall.machine.Machine`
         """
-        for m in self.machines():
-            if m.machine_id == machine_id:
-                return m
-        return Machine('-', {})
+        machine = self.snapshot([machine_id]).machine(machine_id)
+        if machine is None:
+            return Machine('-', {})
+        return machine
 
     def machines(self):
         """ Machines property
@@ -133,27 +908,17 @@ class JujuState:
         :returns: machines known to juju (except bootstrap)
         :rtype: list
         """
-        ret = self.status()
-        machines = []
-
-        for machine_id, machine in ret.get('Machines', {}).items():
-            if '0' == machine_id:
-                continue
-            machines.append(Machine(machine_id, machine))
-        return machines
+        return list(self.snapshot().machines)
 
     def machine_or_container(self, machine_id):
         """ returns machine or container matching the id
         """
-        for machine in self.machines():
-            if '0' == machine_id:
-                continue
-            if machine.machine_id == machine_id:
-                return machine
-            for container in machine.containers:
-                if container.machine_id == machine_id:
-                    return container
-        return None
+        return self.snapshot().machine_or_container(machine_id)
+
+    def machine_by_instance_id(self, instance_id):
+        """ returns machine or container with this instance id, or None
+        """
+        return self.snapshot().machine_by_instance_id(instance_id)
 
     def base_machine(self, machine_id):
         """ returns machine if given a numeric machine id,
@@ -182,10 +947,22 @@ class JujuState:
         :returns: a service entry or None
         :rtype: :class:`~cloudinstall.service.Service`
         """
-        for s in self.services:
-            if s.service_name == name:
-                return s
-        return Service(name, {})
+        service = self.snapshot([name]).service(name)
+        if service is None:
+            return Service(name, {})
+        return service
+
+    def has_service(self, name):
+        """ Whether service 'name' is deployed """
+        return self.snapshot([name]).service(name) is not None
+
+    def unit(self, name):
+        """ Return a single unit entry, or None
+
+        :param str name: unit name, eg. 'keystone/0'
+        :rtype: :class:`~cloudinstall.service.Unit`
+        """
+        return self.snapshot([name]).unit(name)
 
     @property
     def services(self):
@@ -194,13 +971,7 @@ class JujuState:
         :returns: Service() of all loaded services
         :rtype: list
         """
-        ret = self.status()
-        services = []
-
-        for name, service in ret.get('Services', {}).items():
-            services.append(Service(name, service))
-
-        return services
+        return list(self.snapshot().services)
 
     @property
     def networks(self):
@@ -16,8 +16,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from cloudinstall.constraints import compile_constraints
 from cloudinstall.machine import Machine
-from cloudinstall.utils import human_to_mb
+from cloudinstall.maas.details import NodeDetailsCache
+from cloudinstall.polling import PollingPolicy
 from maasclient.auth import MaasAuth
 from maasclient import MaasClient
 from collections import Counter
@@ -25,6 +27,7 @@ from enum import Enum
 import json
 import logging
 import os
+import requests
 import time
 
 
@@ -44,41 +47,22 @@ def satisfies(machine, constraints):
 
     If successful the return will be (True, [])
 
+    To check many machines, use cloudinstall.constraints.MachineTable.
+
     :rtype: tuple
     :returns: (bool, [list-of-failed constraint keys])
 
     """
-    kmap = dict(mem='memory',
-                arch='architecture',
-                storage='storage',
-                cpu_cores='cpu_count')
-    kmap['root-disk'] = 'storage'
-
-    cons_checks = []
-
-    if constraints is None:
-        return (True, [])
-
-    for k, v in constraints.items():
-        if k == 'arch':
-            mval = machine.machine[kmap[k]]
-            if mval != '*' and mval != v:
-                cons_checks.append(k)
-        else:
-            mval = machine.machine[kmap[k]]
-
-            if mval == '*':
-                # '*' always satisfies.
-                continue
+    cons_checks = compile_constraints(constraints).failures(machine)
+    return (len(cons_checks) == 0), cons_checks
 
-            if not str(v).isdecimal():
-                v = human_to_mb(v)
 
-            if mval < v:
-                cons_checks.append(k)
-
-    rval = (len(cons_checks) == 0), cons_checks
-    return rval
+def _number(n):
+    """ int(n), or None if n isn't a number """
+    try:
+        return int(n)
+    except (TypeError, ValueError):
+        return None
 
 
 class MaasMachineStatus(Enum):
@@ -115,8 +99,33 @@ class MaasMachineStatus(Enum):
         return self.name.lower()
 
 
+# MaasMachineStatus(n) is slow, and done for every node
+_STATUSES = {s.value: s for s in MaasMachineStatus}
+
+
 class MaasMachine(Machine):
-    """ Single maas machine """
+    """ Single maas machine
+
+    cpu_count, mem_mb and storage_mb are parsed from the MAAS node
+    when the machine is built, and are None where MAAS has no number
+    (eg. '*' in placeholder data).
+    """
+
+    __slots__ = ('_status',)
+
+    def __init__(self, machine_id, machine):
+        super().__init__(machine_id, machine)
+        self._arch = self.machine.get('architecture')
+        status = self.machine.get('status', MaasMachineStatus.UNKNOWN.value)
+        self._status = _STATUSES.get(status)
+        if self._status is None:
+            # eg. states added by a newer MAAS
+            log.debug("Unrecognised MAAS status {!r} for {}".format(
+                status, self.machine.get('system_id')))
+            self._status = MaasMachineStatus.UNKNOWN
+        self.cpu_count = _number(self.machine.get('cpu_count'))
+        self.mem_mb = _number(self.machine.get('memory'))
+        self.storage_mb = _number(self.machine.get('storage'))
 
     @property
     def hostname(self):
@@ -134,8 +143,7 @@ class MaasMachine(Machine):
         :returns: status enum
         :rtype: MaasMachineStatus
         """
-        return MaasMachineStatus(self.machine.get('status',
-                                                  MaasMachineStatus.UNKNOWN))
+        return self._status
 
     @property
     def zone(self):
@@ -162,20 +170,9 @@ class MaasMachine(Machine):
         :returns: storage size
         :rtype: str
         """
-        try:
-            _storage_in_gb = int(self.machine.get('storage')) / 1024
-        except ValueError:
+        if self.storage_mb is None:
             return "N/A"
-        return "{size:.2f}G".format(size=_storage_in_gb)
-
-    @property
-    def arch(self):
-        """ Return architecture
-
-        :returns: architecture type
-        :rtype: str
-        """
-        return self.machine.get('architecture')
+        return "{size:.2f}G".format(size=self.storage_mb / 1024)
 
     @property
     def mem(self):
@@ -184,10 +181,9 @@ class MaasMachine(Machine):
         :returns: memory size
         :rtype: str
         """
-        try:
-            _mem = int(self.machine.get('memory'))
-        except ValueError:
+        if self.mem_mb is None:
             return "N/A"
+        _mem = self.mem_mb
         if _mem > 1024:
             _mem = _mem / 1024
             return "{size}G".format(size=str(_mem))
@@ -288,47 +284,180 @@ class MaasMachine(Machine):
                 "storage:{storage} cores:{cpus}").format(**d)
 
 
+def _constraints_key(constraints):
+    """ The parts of a juju constraints string that MaasState filters
+    nodes by, as a hashable (arch, frozenset of tags)
+    """
+    if not constraints:
+        return (None, frozenset())
+    cd = dict(c.partition('=')[::2] for c in constraints.split())
+    tags = frozenset(t for t in cd.get('tags', '').split(',') if t)
+    return (cd.get('arch') or None, tags)
+
+
+def _satisfies_key(node, key):
+    """ Whether node has the arch and tags of a _constraints_key() """
+    arch, tags = key
+    if arch and node['architecture'].split('/')[0] != arch:
+        return False
+    return not tags or tags.issubset(node['tag_names'])
+
+
+class MaasNodeCache:
+
+    """ One fetch of MAAS nodes, indexed by instance_id (resource_uri),
+    system_id and status.
+
+    Nodes satisfying each set of constraints, and the MaasMachines
+    wrapping them, are worked out the first time they're asked for and
+    kept until the next fetch.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.by_instance_id = {}
+        self.by_system_id = {}
+        self.by_status = {}
+        for n in nodes:
+            self.by_instance_id[n.get('resource_uri', '')] = n
+            self.by_system_id[n.get('system_id', '')] = n
+            self.by_status.setdefault(n.get('status'), []).append(n)
+        # constraints key -> nodes
+        self._matching = {}
+        # node dict id -> MaasMachine
+        self._wrapped = {}
+        # (constraints key, status) -> MaasMachines, without bootstrap
+        self._machines = {}
+        self._summary = None
+
+    def matching(self, key):
+        """ Nodes satisfying a _constraints_key() """
+        nodes = self._matching.get(key)
+        if nodes is None:
+            nodes = self.nodes
+            if key != _constraints_key(None):
+                nodes = [n for n in nodes if _satisfies_key(n, key)]
+            self._matching[key] = nodes
+        return nodes
+
+    def machine(self, node):
+        """ The MaasMachine for node, or None for the bootstrap node """
+        if node is None or node['hostname'] == 'juju-bootstrap.maas':
+            return None
+        m = self._wrapped.get(id(node))
+        if m is None:
+            m = self._wrapped[id(node)] = MaasMachine(-1, node)
+        return m
+
+    def machines(self, key, status=None):
+        """ MaasMachines for nodes satisfying a _constraints_key(), and
+        with status value status if given.
+
+        The list is shared, callers must copy it before changing it.
+        """
+        machines = self._machines.get((key, status))
+        if machines is None:
+            if status is None:
+                nodes = self.matching(key)
+            elif key == _constraints_key(None):
+                nodes = self.by_status.get(status, [])
+            else:
+                nodes = [n for n in self.matching(key)
+                         if n.get('status') == status]
+            machines = [m for m in map(self.machine, nodes) if m]
+            self._machines[(key, status)] = machines
+        return machines
+
+    def summary(self):
+        """ Counter of MaasMachineStatus over all nodes """
+        if self._summary is None:
+            summary = Counter()
+            for status, nodes in self.by_status.items():
+                summary[_STATUSES.get(status,
+                                      MaasMachineStatus.UNKNOWN)] += len(nodes)
+            self._summary = summary
+        return self._summary
+
+
 class MaasState:
     """ Represents global MaaS state """
 
-    def __init__(self, maas_client):
+    # seconds a fetch of the nodes is used for
+    NODES_TTL = 20
+
+    def __init__(self, maas_client, node_filter=None, details_cache=None):
+        """
+        :param maas_client: MaasClient
+        :param dict node_filter: only fetch nodes matching these
+                                 MaasClient.iter_node_pages filters,
+                                 eg. {'zone': 'openstack'}
+        :param details_cache: NodeDetailsCache for hardware_facts(), or
+                              None
+        """
         self.maas_client = maas_client
+        self.node_filter = node_filter
+        self.details_cache = details_cache
         self._maas_client_nodes = None
+        self._node_cache = None
         self.start_time = time.time()
 
-    def nodes(self, constraints=None):
-        """ Cache MAAS nodes
+    def _fetch_nodes(self):
+        if self.node_filter:
+            try:
+                return self.maas_client.nodes_matching(**self.node_filter)
+            except requests.HTTPError as e:
+                log.warning("Couldn't list MAAS nodes: {}".format(e))
+                return []
+        return self.maas_client.nodes
+
+    def node_cache(self):
+        """ MaasNodeCache for the nodes, fetching them again if they
+        are older than NODES_TTL or have been invalidated
         """
         elapsed_time = time.time() - self.start_time
-        if not self._maas_client_nodes or elapsed_time > 20:
-            self._maas_client_nodes = self.maas_client.nodes
-            self._filtered_nodes = self._maas_client_nodes
-            if constraints:
-                cd = dict(x.split('=') for x in constraints.split(' '))
-                arch = cd.get('arch', None)
-                tagstr = cd.get('tags', None)
-                satisfying_nodes = []
-                for n in self._maas_client_nodes:
-                    if arch:
-                        n_arch = n['architecture'].split('/')[0]
-                        if n_arch != arch:
-                            continue
-                    if tagstr:
-                        c_tags = set(cd['tags'].split(','))
-                        n_tags = set(n['tag_names'])
-                        if not c_tags.issubset(n_tags):
-                            continue
-                    satisfying_nodes.append(n)
-
-                self._filtered_nodes = satisfying_nodes
-
+        if self._node_cache is None or not self._maas_client_nodes or \
+           elapsed_time > self.NODES_TTL:
+            self._maas_client_nodes = self._fetch_nodes()
+            self._node_cache = MaasNodeCache(self._maas_client_nodes)
             self.start_time = time.time()
-        return self._filtered_nodes
+        return self._node_cache
+
+    def nodes(self, constraints=None):
+        """ Cache MAAS nodes
+
+        :param str constraints: a juju style constraints string that
+        we parse for arch and tags
+        """
+        return self.node_cache().matching(_constraints_key(constraints))
 
     def invalidate_nodes_cache(self):
         """Force reload on next access"""
         self._maas_client_nodes = None
 
+    def known_nodes(self):
+        """ Nodes from the last fetch, without fetching """
+        return self._maas_client_nodes or []
+
+    def prefetch_node_details(self):
+        """ Caches the commissioning details of every node that doesn't
+        have them cached yet. Fetches megabytes per node, so call it
+        from a worker thread.
+
+        :returns: system_id -> hardware facts
+        :rtype: dict
+        """
+        if self.details_cache is None:
+            return {}
+        return self.details_cache.prefetch(self.node_cache().nodes)
+
+    def hardware_facts(self, machine):
+        """ hardware_facts() from machine's cached commissioning
+        details, or None if they aren't cached. Never fetches.
+        """
+        if self.details_cache is None:
+            return None
+        return self.details_cache.cached_facts(machine.machine)
+
     def machine(self, instance_id):
         """ Return single machine state
 
@@ -336,10 +465,18 @@ class MaasState:
         :returns: machine
         :rtype: cloudinstall.maas.MaasMachine
         """
-        for m in self.machines():
-            if m.instance_id == instance_id:
-                return m
-        return None
+        cache = self.node_cache()
+        return cache.machine(cache.by_instance_id.get(instance_id))
+
+    def machine_by_system_id(self, system_id):
+        """ Return single machine state
+
+        :param str system_id: maas system id
+        :returns: machine
+        :rtype: cloudinstall.maas.MaasMachine
+        """
+        cache = self.node_cache()
+        return cache.machine(cache.by_system_id.get(system_id))
 
     def machines(self, state=None, constraints=None):
         """Maas Machines
@@ -355,24 +492,136 @@ class MaasState:
         :rtype: list of MaasMachine
 
         """
-        nodes = [n for n in self.nodes(constraints)
-                 if n['hostname'] != 'juju-bootstrap.maas']
-
-        all_machines = [MaasMachine(-1, m) for m in nodes]
-        if state:
-            return [m for m in all_machines if m.status == state]
-        else:
-            return all_machines
+        status = state.value if state else None
+        return list(self.node_cache().machines(
+            _constraints_key(constraints), status))
 
     def machines_summary(self):
         """ Returns summary of known machines and their states.
         """
-        log.debug("in summary, self.nodes is {}".format(self.nodes()))
-        return Counter([MaasMachineStatus(m['status'])
-                        for m in self.nodes()])
+        return Counter(self.node_cache().summary())
+
+
+class MaasNodesMissingError(Exception):
+
+    """ Nodes being waited for are no longer known to MAAS """
+
+    def __init__(self, system_ids):
+        self.system_ids = sorted(system_ids)
+        super().__init__("MAAS nodes went missing: {}".format(
+            ", ".join(self.system_ids)))
+
+
+class MaasReadinessWatcher:
+
+    """ Waits for particular MAAS nodes to be READY or ALLOCATED.
+
+    Each poll fetches only the nodes still pending, by system id, so it
+    costs requests and data in proportion to what's left to wait for
+    rather than the whole inventory. Polls back off per the
+    PollingPolicy while nothing changes.
+
+    A node that a successful poll doesn't return has been deleted, or
+    has left the node filter, so it stops being waited for and is
+    added to missing instead.
+
+    :param maas_client: MaasClient
+    :param system_ids: nodes to wait for
+    :param on_ready: called once every node is ready
+    :param on_progress: called with the watcher after each poll
+    :param polling: PollingPolicy, by default 3 to 30 seconds
+    :param str constraints: juju style constraints string; a node
+                            only counts as ready if it has their arch
+                            and tags
+    """
+
+    READY_STATUSES = frozenset([MaasMachineStatus.READY.value,
+                                MaasMachineStatus.ALLOCATED.value])
+
+    def __init__(self, maas_client, system_ids, on_ready=None,
+                 on_progress=None, polling=None, constraints=None):
+        self.maas_client = maas_client
+        # system_id -> last status seen, or None
+        self.statuses = dict.fromkeys(system_ids)
+        self.pending = set(self.statuses)
+        self.missing = set()
+        self.constraints_key = _constraints_key(constraints)
+        self.on_ready = on_ready
+        self.on_progress = on_progress
+        self.polling = polling or PollingPolicy(3, 30)
+        self._fired = False
+
+    def ready(self, node):
+        """ Whether node is READY or ALLOCATED and meets the constraints
+        """
+        return node['status'] in self.READY_STATUSES and \
+            _satisfies_key(node, self.constraints_key)
 
+    def poll(self):
+        """ Fetches the pending nodes once, and calls on_ready if that
+        leaves none pending and none missing.
 
-def connect_to_maas(creds=None):
+        :returns: True if no nodes are left pending
+        """
+        if self.pending:
+            seen = {}
+            try:
+                for page in self.maas_client.iter_node_pages(
+                        system_ids=self.pending):
+                    for node in page:
+                        seen[node['system_id']] = node
+            except requests.HTTPError as e:
+                # try them all again next poll
+                log.warning("Couldn't fetch pending MAAS nodes: "
+                            "{}".format(e))
+            else:
+                gone = self.pending.difference(seen)
+                if gone:
+                    log.warning("MAAS nodes went missing: {}".format(
+                        ", ".join(sorted(gone))))
+                    self.missing.update(gone)
+                    self.pending.difference_update(gone)
+                self.statuses.update((system_id, node['status'])
+                                     for system_id, node in seen.items())
+                self.pending.difference_update(
+                    system_id for system_id, node in seen.items()
+                    if self.ready(node))
+            self.polling.observe(dict(self.statuses))
+        if self.on_progress:
+            self.on_progress(self)
+        if not self.pending and not self.missing and not self._fired:
+            self._fired = True
+            if self.on_ready:
+                self.on_ready()
+        return not self.pending
+
+    def wait(self, sleep=time.sleep):
+        """ Polls until every node is ready
+
+        :param sleep: called with the seconds to wait between polls
+        :raises MaasNodesMissingError: if any nodes went missing
+        """
+        while not self.poll():
+            sleep(self.polling.interval)
+        if self.missing:
+            raise MaasNodesMissingError(self.missing)
+
+    def summary(self):
+        """ Counter of MaasMachineStatus over the watched nodes """
+        return Counter(_STATUSES.get(status, MaasMachineStatus.UNKNOWN)
+                       for status in self.statuses.values())
+
+
+def connect_to_maas(creds=None, config=None):
+    """ Returns a MaasClient and a MaasState over it
+
+    :param dict creds: api_host and api_key, or None to use the local
+                       MAAS' root credentials
+    :param config: Config for the maas_pool_size, maas_retries,
+                   maas_timeout, maas_max_rate and maas_node_filter
+                   options and node_details_cache_dir, or None for the
+                   defaults and no details cache
+    """
     if creds:
         api_host = creds['api_host']
         api_url = 'http://{}/MAAS/api/1.0'.format(api_host)
@@ -382,8 +631,21 @@ def connect_to_maas(creds=None):
     else:
         auth = MaasAuth()
         auth.get_api_key('root')
-    maas = MaasClient(auth)
-    maas_state = MaasState(maas)
+    client_options = {}
+    node_filter = None
+    cache_dir = None
+    if config is not None:
+        client_options = dict(pool_size=config.getopt('maas_pool_size'),
+                              retries=config.getopt('maas_retries'),
+                              timeout=config.getopt('maas_timeout'),
+                              max_rate=config.getopt('maas_max_rate'))
+        node_filter = config.getopt('maas_node_filter')
+        cache_dir = config.node_details_cache_dir
+    maas = MaasClient(auth, **client_options)
+    details_cache = None
+    if cache_dir:
+        details_cache = NodeDetailsCache(cache_dir, maas)
+    maas_state = MaasState(maas, node_filter, details_cache)
     return maas, maas_state
 
 
@@ -404,5 +666,11 @@ class FakeMaasState:
     def invalidate_nodes_cache(self):
         "no op"
 
+    def known_nodes(self):
+        return []
+
+    def hardware_facts(self, machine):
+        return None
+
     def machines_summary(self):
         return "no summary for fake state"
@@ -0,0 +1,301 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Cached MAAS commissioning details, and the hardware facts in them
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import xml.etree.ElementTree as ET
+
+log = logging.getLogger('cloudinstall.maas.details')
+
+# bump when the saved layout or the facts change; other versions are
+# ignored
+NODE_DETAILS_VERSION = 1
+
+
+def commissioning_stamp(node):
+    """ A key that changes when node is recommissioned onto different
+    hardware.
+
+    MAAS 1.x nodes don't say when they were commissioned, so this is a
+    digest of the fields commissioning fills in: architecture, cpu
+    count, memory, storage and MAC addresses. Recommissioning unchanged
+    hardware keeps the stamp, and the cached details stay valid.
+    """
+    macs = sorted(m.get('mac_address', '')
+                  for m in node.get('macaddress_set') or [])
+    fields = [node.get('architecture'), node.get('cpu_count'),
+              node.get('memory'), node.get('storage'), macs]
+    return hashlib.sha1(json.dumps(fields).encode('utf-8')).hexdigest()[:16]
+
+
+def _text(e, tag):
+    return (e.findtext(tag) or '').strip()
+
+
+def _int(e, tag):
+    try:
+        return int(e.findtext(tag))
+    except (TypeError, ValueError):
+        return None
+
+
+def hardware_facts(details):
+    """ Hardware used for placement, from commissioning details
+
+    lshw doesn't report NUMA topology, so numa_nodes counts populated
+    CPU sockets, which is one NUMA node each on the servers MAAS
+    commissions.
+
+    :param dict details: as from MaasClient.node_details
+    :returns: disks and nics, lists of dicts; numa_nodes; cpu_model;
+              and cpu_flags, a sorted list
+    :rtype: dict
+    """
+    facts = {'disks': [], 'nics': [], 'numa_nodes': 0, 'cpu_model': '',
+             'cpu_flags': []}
+    lshw = (details or {}).get('lshw')
+    if not lshw:
+        return facts
+    try:
+        root = ET.fromstring(lshw)
+    except ET.ParseError as e:
+        log.warning("Can't parse lshw output: {}".format(e))
+        return facts
+
+    flags = set()
+    for node in root.iter('node'):
+        cls = node.get('class')
+        if cls == 'processor':
+            if node.get('disabled') == 'true':
+                continue
+            facts['numa_nodes'] += 1
+            if not facts['cpu_model']:
+                facts['cpu_model'] = _text(node, 'product')
+            flags.update(c.get('id') for c in node.iterfind(
+                'capabilities/capability'))
+        elif cls == 'disk':
+            size = _int(node, 'size')
+            if size is None:
+                # empty cdrom and card readers
+                continue
+            facts['disks'].append({'name': _text(node, 'logicalname'),
+                                   'size_mb': size // (1024 * 1024),
+                                   'model': _text(node, 'product'),
+                                   'serial': _text(node, 'serial')})
+        elif cls == 'network':
+            speed = _int(node, 'capacity') or _int(node, 'size')
+            facts['nics'].append({'name': _text(node, 'logicalname'),
+                                  'mac': _text(node, 'serial'),
+                                  'speed_mbps': speed // 1000000
+                                  if speed else None,
+                                  'vendor': _text(node, 'vendor'),
+                                  'product': _text(node, 'product')})
+    facts['cpu_flags'] = sorted(flags)
+    return facts
+
+
+def _as_text(details):
+    """ details with its bytes values decoded; lshw and lldp are XML,
+    so they survive the round trip through text
+    """
+    return {k: v.decode('utf-8', 'replace') if isinstance(v, bytes) else v
+            for k, v in details.items()}
+
+
+class NodeDetailsCache:
+
+    """ Commissioning details of MAAS nodes, kept on disk
+
+    Each node's decoded details go in their own gzipped JSON file in
+    directory, and the hardware facts of every node in one index, so
+    facts are read without opening the details. Entries are keyed by
+    system_id and commissioning_stamp(), and fetched again once the
+    stamp changes; an entry whose refetch fails is dropped rather than
+    kept for hardware that may be gone.
+
+    Details are returned with their bytes values (lshw, lldp) decoded
+    to str, whether they were fetched or read from the cache.
+
+    :param str directory: where to keep the cache, created if needed
+    :param maas_client: MaasClient to fetch missing details with
+    """
+
+    def __init__(self, directory, maas_client):
+        self.directory = directory
+        self.maas_client = maas_client
+        self._lock = threading.Lock()
+        self._index = None
+
+    @property
+    def index_filename(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def _details_filename(self, system_id):
+        return os.path.join(self.directory, system_id + '.json.gz')
+
+    def _write(self, filename, data, opener=open):
+        os.makedirs(self.directory, exist_ok=True)
+        tmpfile = filename + '.tmp'
+        with opener(tmpfile, 'wt') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmpfile, filename)
+
+    def _read(self, filename, opener=open):
+        try:
+            with opener(filename, 'rt') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError) as e:
+            log.warning("Ignoring unreadable node details {}: "
+                        "{}".format(filename, e))
+            return None
+        if not isinstance(data, dict) or \
+           data.get('version') != NODE_DETAILS_VERSION:
+            return None
+        return data
+
+    def index(self):
+        """ system_id -> {'stamp':, 'facts':} for every cached node """
+        if self._index is None:
+            data = self._read(self.index_filename)
+            self._index = data['nodes'] if data else {}
+        return self._index
+
+    def _save_index(self):
+        self._write(self.index_filename,
+                    {'version': NODE_DETAILS_VERSION,
+                     'nodes': self.index()})
+
+    def cached(self, node):
+        """ True if node's current details are in the cache """
+        entry = self.index().get(node['system_id'])
+        return entry is not None and \
+            entry['stamp'] == commissioning_stamp(node)
+
+    def cached_facts(self, node):
+        """ hardware_facts() for node if they're cached, without
+        fetching anything
+
+        :rtype: dict, or None
+        """
+        entry = self.index().get(node['system_id'])
+        if entry is None or entry['stamp'] != commissioning_stamp(node):
+            return None
+        return entry['facts']
+
+    def store(self, node, details, save_index=True):
+        """ Saves details fetched for node
+
+        :returns: the hardware facts in details
+        """
+        system_id = node['system_id']
+        stamp = commissioning_stamp(node)
+        facts = hardware_facts(details)
+        self._write(self._details_filename(system_id),
+                    {'version': NODE_DETAILS_VERSION, 'stamp': stamp,
+                     'details': _as_text(details)},
+                    gzip.open)
+        with self._lock:
+            self.index()[system_id] = {'stamp': stamp, 'facts': facts}
+            if save_index:
+                self._save_index()
+        return facts
+
+    def forget(self, system_id, save_index=True):
+        """ Drops anything cached for system_id """
+        try:
+            os.remove(self._details_filename(system_id))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if self.index().pop(system_id, None) is not None and \
+               save_index:
+                self._save_index()
+
+    def details(self, node):
+        """ Decoded commissioning details for node, fetched if they
+        aren't cached
+
+        :rtype: dict, or None if MAAS has none
+        """
+        system_id = node['system_id']
+        if self.cached(node):
+            data = self._read(self._details_filename(system_id), gzip.open)
+            if data and data['stamp'] == commissioning_stamp(node):
+                return data['details']
+        details = self.maas_client.node_details(system_id)
+        if details is None:
+            self.forget(system_id)
+            return None
+        self.store(node, details)
+        return _as_text(details)
+
+    def facts(self, node):
+        """ hardware_facts() for node, from the index if they're cached
+
+        :rtype: dict, or None if MAAS has no details
+        """
+        if self.cached(node):
+            return self.index()[node['system_id']]['facts']
+        details = self.details(node)
+        if details is None:
+            return None
+        return self.index()[node['system_id']]['facts']
+
+    def prefetch(self, nodes):
+        """ Fetches the details of every node that isn't cached, in
+        parallel, and saves the index once. Each node's details are
+        stored as they arrive, so only those in flight are held.
+
+        :returns: system_id -> hardware facts for every node whose
+                  current details are now cached
+        :rtype: dict
+        """
+        nodes = list(nodes)
+        missing = {n['system_id']: n for n in nodes if not self.cached(n)}
+        if missing:
+            def fetched(result):
+                system_id = result.system_id
+                details = None
+                if result.ok:
+                    details = self.maas_client.decode_node_details(
+                        result.response.content)
+                else:
+                    log.warning("Couldn't fetch details of {}: "
+                                "{}".format(system_id, result.error))
+                if details is None:
+                    # any entry is for an earlier commissioning
+                    self.forget(system_id, save_index=False)
+                else:
+                    self.store(missing[system_id], details,
+                               save_index=False)
+            self.maas_client.node_details_many(list(missing), fetched)
+            with self._lock:
+                self._save_index()
+        facts = {}
+        for n in nodes:
+            f = self.cached_facts(n)
+            if f is not None:
+                facts[n['system_id']] = f
+        return facts
@@ -17,21 +17,81 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import sys
+
+from cloudinstall.utils import human_to_mb
 
 
 log = logging.getLogger('cloudinstall.machine')
 
 
+def _parse_hardware(hardware):
+    """ [(key, value)] from a Hardware string like 'arch=amd64 mem=2048M'
+    """
+    if not hardware:
+        return []
+    return [item.split('=', 1) for item in hardware.split(' ')
+            if '=' in item]
+
+
+def _lookup(hardware, spec):
+    # keys match if they are part of spec, so 'mem' matches 'memory'
+    for k, v in hardware:
+        if k in spec:
+            return v
+    return "N/A"
+
+
+def _size_mb(size):
+    """ Megabytes in a juju size like '2048M' or '8G', or None """
+    if size == "N/A":
+        return None
+    try:
+        return human_to_mb(size)
+    except Exception:
+        return None
+
+
+def _count(n):
+    if n == "N/A":
+        return None
+    try:
+        return int(n)
+    except (TypeError, ValueError):
+        return None
+
+
 class Machine:
 
-    """ Base machine class """
+    """ Base machine class
+
+    Built once per status, with the Hardware string parsed up front:
+    cpu_count, mem_mb and storage_mb are numbers, or None if juju
+    didn't report them.
+    """
+
+    __slots__ = ('machine_id', 'machine', 'agent', 'agent_state',
+                 'agent_state_info', 'agent_version', 'dns_name', 'err',
+                 'has_vote', 'wants_vote', 'cpu_count', 'mem_mb',
+                 'storage_mb', '_arch', '_cpu_cores', '_mem',
+                 '_storage', '_containers')
 
     def __init__(self, machine_id, machine):
         self.machine_id = machine_id
         self.machine = machine
-        self._cpu_cores = self.hardware('cpu-cores')
-        self._storage = self.hardware('root-disk')
-        self._mem = self.hardware('memory')
+        hardware = _parse_hardware(self.machine.get('Hardware', None))
+        if hardware:
+            # few distinct values across machines, so interned
+            self._arch = sys.intern(_lookup(hardware, 'arch'))
+            self._cpu_cores = sys.intern(_lookup(hardware, 'cpu-cores'))
+            self._storage = sys.intern(_lookup(hardware, 'root-disk'))
+            self._mem = sys.intern(_lookup(hardware, 'memory'))
+            self.cpu_count = _count(self._cpu_cores)
+            self.storage_mb = _size_mb(self._storage)
+            self.mem_mb = _size_mb(self._mem)
+        else:
+            self._arch = self._cpu_cores = self._storage = self._mem = "N/A"
+            self.cpu_count = self.storage_mb = self.mem_mb = None
         self.agent = self.machine.get('Agent', None)
         self.agent_state = self.machine.get('AgentState', None)
         self.agent_state_info = self.machine.get('AgentStateInfo', None)
@@ -40,6 +100,7 @@ class Machine:
         self.err = self.machine.get('Err', None)
         self.has_vote = self.machine.get('HasVote')
         self.wants_vote = self.machine.get('WantsVote')
+        self._containers = None
 
     @property
     def instance_id(self):
@@ -62,6 +123,7 @@ class Machine:
     @cpu_cores.setter
     def cpu_cores(self, val):
         self._cpu_cores = val
+        self.cpu_count = _count(val)
 
     @property
     def arch(self):
@@ -70,7 +132,7 @@ class Machine:
         :returns: architecture type
         :rtype: str
         """
-        return self.hardware('arch')
+        return self._arch
 
     @property
     def storage(self):
@@ -79,15 +141,14 @@ class Machine:
         :returns: storage size
         :rtype: str
         """
-        try:
-            self._storage = int(self._storage[:-1]) / 1024
-            return "{size}G".format(size=str(self._storage))
-        except:
+        if self.storage_mb is None:
             return "N/A"
+        return "{size}G".format(size=str(self.storage_mb / 1024))
 
     @storage.setter
     def storage(self, val):
         self._storage = val
+        self.storage_mb = _size_mb(val)
 
     @property
     def mem(self):
@@ -101,6 +162,7 @@ class Machine:
     @mem.setter
     def mem(self, val):
         self._mem = val
+        self.mem_mb = _size_mb(val)
 
     def hardware(self, spec):
         """ Get hardware information
@@ -110,24 +172,21 @@ class Machine:
         :returns: hardware of spec
         :rtype: str
         """
-        _machine = self.machine.get('Hardware', None)
-        if _machine:
-            _hardware_list = _machine.split(' ')
-            for item in _hardware_list:
-                k, v = item.split('=')
-                if k in spec:
-                    return v
-        return "N/A"
+        return _lookup(_parse_hardware(self.machine.get('Hardware', None)),
+                       spec)
 
     @property
     def containers(self):
         """ Return containers for machine
 
-        :rtype: generator
+        :rtype: iterator
         """
-        _containers = self.machine.get('Containers', {}).items()
-        for container_id, container in _containers:
-            yield Machine(container_id, container)
+        if self._containers is None:
+            _containers = self.machine.get('Containers', {}).items()
+            self._containers = tuple(Machine(container_id, container)
+                                     for container_id, container
+                                     in _containers)
+        return iter(self._containers)
 
     def container(self, container_id):
         """ Inspect a container
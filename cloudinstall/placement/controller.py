@@ -20,7 +20,8 @@ import logging
 import yaml
 from multiprocessing import cpu_count
 
-from cloudinstall.maas import (satisfies, MaasMachineStatus)
+from cloudinstall.constraints import MachineTable
+from cloudinstall.maas import MaasMachineStatus
 from cloudinstall.utils import load_charms
 from cloudinstall.state import CharmState
 
@@ -259,6 +260,14 @@ class PlacementController:
         return mid in [self.sub_placeholder.instance_id,
                        self.def_placeholder.instance_id]
 
+    def hardware_facts(self, machine):
+        """ Cached hardware facts for machine from MAAS commissioning
+        details, or None
+        """
+        if self.maas_state is None:
+            return None
+        return self.maas_state.hardware_facts(machine)
+
     def machines(self, include_placeholders=True):
         """Returns all machines known to the controller.
 
@@ -593,13 +602,19 @@ class PlacementController:
                 MaasMachineStatus.READY,
                 constraints=self.config.getopt('constraints'))
 
-        def satisfying_machine(constraints):
-            for machine in maas_machines:
-                if satisfies(machine, constraints)[0]:
-                    maas_machines.remove(machine)
-                    return machine
+        table = MachineTable(maas_machines)
+        available = [True] * len(table)
 
-            return None
+        def satisfying_machine(constraints):
+            mask = table.evaluate(constraints).mask
+            i = next((i for i, ok in enumerate(mask)
+                      if ok and available[i]), None)
+            if i is None:
+                return None
+            available[i] = False
+            machine = table.machines[i]
+            maas_machines.remove(machine)
+            return machine
 
         isolated_charms, controller_charms = [], []
         subordinate_charms = []
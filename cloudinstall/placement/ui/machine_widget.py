@@ -61,10 +61,16 @@ class MachineWidget(WidgetWrap):
 
     def hardware_info_markup(self):
         m = self.machine
-        return [('label', 'arch'), ' {}  '.format(m.arch),
-                ('label', 'cores'), ' {}  '.format(m.cpu_cores),
-                ('label', 'mem'), ' {}  '.format(m.mem),
-                ('label', 'storage'), ' {}'.format(m.storage)]
+        markup = [('label', 'arch'), ' {}  '.format(m.arch),
+                  ('label', 'cores'), ' {}  '.format(m.cpu_cores),
+                  ('label', 'mem'), ' {}  '.format(m.mem),
+                  ('label', 'storage'), ' {}'.format(m.storage)]
+        facts = self.controller.hardware_facts(m)
+        if facts:
+            markup += ['  ', ('label', 'disks'),
+                       ' {}  '.format(len(facts['disks'])),
+                       ('label', 'nics'), ' {}'.format(len(facts['nics']))]
+        return markup
 
     def build_widgets(self):
 
@@ -16,7 +16,7 @@
 import logging
 from urwid import (AttrMap, Divider, Padding, Pile, Text, WidgetWrap)
 
-from cloudinstall.maas import satisfies
+from cloudinstall.constraints import MachineTable
 
 from cloudinstall.placement.ui.filter_box import FilterBox
 from cloudinstall.placement.ui.machine_widget import MachineWidget
@@ -103,7 +103,9 @@ class MachinesList(WidgetWrap):
             if machine is None:
                 self.remove_machine(mw.machine)
 
-        n_satisfying_machines = len(machines)
+        satisfying = MachineTable.for_machines(machines).evaluate(
+            self.constraints)
+        n_satisfying_machines = satisfying.count()
 
         def get_placement_filter_label(d):
             s = ""
@@ -114,9 +116,8 @@ class MachinesList(WidgetWrap):
             return s
 
         for m in machines:
-            if not satisfies(m, self.constraints)[0]:
+            if not satisfying.satisfied(m):
                 self.remove_machine(m)
-                n_satisfying_machines -= 1
                 continue
 
             assignment_names = ""
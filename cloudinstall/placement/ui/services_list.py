@@ -18,7 +18,7 @@ import logging
 from urwid import (AttrMap, Divider, Padding, Pile, Text,
                    WidgetWrap)
 
-from cloudinstall.maas import satisfies
+from cloudinstall.constraints import compile_constraints
 from cloudinstall.state import CharmState
 from cloudinstall.placement.ui.service_widget import ServiceWidget
 
@@ -106,7 +106,9 @@ class ServicesList(WidgetWrap):
 
         for cc in self.controller.charm_classes():
             if self.machine:
-                if not satisfies(self.machine, cc.constraints)[0] \
+                failed = compile_constraints(cc.constraints).failures(
+                    self.machine)
+                if failed \
                    or not (self.controller.is_assigned_to(cc, self.machine) or
                            self.controller.is_deployed_to(cc, self.machine)):
                     self.remove_service_widget(cc)
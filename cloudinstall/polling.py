@@ -0,0 +1,84 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Adaptive polling intervals
+"""
+
+import logging
+import threading
+
+log = logging.getLogger('cloudinstall.polling')
+
+
+class PollingPolicy:
+
+    """ Decides how long to wait between polls of something that
+    changes in bursts, like juju status during a deploy.
+
+    Each poll reports what it saw to observe(). While it keeps changing
+    the interval stays at min_interval; every poll that sees nothing new
+    multiplies it by backoff, up to max_interval.
+    """
+
+    def __init__(self, min_interval=2, max_interval=60, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+        self._lock = threading.Lock()
+        self._last = None
+
+    @classmethod
+    def from_config(cls, config):
+        """ Builds a policy from the poll_interval_min,
+        poll_interval_max and poll_backoff options
+        """
+        return cls(config.getopt('poll_interval_min'),
+                   config.getopt('poll_interval_max'),
+                   config.getopt('poll_backoff'))
+
+    def copy(self):
+        """ A new policy with the same settings, starting over """
+        return PollingPolicy(self.min_interval, self.max_interval,
+                             self.backoff)
+
+    def changed(self):
+        with self._lock:
+            self.interval = self.min_interval
+
+    def unchanged(self):
+        with self._lock:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+
+    def observe(self, value):
+        """ Records the latest polled value, and adjusts the interval
+        by whether it differs from the previous one.
+
+        :returns: True if value changed
+        """
+        changed = value != self._last
+        self._last = value
+        if changed:
+            self.changed()
+        else:
+            self.unchanged()
+        return changed
+
+    def __repr__(self):
+        return "<PollingPolicy {:.1f}s ({}-{}s x{})>".format(
+            self.interval, self.min_interval, self.max_interval,
+            self.backoff)
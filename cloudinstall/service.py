@@ -32,6 +32,8 @@ class Unit:
 
     """ Unit class """
 
+    __slots__ = ('unit_name', 'unit')
+
     def __init__(self, unit_name, unit):
         self.unit_name = unit_name
         self.unit = unit
@@ -132,6 +134,8 @@ class Relation:
 
     """ Relation class """
 
+    __slots__ = ('relation_name', 'charms')
+
     def __init__(self, relation_name, charms):
         self.relation_name = relation_name
         self.charms = charms
@@ -149,6 +153,9 @@ class Service:
 
     """ Service class """
 
+    __slots__ = ('service_name', 'service', 'charm', 'exposed', 'networks',
+                 'life', '_units')
+
     def __init__(self, service_name, service):
         self.service_name = service_name
         self.service = service
@@ -156,6 +163,7 @@ class Service:
         self.exposed = self.service.get('Exposed')
         self.networks = self.service.get('Networks')
         self.life = self.service.get('Life')
+        self._units = None
 
     def unit(self, name):
         """ Single unit entry
@@ -181,14 +189,11 @@ class Service:
         :returns: iterator of associated units for service
         :rtype: Unit()
         """
-        units_list = []
-        units_dict = self.service.get('Units', {})
-        if units_dict is None:
-            return units_list
-
-        for unit_name, units in units_dict.items():
-            units_list.append(Unit(unit_name, units))
-        return units_list
+        if self._units is None:
+            units_dict = self.service.get('Units', {}) or {}
+            self._units = [Unit(unit_name, units)
+                           for unit_name, units in units_dict.items()]
+        return list(self._units)
 
     def relation(self, name):
         """ Single relation entry
@@ -0,0 +1,112 @@
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Last known Juju and MAAS state, saved for the next launch
+"""
+
+import gzip
+import json
+import logging
+import os
+import time
+
+from cloudinstall.juju import JujuState
+from cloudinstall.maas import MaasState
+
+log = logging.getLogger('cloudinstall.statuscache')
+
+# bump when the saved layout changes; other versions are ignored
+STATUS_CACHE_VERSION = 1
+
+
+class StatusCache:
+
+    """ Saves and loads the last Juju status and MAAS node list, as
+    gzipped JSON
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def save(self, juju_status, maas_nodes=None):
+        """ Writes the cache, replacing any previous one whole """
+        data = {'version': STATUS_CACHE_VERSION,
+                'saved': time.time(),
+                'juju': juju_status,
+                'maas': maas_nodes}
+        tmpfile = self.filename + '.tmp'
+        with gzip.open(tmpfile, 'wt') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmpfile, self.filename)
+
+    def load(self):
+        """ Reads the cache
+
+        :returns: (juju status, maas nodes or None, time saved), or None
+                  if there is no usable cache
+        """
+        try:
+            with gzip.open(self.filename, 'rt') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError) as e:
+            log.warning("Ignoring unreadable status cache {}: "
+                        "{}".format(self.filename, e))
+            return None
+        if not isinstance(data, dict) or \
+           data.get('version') != STATUS_CACHE_VERSION:
+            log.info("Ignoring status cache {} from another "
+                     "version".format(self.filename))
+            return None
+        return data['juju'], data.get('maas'), data['saved']
+
+
+class CachedJujuState(JujuState):
+
+    """ JujuState over a saved status, to draw from before juju is
+    connected. Never fetches anything.
+    """
+
+    def __init__(self, status, saved):
+        super().__init__(juju=None)
+        self.stale_since = saved
+        self._cached_status = status
+
+    def status(self):
+        return self._cached_status
+
+    def status_matching(self, patterns):
+        return self._cached_status
+
+
+class CachedMaasState(MaasState):
+
+    """ MaasState over a saved node list. Never fetches anything.
+    """
+
+    NODES_TTL = float('inf')
+
+    def __init__(self, nodes, saved):
+        super().__init__(maas_client=None)
+        self.stale_since = saved
+        self._maas_client_nodes = nodes
+
+    def _fetch_nodes(self):
+        return self._maas_client_nodes
+
+    def invalidate_nodes_cache(self):
+        "no op"
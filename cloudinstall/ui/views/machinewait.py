@@ -36,7 +36,7 @@ class MachineWaitView(WidgetWrap):
             self.maas_client = None
             self.maas_state = FakeMaasState()
         else:
-            self.maas_client, self.maas_state = connect_to_maas(creds)
+            self.maas_client, self.maas_state = connect_to_maas(creds, self.config)
         self.spinner = Spinner(15, 4)
         w = self.build_widgets()
         super().__init__(w)
@@ -17,8 +17,10 @@ from __future__ import unicode_literals
 from operator import attrgetter
 import logging
 import random
+import time
 from urwid import (Text, Columns, WidgetWrap,
                    Pile, ListBox, Divider)
+from cloudinstall.juju import JujuStatusChanges
 from cloudinstall.status import get_sync_status
 from cloudinstall import utils
 from cloudinstall.ui.widgets import UnitInfoWidget
@@ -93,35 +95,75 @@ class ServicesView(WidgetWrap):
         self.config = config
         self.unit_w = None
         self.log_cache = None
+        # names of units changed since the last refresh, None for all
+        self.changed_units = None
+        # names of units whose text changes without juju status
+        # changing, redrawn on every refresh
+        self.live_units = set()
+        self._service_names = None
 
         for key, label in self.view_columns:
             self.columns.add(key, label)
-        super().__init__(ListBox([self.columns.render()]))
-
+        rows = [self.columns.render()]
+        if juju_state.stale_since:
+            rows.insert(0, Color.info_minor(Text(
+                "Showing status from {}, connecting to juju...".format(
+                    time.strftime("%c", time.localtime(
+                        juju_state.stale_since))))))
+        super().__init__(ListBox(rows))
+
+        self.juju_state.subscribe(self._status_changed,
+                                  JujuStatusChanges.UNIT_KINDS +
+                                  JujuStatusChanges.MACHINE_KINDS)
         self.refresh_nodes(self.nodes)
 
+    def _status_changed(self, changes):
+        if self.changed_units is not None:
+            self.changed_units.update(changes.affected_units())
+
+    def detach(self):
+        """ Stops following juju status changes, for when the view is
+        replaced
+        """
+        self.juju_state.unsubscribe(self._status_changed)
+
     def refresh_nodes(self, nodes):
-        """ Adds services to the view if they don't already exist
+        """ Adds services to the view if they don't already exist, and
+        updates the units that changed since the last refresh
+
+        Every unit is redrawn the first time and whenever the set of
+        services changes.
         """
-        for node in nodes:
-            charm_class, service = node
-            if len(service.units) > 0:
-                for u in sorted(service.units, key=attrgetter('unit_name')):
-                    # Refresh any state changes
-                    try:
-                        unit_w = self.deployed[u.unit_name]
-                    except:
-                        hwinfo = self._get_hardware_info(u)
-                        self.deployed[u.unit_name] = UnitInfoWidget(
-                            u,
-                            charm_class,
-                            hwinfo)
-                        unit_w = self.deployed[u.unit_name]
-                        for k, label in self.view_columns:
-                            self.columns.add_to(k, getattr(unit_w, k))
-
-                    self.update_ui_state(charm_class, u,
-                                         unit_w)
+        charm_classes = {service.service_name: charm_class
+                         for charm_class, service in nodes}
+        service_names = [service.service_name for _, service in nodes]
+        if service_names != self._service_names:
+            self._service_names = service_names
+            self.changed_units = None
+
+        if self.changed_units is None:
+            units = [u for _, service in nodes
+                     for u in sorted(service.units,
+                                     key=attrgetter('unit_name'))]
+        else:
+            names = sorted(self.changed_units | self.live_units)
+            units = [u for u in map(self.juju_state.unit, names)
+                     if u is not None]
+        self.changed_units = set()
+
+        for u in units:
+            charm_class = charm_classes.get(u.unit_name.split('/')[0])
+            if charm_class is None:
+                continue
+            unit_w = self.deployed.get(u.unit_name)
+            if unit_w is None:
+                hwinfo = self._get_hardware_info(u)
+                unit_w = UnitInfoWidget(u, charm_class, hwinfo)
+                self.deployed[u.unit_name] = unit_w
+                for k, label in self.view_columns:
+                    self.columns.add_to(k, getattr(unit_w, k))
+
+            self.update_ui_state(charm_class, u, unit_w)
 
     def status_icon_state(self, charm_class, unit):
         # unit.agent_state may be "pending" despite errors elsewhere,
@@ -156,6 +198,13 @@ class ServicesView(WidgetWrap):
         unit_w.public_address.set_text(unit.public_address)
         unit_w.agent_state.set_text(unit.agent_state)
         unit_w.icon.set_text(self.status_icon_state(charm_class, unit))
+        # the pending icon is animated, and the sync status is read
+        # from a file
+        if unit.agent_state == "pending" or \
+           'glance-simplestreams-sync' in unit.unit_name:
+            self.live_units.add(unit.unit_name)
+        else:
+            self.live_units.discard(unit.unit_name)
 
         extended_agent_state = unit.extended_agent_state
         if len(extended_agent_state) > 0 and \
@@ -16,66 +16,233 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
 import bson
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
 import requests
 import json
 
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    # urllib3 < 1.9, bundled with requests < 2.4.1
+    Retry = None
+
+
+# outcome of one node's request in a bulk operation. error is None on
+# success, otherwise a description of the HTTP or connection error.
+NodeResult = namedtuple('NodeResult',
+                        ['system_id', 'ok', 'response', 'error'])
+
+
+def _retry(retries):
+    """ The max_retries for MaasClient's HTTPAdapter
+
+    Retry's default methods are the idempotent ones, so POST is left
+    out. Reads that time out aren't retried, so a call never waits much
+    longer than its timeout.
+    """
+    if Retry is None:
+        return retries
+    try:
+        return Retry(total=retries, connect=retries, read=False,
+                     backoff_factor=0.2,
+                     status_forcelist=(502, 503, 504),
+                     raise_on_status=False)
+    except TypeError:
+        # urllib3 < 1.15 has no raise_on_status, and would raise
+        # instead of returning the last 5xx once retries ran out, so
+        # only retry connecting
+        return Retry(total=retries, connect=retries, read=False,
+                     backoff_factor=0.2)
+
+
+class BulkResults(OrderedDict):
+
+    """ NodeResults of a bulk operation by system_id, in request order
+    """
+
+    @property
+    def succeeded(self):
+        return [r.system_id for r in self.values() if r.ok]
+
+    @property
+    def failed(self):
+        return [r for r in self.values() if not r.ok]
+
+
+class RateLimiter:
+
+    """ Spaces calls to wait() at least 1/rate seconds apart, across
+    threads. A rate of None or 0 doesn't limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            at = max(self._next, now)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
 
 class MaasClient:
 
     """ Client Class
+
+    Requests go through one requests.Session, so connections to the
+    MAAS server are kept alive and reused rather than opened per call.
     """
 
-    def __init__(self, auth):
+    def __init__(self, auth, pool_size=10, retries=3, timeout=30,
+                 max_rate=None):
         """ Entry point to client routines for interfacing
         with MAAS api.
 
         :param auth: MAAS Authorization class (required)
+        :param int pool_size: connections kept open to the MAAS server,
+                              and the number of requests bulk operations
+                              make at once
+        :param int retries: times to retry a GET or DELETE that fails to
+                            connect or gets a 502, 503 or 504. POSTs
+                            aren't retried, they may not be idempotent.
+        :param float timeout: default seconds to wait for a response
+        :param float max_rate: most requests per second bulk operations
+                               make, or None for no limit
         """
         self.auth = auth
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(max_rate)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=_retry(retries))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._oauth_signer = None
+        self._oauth_key = None
+
+    def close(self):
+        """ Closes pooled connections """
+        self.session.close()
+
+    def _parallel(self, fn, items):
+        """ Calls fn on each of items, from as many threads as there are
+        pooled connections, and no faster than max_rate
+
+        :returns: results in the order of items
+        :rtype: list
+        """
+        items = list(items)
+
+        def limited(item):
+            self.rate_limiter.wait()
+            return fn(item)
+
+        if len(items) < 2 or self.pool_size < 2:
+            return [limited(item) for item in items]
+        with ThreadPoolExecutor(min(self.pool_size, len(items))) as pool:
+            return list(pool.map(limited, items))
+
+    def _bulk(self, request, system_ids, on_result=None):
+        """ Makes request(system_id) for each of system_ids in parallel
+
+        :param request: function returning a requests.Response
+        :param on_result: (optional) called with each NodeResult, from
+                          the worker thread, as soon as it's made. The
+                          returned results then leave out the responses,
+                          so they can be freed as they're handled.
+        :returns: results by system_id
+        :rtype: BulkResults
+        """
+        def make(system_id):
+            try:
+                res = request(system_id)
+            except requests.exceptions.RequestException as e:
+                return NodeResult(system_id, False, None, str(e))
+            if res.ok:
+                return NodeResult(system_id, True, res, None)
+            return NodeResult(system_id, False, res, "{} {}".format(
+                res.status_code, res.text or res.reason))
+
+        def run(system_id):
+            result = make(system_id)
+            if on_result is None:
+                return result
+            on_result(result)
+            return result._replace(response=None)
+
+        results = BulkResults()
+        for result in self._parallel(run, system_ids):
+            results[result.system_id] = result
+        return results
 
     def _oauth(self):
         """ Generates OAuth attributes for protected resources
 
+        Built once and reused until the api key changes.
+
         :returns: OAuth class
         """
-        oauth = OAuth1(self.auth.consumer_key,
-                       client_secret=self.auth.consumer_secret,
-                       resource_owner_key=self.auth.token_key,
-                       resource_owner_secret=self.auth.token_secret,
-                       signature_method='PLAINTEXT',
-                       signature_type='query')
-        return oauth
-
-    def get(self, url, params=None):
+        if self._oauth_signer is None or \
+           self._oauth_key != self.auth.api_key:
+            self._oauth_signer = OAuth1(
+                self.auth.consumer_key,
+                client_secret=self.auth.consumer_secret,
+                resource_owner_key=self.auth.token_key,
+                resource_owner_secret=self.auth.token_secret,
+                signature_method='PLAINTEXT',
+                signature_type='query')
+            self._oauth_key = self.auth.api_key
+        return self._oauth_signer
+
+    def get(self, url, params=None, timeout=None):
         """ Performs a authenticated GET against a MAAS endpoint
 
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
+        :param timeout: seconds to wait, instead of the client's default
         """
-        return requests.get(url=self.auth.api_url + url,
-                            auth=self._oauth(),
-                            params=params)
+        return self.session.get(url=self.auth.api_url + url,
+                                auth=self._oauth(),
+                                params=params,
+                                timeout=timeout or self.timeout)
 
-    def post(self, url, params=None):
+    def post(self, url, params=None, timeout=None):
         """ Performs a authenticated POST against a MAAS endpoint
 
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
+        :param timeout: seconds to wait, instead of the client's default
         """
-        return requests.post(url=self.auth.api_url + url,
-                             auth=self._oauth(),
-                             data=params)
+        return self.session.post(url=self.auth.api_url + url,
+                                 auth=self._oauth(),
+                                 data=params,
+                                 timeout=timeout or self.timeout)
 
-    def delete(self, url, params=None):
+    def delete(self, url, params=None, timeout=None):
         """ Performs a authenticated DELETE against a MAAS endpoint
 
         :param url: MAAS endpoint
         :param params: extra data sent with the HTTP request
+        :param timeout: seconds to wait, instead of the client's default
         """
-        return requests.delete(url=self.auth.api_url + url,
-                               auth=self._oauth())
+        return self.session.delete(url=self.auth.api_url + url,
+                                   auth=self._oauth(),
+                                   timeout=timeout or self.timeout)
 
     ###########################################################################
     # Boot Images API
@@ -133,26 +300,107 @@ class MaasClient:
             return json.loads(res.text)
         return []
 
+    def iter_node_pages(self, hostname=None, zone=None, tag=None,
+                        arch=None, status=None, system_ids=None,
+                        page_size=100, **params):
+        """ Nodes managed by MAAS that match every filter given, a page
+        at a time
+
+        See http://maas.ubuntu.com/docs/api.html#nodes
+
+        MAAS does the filtering by hostname, zone and system id, and
+        with a tag, lists only that tag's nodes. The 1.x API has no arch
+        or status filters, so those are applied to each page as it
+        arrives. Lists of system ids, or failing that hostnames, are
+        sent page_size at a time, one request per page.
+
+        :param hostname: hostname or list of hostnames
+        :param str zone: physical zone name
+        :param str tag: tag name
+        :param str arch: architecture, eg. 'amd64' or 'amd64/generic'
+        :param status: status number or list of status numbers
+        :param system_ids: list of system ids
+        :param int page_size: most ids or hostnames per request
+        :param params: other parameters for the nodes list call
+        :returns: lists of nodes
+        :rtype: generator
+        :raises requests.HTTPError: if MAAS fails a request
+        """
+        def as_set(v):
+            if v is None:
+                return None
+            return {v} if isinstance(v, (str, int)) else set(v)
+
+        hostnames = as_set(hostname)
+        statuses = as_set(status)
+        ids = as_set(system_ids)
+
+        def wanted(node):
+            if statuses is not None and node['status'] not in statuses:
+                return False
+            if arch and node['architecture'] != arch and \
+               node['architecture'].split('/')[0] != arch:
+                return False
+            if not tag:
+                return True
+            # the tag's nodes call takes no other filters
+            return ((hostnames is None or node['hostname'] in hostnames) and
+                    (ids is None or node['system_id'] in ids) and
+                    (zone is None or
+                     node.get('zone', {}).get('name') == zone))
+
+        if tag:
+            calls = [('/tags/{}/'.format(tag), dict(op='nodes'))]
+        else:
+            params['op'] = 'list'
+            if zone:
+                params['zone'] = zone
+            if hostnames is not None:
+                params['hostname'] = sorted(hostnames)
+            if ids is not None:
+                params['id'] = sorted(ids)
+            paged = 'id' if ids is not None else \
+                'hostname' if hostnames is not None else None
+            if paged is None:
+                calls = [('/nodes/', params)]
+            else:
+                values = params[paged]
+                calls = [('/nodes/', dict(params, **{
+                    paged: values[i:i + page_size]}))
+                    for i in range(0, len(values), page_size)]
+
+        for url, page_params in calls:
+            res = self.get(url, page_params)
+            res.raise_for_status()
+            page = [node for node in res.json() if wanted(node)]
+            if page:
+                yield page
+
+    def nodes_matching(self, **filters):
+        """ Nodes managed by MAAS that match every filter given
+
+        :param filters: as for iter_node_pages
+        :returns: managed nodes
+        :rtype: list
+        :raises requests.HTTPError: if MAAS fails a request
+        """
+        return [node for page in self.iter_node_pages(**filters)
+                for node in page]
+
     def nodes_V2(self, **params):
         """ Nodes managed by MAAS
 
         See http://maas.ubuntu.com/docs/api.html#nodes
 
         :param params: keyword parameters to filter returned nodes
-                       allowed values include hostnames, mac_addresses,
-                       zone.
+                       allowed values include hostname, zone, tag, arch,
+                       state and system_ids, as for iter_node_pages.
         :returns: managed nodes
         :rtype: list
         """
-        params['op'] = 'list'
-        res = self.get('/nodes/', params)
-        if res.ok:
-            machines = map(Machine, res.json())
-            # Filter by state post response manually till maas fixes.
-            if 'state' in params:
-                machines = [m for m in machines if m.state == params['state']]
-            return machines
-        return []
+        if 'state' in params:
+            params['status'] = params.pop('state')
+        return [Machine(node) for node in self.nodes_matching(**params)]
 
     def node_get(self, node_id):
         res = self.get('/nodes/%s' % node_id)
@@ -209,11 +457,45 @@ class MaasClient:
         res = self.get('/nodes/{}/'.format(system_id),
                        dict(op='details'))
         if res.ok:
-            ds = bson.decode_all(res.content)
+            return self.decode_node_details(res.content)
+        return None
+
+    def node_details_many(self, system_ids, on_result=None):
+        """ Fetch several nodes' details in parallel
+
+        Details run to megabytes per node, so for many nodes pass
+        on_result to handle each as it arrives rather than holding
+        every response until the last one is in.
+
+        :param system_ids: machine identifications
+        :param on_result: (optional) called with each NodeResult as it
+                          completes, see _bulk
+        :returns: results by system_id, decode each response's content
+                  with decode_node_details
+        :rtype: BulkResults
+        """
+        return self._bulk(
+            lambda system_id: self.get('/nodes/{}/'.format(system_id),
+                                       dict(op='details')),
+            system_ids, on_result)
+
+    @staticmethod
+    def decode_node_details(content):
+        """ Decodes a node details response
+
+        :returns: dictionary of commissioning details, or None
+        :rtype: dict
+        """
+        if not content:
+            return None
+        if hasattr(bson, 'decode_all'):
+            # python3-bson, from pymongo
+            ds = bson.decode_all(content)
             if len(ds) == 0:
                 return None
             return ds[0]
-        return None
+        # bson from pypi
+        return bson.loads(content)
 
     def nodes_accept_all(self):
         """ Accept all commissioned nodes
@@ -227,6 +509,21 @@ class MaasClient:
             return True
         return False
 
+    def nodes_accept(self, system_ids):
+        """ Accept particular commissioned nodes, in one request
+
+        :param system_ids: machine identifications
+        :returns: Status
+        :rtype: bool
+        """
+        system_ids = list(system_ids)
+        if not system_ids:
+            return True
+        res = self.post('/nodes/', dict(op='accept', nodes=system_ids))
+        if res.ok:
+            return True
+        return False
+
     def node_commission(self, system_id):
         """ (Re)commission a node
 
@@ -249,6 +546,61 @@ class MaasClient:
             return True
         return False
 
+    def _node_op_many(self, op, system_ids, params=None):
+        params = dict(params or {}, op=op)
+        return self._bulk(
+            lambda system_id: self.post('/nodes/%s/' % (system_id,),
+                                        params),
+            system_ids)
+
+    def start_many(self, system_ids, user_data=None, distro_series=None):
+        """ Power up several nodes
+
+        :param system_ids: machine identifications
+        :returns: results by system_id
+        :rtype: BulkResults
+        """
+        params = {}
+        if user_data:
+            params['user_data'] = user_data
+        if distro_series:
+            params['distro_series'] = distro_series
+        return self._node_op_many('start', system_ids, params)
+
+    def stop_many(self, system_ids):
+        """ Shutdown several nodes
+
+        :param system_ids: machine identifications
+        :rtype: BulkResults
+        """
+        return self._node_op_many('stop', system_ids)
+
+    def commission_many(self, system_ids):
+        """ (Re)commission several nodes
+
+        :param system_ids: machine identifications
+        :rtype: BulkResults
+        """
+        return self._node_op_many('commission', system_ids)
+
+    def release_many(self, system_ids):
+        """ Release several nodes back into the pool
+
+        :param system_ids: machine identifications
+        :rtype: BulkResults
+        """
+        return self._node_op_many('release', system_ids)
+
+    def remove_many(self, system_ids):
+        """ Delete several nodes
+
+        :param system_ids: machine identifications
+        :rtype: BulkResults
+        """
+        return self._bulk(
+            lambda system_id: self.delete('/nodes/%s/' % (system_id,)),
+            system_ids)
+
     ###########################################################################
     # Nodegroups API
     ###########################################################################
@@ -335,6 +687,63 @@ class MaasClient:
             return True
         return False
 
+    # most system_ids sent in one update_nodes call
+    TAG_BATCH_SIZE = 100
+
+    def tag_new_many(self, tags):
+        """ Create whichever of the tags don't exist yet.
+
+        Lists the known tags once, then creates the missing ones in
+        parallel.
+
+        :param tags: Tag names
+        :returns: names of the tags that exist now
+        :rtype: set
+        """
+        existing = {tagmd['name'] for tagmd in self.tags}
+        missing = [tag for tag in dict.fromkeys(tags)
+                   if tag not in existing]
+
+        def create(tag):
+            return self.post('/tags/', dict(op='new', name=tag)).ok
+
+        created = self._parallel(create, missing)
+        return existing | {tag for tag, ok in zip(missing, created) if ok}
+
+    def tag_machines(self, tag, system_ids):
+        """ Tag several machines with the specified tag, up to
+        TAG_BATCH_SIZE per request.
+
+        :param tag: Tag name
+        :type tag: str
+        :param system_ids: IDs of nodes
+        :type system_ids: list
+        :returns: Success or Fail
+        :rtype: bool
+        """
+        system_ids = list(system_ids)
+        ok = True
+        for i in range(0, len(system_ids), self.TAG_BATCH_SIZE):
+            res = self.post('/tags/%s/' % (tag,),
+                            dict(op='update_nodes',
+                                 add=system_ids[i:i + self.TAG_BATCH_SIZE]))
+            ok = ok and res.ok
+        return ok
+
+    def tag_machine_many(self, tags):
+        """ Tag machines, each with its own tag, in parallel.
+
+        :param tags: (tag, system_id) pairs
+        :returns: results by system_id
+        :rtype: BulkResults
+        """
+        tag_of = {system_id: tag for tag, system_id in tags}
+        return self._bulk(
+            lambda system_id: self.post('/tags/%s/' % (tag_of[system_id],),
+                                        dict(op='update_nodes',
+                                             add=system_id)),
+            tag_of)
+
     def tag_name(self, nodes):
         """ Tag each managed node with its hostname.
 
@@ -345,13 +754,21 @@ class MaasClient:
         its hostname for now so that we can pass that tag as a
         constraint to juju.
 
+        Nodes already carrying their tag are skipped. The tag list is
+        fetched once, and every tag is its own update_nodes call, so
+        those are made in parallel.
+
+        :returns: tagging results by system_id
+        :rtype: BulkResults
         """
-        for machine in nodes:
-            system_id = machine['system_id']
-            if 'tag_names' not in machine['tag_names'] or \
-               system_id not in machine['tag_names']:
-                self.tag_new(system_id)
-                self.tag_machine(system_id, system_id)
+        untagged = [machine['system_id'] for machine in nodes
+                    if machine['system_id'] not in machine['tag_names']]
+        if not untagged:
+            return BulkResults()
+        tags = self.tag_new_many(untagged)
+        return self.tag_machine_many(
+            [(system_id, system_id) for system_id in untagged
+             if system_id in tags])
 
     def tag_fpi(self, nodes):
         """ Tag each DECLARED host with the FPI tag.
@@ -366,10 +783,12 @@ class MaasClient:
         :param maas: MAAS object representing all managed nodes
         """
         FPI_TAG = 'use-fastpath-installer'
-        self.tag_new(FPI_TAG)
-        for machine in nodes:
-            if machine['status'] == 0:
-                self.tag_machine(FPI_TAG, machine['system_id'])
+        self.tag_new_many([FPI_TAG])
+        declared = [machine['system_id'] for machine in nodes
+                    if machine['status'] == 0 and
+                    FPI_TAG not in machine.get('tag_names', [])]
+        if declared:
+            self.tag_machines(FPI_TAG, declared)
 
     ###########################################################################
     # Users API
@@ -15,12 +15,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from ws4py.client.threadedclient import WebSocketClient
+from collections import Counter, OrderedDict
+from concurrent import futures
+import bisect
 import json
 import logging
 import requests
+import os
 from os import path
 from queue import Queue, Empty
 import pprint
+import random
 import threading
 import time
 
@@ -43,17 +48,21 @@ class CharmNotFoundError(MacumbaError):
     "Error when getting charm store url"
 
 
-def query_cs(charm):
-    """ This helper routine will query the charm store to pull latest revisions
-    and charmstore url for the api.
-
-    :param str charm: charm name, can be in the form of 'precise/<charm>' to
-                      specify an alternate series.
-    """
+def _split_charm(charm):
     try:
         series, charm = charm.split('/')
     except ValueError:
         series = 'trusty'
+    return series, charm
+
+
+def fetch_cs(charm):
+    """ Queries the charm store for 'charm', bypassing any cache.
+
+    :param str charm: charm name, can be in the form of 'precise/<charm>' to
+                      specify an alternate series.
+    """
+    series, charm = _split_charm(charm)
     charm_store_url = 'https://manage.jujucharms.com/api/3/charm'
     url = path.join(charm_store_url, series, charm)
     r = requests.get(url)
@@ -65,6 +74,137 @@ def query_cs(charm):
     return r.json()
 
 
+class CharmStore:
+
+    """ Caching charm store resolver
+
+    Lookups are keyed by series and charm name, including the revision
+    when one is given (eg. 'trusty/keystone-19'). Revision-pinned
+    entries never change, so they never expire. Unpinned entries are
+    fresh for 'ttl' seconds; after that the cached value is still
+    returned while a background refresh runs, until 'max_stale'
+    seconds have passed. If the charm store can't be reached any cached
+    value is used regardless of age, so a pre-seeded cache file works
+    for offline or mirrored deployments.
+    """
+
+    def __init__(self, cache_file=None, ttl=3600, max_stale=7 * 86400,
+                 max_workers=8):
+        """
+        :param str cache_file: (optional) JSON file to persist lookups in
+        """
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_workers = max_workers
+        self.lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        self._refreshing = set()
+        self._entries = self._load()
+
+    def _key(self, charm):
+        return "/".join(_split_charm(charm))
+
+    def _pinned(self, key):
+        return key.rsplit('-', 1)[-1].isdigit()
+
+    def _load(self):
+        if not self.cache_file or not path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            log.exception("ignoring unreadable charm store cache "
+                          "{}".format(self.cache_file))
+            return {}
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        tmpfile = self.cache_file + '.tmp'
+        try:
+            with self._save_lock:
+                with self.lock:
+                    data = json.dumps(self._entries)
+                with open(tmpfile, 'w') as f:
+                    f.write(data)
+                os.rename(tmpfile, self.cache_file)
+        except IOError:
+            log.exception("could not save charm store cache")
+
+    def _fetch(self, key):
+        rv = fetch_cs(key)
+        with self.lock:
+            self._entries[key] = dict(fetched=time.time(), result=rv)
+        self._save()
+        return rv
+
+    def _refresh(self, key):
+        try:
+            self._fetch(key)
+        except Exception:
+            log.debug("background refresh of {} failed".format(key))
+        finally:
+            with self.lock:
+                self._refreshing.discard(key)
+
+    def lookup(self, charm):
+        """ Returns the charm store data for 'charm', see fetch_cs() """
+        key = self._key(charm)
+        with self.lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return self._fetch(key)
+
+        age = time.time() - entry['fetched']
+        if self._pinned(key) or age < self.ttl:
+            return entry['result']
+
+        if age < self.max_stale:
+            with self.lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+            if start:
+                threading.Thread(target=self._refresh, args=(key,),
+                                 daemon=True).start()
+            return entry['result']
+
+        try:
+            return self._fetch(key)
+        except (requests.RequestException, ValueError):
+            log.warning("charm store unreachable, using cached "
+                        "entry for {}".format(key))
+            return entry['result']
+
+    def prefetch(self, charms):
+        """ Resolves all 'charms' in parallel, filling the cache.
+
+        :returns: dict of charm to lookup error, for those that failed
+        """
+        errors = {}
+        with futures.ThreadPoolExecutor(self.max_workers) as pool:
+            fs = {pool.submit(self.lookup, c): c for c in set(charms)}
+            for f in futures.as_completed(fs):
+                if f.exception() is not None:
+                    errors[fs[f]] = f.exception()
+        return errors
+
+
+default_charm_store = CharmStore()
+
+
+def query_cs(charm):
+    """ This helper routine will query the charm store to pull latest revisions
+    and charmstore url for the api. Results are cached by
+    default_charm_store.
+
+    :param str charm: charm name, can be in the form of 'precise/<charm>' to
+                      specify an alternate series.
+    """
+    return default_charm_store.lookup(charm)
+
+
 class PrettyLog():
 
     def __init__(self, obj):
@@ -114,17 +254,167 @@ class RequestTimeout(MacumbaError):
     "Request timed out"
 
 
+# upper bounds, in seconds, of the CallStats latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class CallStats:
+
+    """ Per-Request counters for API calls
+
+    Records, for each Request name (FullStatus, ServiceDeploy, ...),
+    how many calls were made, how they ended, a latency histogram and
+    the bytes sent and received. Latency runs from sending the request
+    to its reply arriving on the socket, so it measures the server and
+    the network rather than how long the caller took to collect it.
+
+    Thread safe; one instance is shared by every connection a
+    JujuClient makes.
+    """
+
+    OUTCOMES = ('ok', 'error', 'timeout', 'closed')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def _entry(self, request):
+        entry = self.requests.get(request)
+        if entry is None:
+            entry = dict(count=0, time=0.0, max_time=0.0,
+                         bytes_sent=0, bytes_received=0,
+                         histogram=[0] * len(LATENCY_BUCKETS))
+            entry.update((o, 0) for o in self.OUTCOMES)
+            self.requests[request] = entry
+        return entry
+
+    def record(self, request, elapsed, outcome='ok', bytes_sent=0,
+               bytes_received=0):
+        """ Adds one finished call
+
+        :param str outcome: one of CallStats.OUTCOMES
+        """
+        with self.lock:
+            entry = self._entry(request)
+            entry['count'] += 1
+            entry[outcome] += 1
+            entry['time'] += elapsed
+            entry['max_time'] = max(entry['max_time'], elapsed)
+            entry['bytes_sent'] += bytes_sent
+            entry['bytes_received'] += bytes_received
+            entry['histogram'][bisect.bisect_left(LATENCY_BUCKETS,
+                                                  elapsed)] += 1
+
+    def _quantile(self, entry, q):
+        "upper bound of the bucket holding the q'th quantile"
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, entry['histogram']):
+            seen += n
+            if seen >= q * entry['count']:
+                return min(bound, entry['max_time'])
+        return entry['max_time']
+
+    def snapshot(self):
+        """ Returns a JSON-serialisable copy of the counters
+
+        Keyed by Request name; each entry has the raw counters plus
+        'mean', and 'p50' and 'p95' rounded up to a bucket bound.
+        """
+        with self.lock:
+            requests = {k: dict(v, histogram=list(v['histogram']))
+                        for k, v in self.requests.items()}
+        for entry in requests.values():
+            count = entry['count']
+            entry['mean'] = entry['time'] / count if count else 0
+            entry['p50'] = self._quantile(entry, 0.5)
+            entry['p95'] = self._quantile(entry, 0.95)
+            entry['histogram'] = [[str(b), n] for b, n
+                                  in zip(LATENCY_BUCKETS,
+                                         entry['histogram']) if n]
+        return requests
+
+    def summary(self):
+        """ Returns a table of the snapshot, slowest total time first """
+        lines = ["{:<28} {:>6} {:>5} {:>5} {:>9} {:>8} {:>8} "
+                 "{:>10}".format('request', 'count', 'err', 'tmo',
+                                 'total s', 'mean ms', 'p95 ms',
+                                 'recv KiB')]
+        stats = self.snapshot()
+        for name in sorted(stats, key=lambda k: -stats[k]['time']):
+            s = stats[name]
+            lines.append("{:<28} {:>6} {:>5} {:>5} {:>9.2f} {:>8.1f} "
+                         "{:>8.0f} {:>10.1f}".format(
+                             name, s['count'], s['error'], s['timeout'],
+                             s['time'], 1000 * s['mean'],
+                             1000 * s['p95'],
+                             s['bytes_received'] / 1024))
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        """ Writes snapshot() to filename as JSON """
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(dict(time=time.time(), requests=self.snapshot()),
+                      f, indent=2, sort_keys=True)
+        os.rename(tmpfile, filename)
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+
+
+def parse_response(res):
+    """ Returns the Response of a reply message, raising ServerError if
+    it carries an Error.
+    """
+    if 'Error' in res:
+        raise ServerError(res['Error'], res)
+
+    try:
+        return res['Response']
+    except:
+        raise BadResponseError("Failed to parse response: {}".format(res))
+
+
 class JujuWS(WebSocketClient):
 
     def __init__(self, url, password, protocols=['https-only'],
                  extensions=None, ssl_options=None, headers=None,
-                 start_reqid=1):
+                 start_reqid=1, max_pending=1000, unclaimed_ttl=300,
+                 sweep_interval=1, stats=None, api_stats=None):
+        """ Websocket connection tracking replies by RequestId
+
+        Pending replies are bounded: a request whose deadline passes
+        fails with RequestTimeout and is dropped, replies nobody
+        collects are dropped after unclaimed_ttl seconds, and once
+        max_pending requests are outstanding the oldest are evicted.
+        Replies that arrive for dropped requests are counted in stats.
+
+        :param int max_pending: most replies tracked at once
+        :param int unclaimed_ttl: seconds to keep a reply nobody
+                                  has received
+        :param Counter stats: counters to update, shared across
+                              reconnects by JujuClient
+        :param CallStats api_stats: (optional) per-Request call stats
+        """
         WebSocketClient.__init__(self, url, protocols, extensions,
                                  ssl_options=ssl_options, headers=headers)
         self.open_done = threading.Event()
         self.rid_lock = threading.RLock()
         self.msglock = threading.RLock()
-        self.messages = {}
+        self.messages = OrderedDict()
+        self.deadlines = {}
+        # ids given up on recently, to tell late replies from strays
+        self.expired = OrderedDict()
+        self.max_pending = max_pending
+        self.unclaimed_ttl = unclaimed_ttl
+        self.sweep_interval = sweep_interval
+        self.stats = Counter() if stats is None else stats
+        self.api_stats = api_stats
+        # request_id -> (Request, send time, bytes sent) for api_stats
+        self.inflight = {}
+        self._next_sweep = 0
         self._cur_request_id = start_reqid
 
     # WebSocketClient subclass overrides, run in private thread:
@@ -135,10 +425,33 @@ class JujuWS(WebSocketClient):
         msg = json.loads(m.data.decode('utf-8'))
         msg_req_id = msg['RequestId']
         with self.msglock:
-            self.messages[msg_req_id] = msg
+            pending = self.messages.get(msg_req_id, None)
+            if pending is None:
+                if self.expired.pop(msg_req_id, None) is not None:
+                    self.stats['late'] += 1
+                    log.debug("dropping late reply for request "
+                              "{}".format(msg_req_id))
+                else:
+                    self.stats['unknown'] += 1
+                    log.debug("dropping reply for unknown request "
+                              "{}".format(msg_req_id))
+                return
+            if not pending.done():
+                pending.set_result(msg)
+                self.deadlines[msg_req_id] = (time.time() +
+                                              self.unclaimed_ttl)
+                self._record(msg_req_id,
+                             'error' if 'Error' in msg else 'ok',
+                             len(m.data))
 
     def closed(self, code, reason=None):
         log.debug("socket closed: code:{} reason:{}".format(code, reason))
+        # wake up anyone still waiting on a reply from this connection
+        with self.msglock:
+            for request_id, f in self.messages.items():
+                if not f.done():
+                    f.set_exception(ConnectionClosedError(reason))
+                    self._record(request_id, 'closed')
 
     # actions for users of the class:
     def get_current_request_id(self):
@@ -148,61 +461,222 @@ class JujuWS(WebSocketClient):
     def do_close(self):
         self.close()
 
-    def do_connect(self):
+    def do_connect(self, timeout=None):
         self.connect()
-        self.open_done.wait()
+        if not self.open_done.wait(timeout):
+            raise RequestTimeout("websocket did not open")
         self.open_done.clear()
-        rv = self.do_send(creds)
+        rv = self.do_send(creds, timeout)
         return rv
 
-    def do_send(self, json_message):
+    def do_send(self, json_message, timeout=None):
+        """ Sends json_message, returning its RequestId
+
+        If timeout is set, the reply is given up on after 'timeout'
+        seconds even if nobody is waiting for it.
+        """
+        if self.terminated:
+            raise ConnectionClosedError
+
         with self.rid_lock:
             self._cur_request_id += 1
             request_id = self._cur_request_id
 
         json_message['RequestId'] = request_id
+        data = json.dumps(json_message)
 
-        self.send(json.dumps(json_message))
-
+        # register the pending reply before sending, the response may
+        # arrive on the socket thread before send() returns.
         with self.msglock:
-            self.messages[request_id] = None
+            now = time.time()
+            if now >= self._next_sweep:
+                self.sweep(now)
+            while len(self.messages) >= self.max_pending:
+                self._evict()
+            self.messages[request_id] = futures.Future()
+            if timeout:
+                self.deadlines[request_id] = now + timeout
+            if self.api_stats is not None:
+                self.inflight[request_id] = (
+                    json_message.get('Request', ''), now, len(data))
+
+        try:
+            self.send(data)
+        except (RuntimeError, OSError) as e:
+            self.forget(request_id)
+            raise ConnectionClosedError(str(e))
 
         return request_id
 
-    def do_receive(self, request_id):
-        """Checks for message matching request_id.
+    def do_receive(self, request_id, timeout=None):
+        """Waits for message matching request_id.
 
-        Will return None if message has not arrived yet.
+        Blocks until the reply arrives, the connection is closed or
+        'timeout' seconds pass, whichever comes first.
 
         Raises UnknownRequestError if request_id hasn't been sent yet
-        (or was already received).
+        (or was already received), RequestTimeout on timeout and
+        ConnectionClosedError if the socket went away.
 
         """
-        if self.terminated:
+        pending = self.pending_reply(request_id)
+
+        if self.terminated and not pending.done():
             raise ConnectionClosedError
 
+        try:
+            message = pending.result(timeout)
+        except futures.TimeoutError:
+            self.expire(request_id)
+            raise RequestTimeout(request_id)
+
+        self.forget(request_id)
+        return message
+
+    def pending_reply(self, request_id):
+        """Returns the concurrent.futures.Future that completes with
+        the reply to request_id.
+
+        Raises UnknownRequestError if request_id hasn't been sent yet
+        (or was already received).
+
+        """
         with self.msglock:
             if request_id not in self.messages:
                 errmsg = ("{} not in messages. "
                           "cur = {}".format(request_id,
                                             self._cur_request_id))
                 raise UnknownRequestError(errmsg)
+            return self.messages[request_id]
 
-            message = self.messages[request_id]
-            if message is not None:
-                del self.messages[request_id]
+    def forget(self, request_id):
+        "Stop tracking request_id, once its reply has been consumed"
+        with self.msglock:
+            self.messages.pop(request_id, None)
+            self.deadlines.pop(request_id, None)
+            self.inflight.pop(request_id, None)
+
+    def _record(self, request_id, outcome, bytes_received=0):
+        "update api_stats once request_id has finished"
+        call = self.inflight.pop(request_id, None)
+        if call is None:
+            return
+        request, start, bytes_sent = call
+        self.api_stats.record(request, time.time() - start, outcome,
+                              bytes_sent, bytes_received)
+
+    def expire(self, request_id, stat='timeouts'):
+        """ Give up on request_id, failing anyone still waiting on it
+        with RequestTimeout.
+
+        A reply that turns up afterwards is counted as late.
+        """
+        with self.msglock:
+            pending = self.messages.pop(request_id, None)
+            self.deadlines.pop(request_id, None)
+            if pending is None:
+                return
+            if pending.done():
+                # the reply came in but nobody collected it
+                self.stats['evicted' if stat == 'evicted'
+                           else 'unclaimed'] += 1
+                return
+            pending.set_exception(RequestTimeout(request_id))
+            self._record(request_id, 'timeout')
+            self.stats[stat] += 1
+            self.expired[request_id] = True
+            while len(self.expired) > self.max_pending:
+                self.expired.popitem(last=False)
+
+    def _evict(self):
+        request_id = next(iter(self.messages))
+        log.warning("too many pending requests, dropping "
+                    "{}".format(request_id))
+        self.expire(request_id, 'evicted')
+
+    def sweep(self, now=None):
+        """ Expires requests whose deadline has passed """
+        now = now or time.time()
+        with self.msglock:
+            overdue = [r for r, t in self.deadlines.items() if t <= now]
+            for request_id in overdue:
+                self.expire(request_id, 'expired')
+            self._next_sweep = now + self.sweep_interval
+
+    def pending_stats(self):
+        """ Returns counters describing the pending-reply table
+
+        'pending' is the number of requests tracked right now and
+        'ready' how many of those have a reply waiting to be received.
+        The rest count, over the client's lifetime: 'timeouts' (receive
+        gave up), 'expired' (deadline passed while nobody waited),
+        'evicted' (table full), 'unclaimed' (reply never received),
+        'late' (reply after we gave up) and 'unknown' (reply for a
+        request we never tracked).
+        """
+        with self.msglock:
+            rv = {k: self.stats[k] for k in ('timeouts', 'expired',
+                                             'evicted', 'unclaimed',
+                                             'late', 'unknown')}
+            rv['pending'] = len(self.messages)
+            rv['ready'] = sum(1 for f in self.messages.values()
+                              if f.done())
+        return rv
 
-        return message
+
+# Requests that are safe to send again after a reconnect when we can't
+# tell whether the server saw them the first time.
+# AddRelation fails once the relation exists, and each WatchAll leaves
+# a watcher on the server, so neither is replayed
+IDEMPOTENT_REQUESTS = {'FullStatus', 'EnvironmentInfo', 'CharmInfo',
+                       'GetEnvironmentConstraints', 'EnvironmentGet',
+                       'ServiceGet', 'GetServiceConstraints',
+                       'ServiceCharmRelations', 'PublicAddress',
+                       'GetAnnotations', 'SetAnnotations',
+                       'ServiceSet', 'ServiceExpose'}
 
 
 class JujuClient:
 
-    def __init__(self, url='wss://localhost:17070', password='pass'):
+    def __init__(self, url='wss://localhost:17070', password='pass',
+                 charm_store=None, alternate_urls=None,
+                 reconnect_attempts=8, reconnect_backoff=0.5,
+                 reconnect_backoff_max=30, max_pending=1000,
+                 login_timeout=30):
+        """ Juju API client
+
+        If the connection drops, calls transparently reconnect, trying
+        url and then each of alternate_urls (eg. the other state
+        servers) with jittered exponential backoff, and replay the
+        interrupted request if it is in IDEMPOTENT_REQUESTS.
+
+        Counts, latencies and payload sizes of every call are kept per
+        Request in self.api_stats, see CallStats.
+
+        :param list alternate_urls: other API endpoints to fail over to
+        :param int reconnect_attempts: give up reconnecting after this
+                                       many tries, 0 disables reconnect
+        :param int max_pending: most replies each connection tracks,
+                                see JujuWS
+        :param login_timeout: seconds to wait for a login to complete
+        """
         self.url = url
+        self.urls = [url] + [u for u in alternate_urls or [] if u != url]
         self.password = password
+        self.charm_store = charm_store or default_charm_store
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_backoff = reconnect_backoff
+        self.reconnect_backoff_max = reconnect_backoff_max
+        self.max_pending = max_pending
+        self.login_timeout = login_timeout
+        self._reconnected = None
+        self.pending_counters = Counter()
+        self.api_stats = CallStats()
         self.connlock = threading.RLock()
         with self.connlock:
-            self.conn = JujuWS(url, password)
+            self.conn = JujuWS(url, password, max_pending=max_pending,
+                               stats=self.pending_counters,
+                               api_stats=self.api_stats)
         creds['Params']['Password'] = password
 
     def _prepare_strparams(self, d):
@@ -223,28 +697,106 @@ class JujuClient:
         block other threads until done.
         """
         with self.connlock:
-            req_id = self.conn.do_connect()
-            try:
-                res = self.receive(req_id)
-                if 'Error' in res:
-                    raise LoginError(res['ErrorCode'])
-            except Exception as e:
-                raise LoginError(str(e))
+            self._login(self.conn)
+
+    def _login(self, conn):
+        try:
+            req_id = conn.do_connect(self.login_timeout)
+            res = parse_response(conn.do_receive(req_id,
+                                                 self.login_timeout))
+            if 'Error' in res:
+                raise LoginError(res['ErrorCode'])
+        except Exception as e:
+            raise LoginError(str(e))
 
     def reconnect(self):
+        """ Replace the connection, failing over across self.urls.
+
+        The new connection logs in and the backoff sleeps happen without
+        holding connlock; it is only taken to swap the connection in.
+
+        Raises ConnectionClosedError once reconnect_attempts have failed.
+        """
         with self.connlock:
-            self.close()
+            try:
+                self.close()
+            except (RuntimeError, OSError):
+                pass
             start_id = self.conn.get_current_request_id() + 1
-            self.conn = JujuWS(self.url,
-                               self.password,
-                               start_reqid=start_id)
-            self.login()
+            url_idx = self.urls.index(self.url) if self.url in self.urls \
+                else 0
+        for attempt in range(max(self.reconnect_attempts, 1)):
+            url = self.urls[(url_idx + attempt) % len(self.urls)]
+            conn = JujuWS(url, self.password,
+                          start_reqid=start_id,
+                          max_pending=self.max_pending,
+                          stats=self.pending_counters,
+                          api_stats=self.api_stats)
+            try:
+                self._login(conn)
+                with self.connlock:
+                    self.conn = conn
+                    self.url = url
+                log.info("reconnected to {}".format(url))
+                return
+            except Exception as e:
+                log.warning("reconnect to {} failed: {}".format(url, e))
+                start_id = conn.get_current_request_id() + 1
+                try:
+                    conn.do_close()
+                except (RuntimeError, OSError):
+                    pass
+            delay = min(self.reconnect_backoff_max,
+                        self.reconnect_backoff * 2 ** attempt)
+            time.sleep(random.uniform(delay / 2, delay))
+        raise ConnectionClosedError("unable to reconnect to "
+                                    "{}".format(self.urls))
+
+    def _recover(self, conn):
+        """ Reconnect after conn failed, unless another thread already
+        has. Threads that lose conn while a reconnect is under way wait
+        for it instead of starting their own.
+        """
+        with self.connlock:
+            if self.conn is not conn:
+                return
+            if self.reconnect_attempts == 0:
+                raise ConnectionClosedError
+            done = self._reconnected
+            leader = done is None
+            if leader:
+                done = self._reconnected = threading.Event()
+                log.warning("lost connection to {}, "
+                            "reconnecting".format(self.url))
+        if not leader:
+            done.wait()
+            with self.connlock:
+                if self.conn is conn:
+                    raise ConnectionClosedError("unable to reconnect to "
+                                                "{}".format(self.urls))
+            return
+        try:
+            self.reconnect()
+        finally:
+            with self.connlock:
+                self._reconnected = None
+            done.set()
+
+    def _is_idempotent(self, params):
+        return params.get('Request') in IDEMPOTENT_REQUESTS
 
     def close(self):
         """ Closes connection to juju websocket """
         with self.connlock:
             self.conn.do_close()
 
+    def pending_stats(self):
+        """ Returns pending-reply counters for diagnostics, see
+        JujuWS.pending_stats
+        """
+        with self.connlock:
+            return self.conn.pending_stats()
+
     def receive(self, request_id, timeout=None):
         """receives expected message.
         
@@ -254,23 +806,9 @@ class JujuClient:
         with no received message.
 
         """
-        res = None
-        start_time = time.time()
-        while res is None:
-            with self.connlock:
-                res = self.conn.do_receive(request_id)
-            if res is None:
-                time.sleep(0.1)
-                if timeout and (time.time() - start_time > timeout):
-                    raise RequestTimeout(request_id)
-
-        if 'Error' in res:
-            raise ServerError(res['Error'], res)
-
-        try:
-            return res['Response']
-        except:
-            raise BadResponseError("Failed to parse response: {}".format(res))
+        with self.connlock:
+            conn = self.conn
+        return parse_response(conn.do_receive(request_id, timeout))
 
     def call(self, params, timeout=None):
         """ Get json data from juju api daemon.
@@ -278,21 +816,104 @@ class JujuClient:
         :params params: Additional params to be passed into request
         :type params: dict
         """
+        replays = 0
+        while True:
+            with self.connlock:
+                conn = self.conn
+            try:
+                with self.connlock:
+                    req_id = conn.do_send(params, timeout)
+                return parse_response(conn.do_receive(req_id, timeout))
+            except ConnectionClosedError:
+                self._recover(conn)
+                replays += 1
+                if not self._is_idempotent(params) or \
+                   replays > self.reconnect_attempts:
+                    raise
+                log.debug("replaying {}".format(params['Request']))
+
+    def call_many(self, params_list, timeout=None):
+        """ Pipeline several requests over the websocket.
+
+        All requests are sent back to back before waiting on any reply,
+        so N calls cost roughly one round trip instead of N. Replies
+        are matched up by RequestId.
+
+        If the connection drops part way, the client reconnects and
+        resends the outstanding requests that are idempotent or were
+        never sent; the others get a ConnectionClosedError. If it can't
+        reconnect, the replies already received are still returned and
+        every outstanding request gets the ConnectionClosedError.
+
+        :param list params_list: request dicts as passed to call()
+        :param timeout: (optional) seconds to wait for the whole batch
+        :returns: list of (response, error) tuples in request order,
+                  where error is a MacumbaError or None
+        :rtype: list
+        """
         with self.connlock:
-            req_id = self.conn.do_send(params)
-
-        return self.receive(req_id, timeout)
+            conn = self.conn
+            req_ids = []
+            try:
+                for params in params_list:
+                    req_ids.append(conn.do_send(params, timeout))
+            except ConnectionClosedError:
+                pass
+
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+
+        results = []
+        for req_id in req_ids:
+            remaining = None
+            if deadline:
+                remaining = max(deadline - time.time(), 0)
+            try:
+                results.append((parse_response(
+                    conn.do_receive(req_id, remaining)), None))
+            except ConnectionClosedError:
+                break
+            except MacumbaError as e:
+                results.append((None, e))
+
+        if len(results) < len(params_list):
+            try:
+                self._recover(conn)
+            except ConnectionClosedError as e:
+                return results + [(None, e)] * (len(params_list) -
+                                                len(results))
+            for i in range(len(results), len(params_list)):
+                params = params_list[i]
+                # requests that never made it out are safe to send
+                if i < len(req_ids) and not self._is_idempotent(params):
+                    results.append((None, ConnectionClosedError()))
+                    continue
+                try:
+                    results.append((self.call(params, timeout), None))
+                except MacumbaError as e:
+                    results.append((None, e))
+        return results
 
     def info(self):
         """ Returns Juju environment state """
         return self.call(dict(Type="Client",
                               Request="EnvironmentInfo"))
 
-    def status(self):
-        """ Returns status of juju environment """
-        return self.call(dict(Type="Client",
-                              Request="FullStatus"),
-                         timeout=60)
+    def _status_params(self, patterns=None):
+        params = dict(Type="Client", Request="FullStatus")
+        if patterns:
+            params['Params'] = dict(Patterns=list(patterns))
+        return params
+
+    def status(self, patterns=None):
+        """ Returns status of juju environment
+
+        :param list patterns: (optional) only report the services,
+                              units and machines matching these names
+                              or globs, eg. ['keystone', 'nova-*', '3']
+        """
+        return self.call(self._status_params(patterns), timeout=60)
 
     def get_watcher(self):
         """ Returns watcher """
@@ -305,6 +926,12 @@ class JujuClient:
                               Request="Next",
                               Id=watcher_id))
 
+    def stop_watcher(self, watcher_id):
+        """ Stops a watcher, failing any Next call waiting on it """
+        return self.call(dict(Type="AllWatcher",
+                              Request="Stop",
+                              Id=watcher_id))
+
     def add_charm(self, charm_url):
         """ Adds charm """
         return self.call(dict(Type="Client",
@@ -343,18 +970,24 @@ class JujuClient:
                     machine_spec="", parent_id="", container_type=""):
         """Allocate a new machine from the iaas provider.
         """
+        params = self.machine_params(series, constraints, machine_spec,
+                                     parent_id, container_type)
+        return self.add_machines([params])
+
+    def machine_params(self, series="", constraints={},
+                       machine_spec="", parent_id="", container_type=""):
+        """ Build one MachineParams entry for add_machines() """
         if machine_spec:
             err_msg = "Cant specify machine spec with container_type/parent_id"
             assert not (parent_id or container_type), err_msg
             parent_id, container_type = machine_spec.split(":", 1)
 
-        params = dict(
+        return dict(
             Series=series,
             ContainerType=container_type,
             ParentId=parent_id,
             Constraints=self._prepare_constraints(constraints),
             Jobs=[Jobs.HostUnits])
-        return self.add_machines([params])
 
     def add_machines(self, machines):
         """ Add machines """
@@ -370,22 +1003,45 @@ class JujuClient:
                               Request="DestroyMachines",
                               Params=params))
 
+    def _add_relation_params(self, endpoint_a, endpoint_b):
+        return dict(Type="Client",
+                    Request="AddRelation",
+                    Params=dict(Endpoints=[endpoint_a,
+                                           endpoint_b]))
+
+    def _relation_exists(self, e):
+        return (isinstance(e, ServerError) and
+                'relation already exists' in e.response['Error'])
+
     def add_relation(self, endpoint_a, endpoint_b):
         """ Adds relation between units """
         try:
-            rv = self.call(dict(Type="Client",
-                                Request="AddRelation",
-                                Params=dict(Endpoints=[endpoint_a,
-                                                       endpoint_b])))
+            rv = self.call(self._add_relation_params(endpoint_a, endpoint_b))
         except ServerError as e:
             # do not treat pre-existing relations as exceptions:
-            if 'relation already exists' in e.response['Error']:
+            if self._relation_exists(e):
                 rv = e.response
             else:
                 raise e
 
         return rv
 
+    def add_relations(self, endpoints):
+        """ Adds several relations in one pipelined batch
+
+        :param list endpoints: list of (endpoint_a, endpoint_b) pairs
+        :returns: list of (response, error) tuples, see call_many()
+        """
+        results = self.call_many([self._add_relation_params(a, b)
+                                  for a, b in endpoints])
+        rv = []
+        for res, err in results:
+            # do not treat pre-existing relations as exceptions:
+            if self._relation_exists(err):
+                res, err = err.response, None
+            rv.append((res, err))
+        return rv
+
     def remove_relation(self, endpoint_a, endpoint_b):
         """ Removes relation """
         return self.call(dict(Type="Client",
@@ -405,10 +1061,17 @@ class JujuClient:
         :param str machine_spec: Type of machine to deploy to
         :returns: Deployed charm status
         """
+        _url = self.charm_store.lookup(charm)
+        return self.call(self._deploy_params(_url['charm']['url'],
+                                             service_name, num_units,
+                                             config_yaml, constraints,
+                                             machine_spec))
+
+    def _deploy_params(self, charm_url, service_name, num_units=1,
+                       config_yaml="", constraints=None, machine_spec=""):
         params = {'ServiceName': service_name}
 
-        _url = query_cs(charm)
-        params['CharmUrl'] = _url['charm']['url']
+        params['CharmUrl'] = charm_url
         params['NumUnits'] = num_units
         params['ConfigYAML'] = config_yaml
 
@@ -417,9 +1080,9 @@ class JujuClient:
                 constraints)
         if machine_spec:
             params['ToMachineSpec'] = machine_spec
-        return self.call(dict(Type="Client",
-                              Request="ServiceDeploy",
-                              Params=dict(params)))
+        return dict(Type="Client",
+                    Request="ServiceDeploy",
+                    Params=dict(params))
 
     def set_config(self, service_name, config_keys):
         """ Sets machine config """
@@ -501,6 +1164,17 @@ class JujuClient:
                               Request="ServiceCharmRelations",
                               Params=dict(ServiceName=service_name)))
 
+    def _add_unit_params(self, service_name, num_units=1, machine_spec=""):
+        params = {}
+        params['ServiceName'] = service_name
+        params['NumUnits'] = num_units
+        if machine_spec:
+            params['ToMachineSpec'] = machine_spec
+
+        return dict(Type="Client",
+                    Request="AddServiceUnits",
+                    Params=dict(params))
+
     def add_unit(self, service_name, num_units=1, machine_spec=""):
         """ Add unit
 
@@ -509,15 +1183,18 @@ class JujuClient:
         :param str machine_spec: Type of machine to deploy to
         :returns dict: Units added
         """
-        params = {}
-        params['ServiceName'] = service_name
-        params['NumUnits'] = num_units
-        if machine_spec:
-            params['ToMachineSpec'] = machine_spec
+        return self.call(self._add_unit_params(service_name, num_units,
+                                               machine_spec))
 
-        return self.call(dict(Type="Client",
-                              Request="AddServiceUnits",
-                              Params=dict(params)))
+    def add_units(self, service_name, machine_specs):
+        """ Add one unit to each machine spec in one pipelined batch
+
+        :param str service_name: Name of charm
+        :param list machine_specs: machine specs to deploy to
+        :returns: list of (response, error) tuples, see call_many()
+        """
+        return self.call_many([self._add_unit_params(service_name, 1, mspec)
+                               for mspec in machine_specs])
 
     def remove_unit(self, unit_names):
         """ Removes unit """
@@ -538,18 +1215,42 @@ class JujuClient:
                               Request="PublicAddress",
                               Params=dict(Target=target)))
 
+    def _set_annotations_params(self, entity, entity_type, annotation):
+        return dict(Type="Client",
+                    Request="SetAnnotations",
+                    Params=dict(Tag="%s-%s" % (entity_type, entity),
+                                Pairs=annotation))
+
+    def _get_annotations_params(self, entity, entity_type):
+        return dict(Type="Client",
+                    Request="GetAnnotations",
+                    Params=dict(Tag="%s-%s" % (entity_type, entity)))
+
     def set_annotations(self, entity, entity_type, annotation):
         """ Sets annotations.
         :param dict annotation: dict with string pairs.
         """
-        return self.call(dict(Type="Client",
-                              Request="SetAnnotations",
-                              Params=dict(Tag="%s-%s" % (entity_type, entity),
-                                          Pairs=annotation)))
+        return self.call(self._set_annotations_params(entity, entity_type,
+                                                      annotation))
+
+    def set_annotations_many(self, entity_type, annotations):
+        """ Sets annotations on several entities in one pipelined batch
+
+        :param list annotations: list of (entity, dict with string pairs)
+        :returns: list of (response, error) tuples, see call_many()
+        """
+        return self.call_many([self._set_annotations_params(e, entity_type,
+                                                            a)
+                               for e, a in annotations])
 
     def get_annotations(self, entity, entity_type):
         """ Gets annotations """
-        return self.call(dict(Type="Client",
-                              Request="GetAnnotations",
-                              Params=dict(Tag="%s-%s" % (entity_type,
-                                                         entity))))
+        return self.call(self._get_annotations_params(entity, entity_type))
+
+    def get_annotations_many(self, entities, entity_type):
+        """ Gets annotations of several entities in one pipelined batch
+
+        :returns: list of (response, error) tuples, see call_many()
+        """
+        return self.call_many([self._get_annotations_params(e, entity_type)
+                               for e in entities])
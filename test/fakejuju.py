@@ -0,0 +1,754 @@
+#
+# fakejuju.py - local fake Juju API websocket server
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Fake Juju API server
+
+Speaks the subset of the Juju websocket API that macumba uses (Login,
+FullStatus, the AllWatcher, ServiceDeploy, AddServiceUnits,
+AddMachines, AddRelation and annotations) against an in-memory
+environment, so the websocket path, JujuState and the status screen
+can be exercised by tests and benchmarks without a real state server.
+
+Machines and units go through a simulated lifecycle: machines are
+'pending' until provisioned, units are 'pending' until their machine
+is up and then 'installed' and 'started' (or 'error').
+
+Run it standalone to point openstack-status at a large fake
+environment:
+
+    python3 test/fakejuju.py --port 17070 --machines 1000 --units 5000
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from wsgiref.simple_server import make_server
+
+from ws4py.server.wsgirefserver import (WSGIServer,
+                                        WebSocketWSGIRequestHandler)
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from ws4py.websocket import WebSocket
+
+log = logging.getLogger('fakejuju')
+
+
+class FakeJujuError(Exception):
+
+    "Returned to the client as the reply's Error"
+
+
+class FakeJujuModel:
+
+    """ In-memory juju environment
+
+    Entities are stored in AllWatcher delta form, and every change is
+    appended to a delta log that AllWatchers read from. FullStatus is
+    built from the same entities.
+
+    Lifecycle transitions are scheduled on a timer heap and applied by
+    tick(), which the API calls before answering each request.
+
+    :param float provision_time: seconds from AddMachines until a
+                                 machine is 'started'
+    :param float start_time: seconds from a unit's machine starting
+                             until the unit is 'started'
+    :param float error_rate: fraction of units that end in 'error'
+    :param seed: seed for the jitter and error choices
+    """
+
+    def __init__(self, provision_time=0, start_time=0, error_rate=0,
+                 seed=None):
+        self.provision_time = provision_time
+        self.start_time = start_time
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.stopped = False
+
+        self.machines = OrderedDict()
+        self.services = OrderedDict()
+        self.units = OrderedDict()
+        self.relations = OrderedDict()
+        self.annotations = {}
+        self.deltas = []
+        self.watchers = {}
+
+        self._timers = []
+        self._timer_seq = 0
+        self._on_started = {}
+        self._next_machine = 0
+        self._next_container = {}
+        self._next_unit = {}
+        self._next_watcher = 0
+
+        with self.lock:
+            self._add_machine(jobs=['JobManageEnviron'], started=True)
+
+    # lifecycle scheduling
+    def _jitter(self, delay):
+        if delay <= 0:
+            return 0
+        return delay * self.random.uniform(0.5, 1.5)
+
+    def _schedule(self, delay, fn, *args):
+        if delay <= 0:
+            fn(*args)
+            return
+        self._timer_seq += 1
+        heapq.heappush(self._timers,
+                       (time.time() + delay, self._timer_seq, fn, args))
+
+    def tick(self):
+        """ Applies every lifecycle transition that is due """
+        with self.lock:
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, fn, args = heapq.heappop(self._timers)
+                fn(*args)
+
+    def next_due(self):
+        "seconds until the next scheduled transition, or None"
+        with self.lock:
+            if not self._timers:
+                return None
+            return max(self._timers[0][0] - time.time(), 0)
+
+    def _emit(self, entity, change, info):
+        self.deltas.append([entity, change, dict(info)])
+        self.changed.notify_all()
+
+    def _when_started(self, machine_id, fn, *args):
+        if self.machines[machine_id]['Status'] == 'started':
+            fn(*args)
+        else:
+            self._on_started.setdefault(machine_id, []).append((fn, args))
+
+    # machines
+    def _add_machine(self, series='trusty', constraints=None, parent_id='',
+                     container_type='', jobs=None, started=False):
+        if parent_id:
+            if parent_id not in self.machines:
+                raise FakeJujuError("machine {} not found".format(parent_id))
+            n = self._next_container.get((parent_id, container_type), 0)
+            self._next_container[(parent_id, container_type)] = n + 1
+            machine_id = "{}/{}/{}".format(parent_id, container_type, n)
+        else:
+            machine_id = str(self._next_machine)
+            self._next_machine += 1
+        constraints = constraints or {}
+        n = len(self.machines)
+        info = {'Id': machine_id,
+                'InstanceId': 'pending',
+                'Status': 'pending',
+                'StatusInfo': '',
+                'Life': 'alive',
+                'Series': series or 'trusty',
+                'Jobs': jobs or ['JobHostUnits'],
+                'Addresses': [],
+                'HardwareCharacteristics': {
+                    'Arch': constraints.get('arch', 'amd64'),
+                    'CpuCores': constraints.get('cpu-cores') or 4,
+                    'Mem': constraints.get('mem') or 16384,
+                    'RootDisk': constraints.get('root-disk') or 204800},
+                'HasVote': machine_id == '0',
+                'WantsVote': machine_id == '0',
+                '_address': "10.{}.{}.{}".format((n >> 16) & 255,
+                                                 (n >> 8) & 255,
+                                                 n & 255 or 1)}
+        self.machines[machine_id] = info
+        if started:
+            self._start_machine(machine_id)
+        else:
+            self._emit('machine', 'change', self._public(info))
+            if parent_id:
+                self._when_started(parent_id, self._schedule,
+                                   self._jitter(self.provision_time),
+                                   self._start_machine, machine_id)
+            else:
+                self._schedule(self._jitter(self.provision_time),
+                               self._start_machine, machine_id)
+        return machine_id
+
+    def _start_machine(self, machine_id):
+        info = self.machines.get(machine_id)
+        if info is None:
+            return
+        info['Status'] = 'started'
+        info['InstanceId'] = 'fake-{}'.format(machine_id.replace('/', '-'))
+        info['Addresses'] = [{'Value': info['_address'], 'Type': 'ipv4',
+                              'Scope': 'public'}]
+        self._emit('machine', 'change', self._public(info))
+        for fn, args in self._on_started.pop(machine_id, []):
+            fn(*args)
+
+    def _public(self, info):
+        return {k: v for k, v in info.items() if not k.startswith('_')}
+
+    def _resolve_spec(self, machine_spec, constraints=None):
+        """ Returns the machine id a unit with machine_spec goes on,
+        adding a machine or container if needed.
+        """
+        if not machine_spec:
+            return self._add_machine(constraints=constraints)
+        if ':' in machine_spec:
+            container_type, parent_id = machine_spec.split(':', 1)
+            return self._add_machine(parent_id=parent_id,
+                                     container_type=container_type)
+        if machine_spec not in self.machines:
+            raise FakeJujuError("machine {} not found".format(machine_spec))
+        return machine_spec
+
+    def add_machines(self, machine_params):
+        """ Returns a list of {'Machine': id, 'Error': None} entries """
+        with self.lock:
+            rv = []
+            for p in machine_params:
+                try:
+                    mid = self._add_machine(p.get('Series'),
+                                            p.get('Constraints'),
+                                            p.get('ParentId'),
+                                            p.get('ContainerType'))
+                    rv.append({'Machine': mid, 'Error': None})
+                except FakeJujuError as e:
+                    rv.append({'Machine': '', 'Error': {'Message': str(e)}})
+            return rv
+
+    # services and units
+    def add_service(self, name, charm_url, num_units=1, machine_spec='',
+                    constraints=None):
+        with self.lock:
+            if name in self.services:
+                raise FakeJujuError("service \"{}\" already "
+                                    "exists".format(name))
+            info = {'Name': name, 'CharmURL': charm_url,
+                    'Exposed': False, 'Life': 'alive',
+                    'Constraints': constraints or {}}
+            self.services[name] = info
+            self._emit('service', 'change', info)
+            return [self.add_unit(name, machine_spec)
+                    for _ in range(num_units)]
+
+    def add_unit(self, service_name, machine_spec=''):
+        with self.lock:
+            svc = self.services.get(service_name)
+            if svc is None:
+                raise FakeJujuError("service \"{}\" not "
+                                    "found".format(service_name))
+            machine_id = self._resolve_spec(machine_spec,
+                                            svc['Constraints'])
+            n = self._next_unit.get(service_name, 0)
+            self._next_unit[service_name] = n + 1
+            name = "{}/{}".format(service_name, n)
+            info = {'Name': name,
+                    'Service': service_name,
+                    'Series': self.machines[machine_id]['Series'],
+                    'CharmURL': svc['CharmURL'],
+                    'MachineId': machine_id,
+                    'PublicAddress': '',
+                    'Status': 'pending',
+                    'StatusInfo': '',
+                    'WorkloadStatus': {'Current': 'unknown',
+                                       'Message': 'Waiting for agent '
+                                                  'initialization'},
+                    'AgentStatus': {'Current': 'allocating'}}
+            self.units[name] = info
+            self._emit('unit', 'change', info)
+            self._when_started(machine_id, self._schedule,
+                               self._jitter(self.start_time),
+                               self._install_unit, name)
+            return name
+
+    def _install_unit(self, name):
+        info = self.units[name]
+        machine = self.machines[info['MachineId']]
+        info['PublicAddress'] = machine['_address']
+        info['Status'] = 'installed'
+        info['WorkloadStatus'] = {'Current': 'maintenance',
+                                  'Message': 'installing charm software'}
+        info['AgentStatus'] = {'Current': 'executing'}
+        self._emit('unit', 'change', info)
+        self._schedule(self._jitter(self.start_time / 2),
+                       self._start_unit, name)
+
+    def _start_unit(self, name):
+        info = self.units[name]
+        if self.random.random() < self.error_rate:
+            info['Status'] = 'error'
+            info['StatusInfo'] = 'hook failed: "install"'
+            info['WorkloadStatus'] = {'Current': 'error',
+                                      'Message': 'hook failed: "install"'}
+        else:
+            info['Status'] = 'started'
+            info['WorkloadStatus'] = {'Current': 'active', 'Message': ''}
+        info['AgentStatus'] = {'Current': 'idle'}
+        self._emit('unit', 'change', info)
+
+    # relations
+    def _endpoint(self, ep, other):
+        if ':' in ep:
+            service, relation = ep.split(':', 1)
+        else:
+            service, relation = ep, other.split(':')[0]
+        if service not in self.services:
+            raise FakeJujuError("service \"{}\" not found".format(service))
+        return {'ServiceName': service,
+                'Relation': {'Name': relation, 'Role': 'requirer',
+                             'Interface': relation, 'Optional': False,
+                             'Limit': 1, 'Scope': 'global'}}
+
+    def add_relation(self, endpoint_a, endpoint_b):
+        with self.lock:
+            eps = [self._endpoint(endpoint_a, endpoint_b),
+                   self._endpoint(endpoint_b, endpoint_a)]
+            eps[1]['Relation']['Role'] = 'provider'
+            key = " ".join("{}:{}".format(e['ServiceName'],
+                                          e['Relation']['Name'])
+                           for e in eps)
+            if key in self.relations:
+                raise FakeJujuError("cannot add relation \"{}\": relation "
+                                    "already exists".format(key))
+            info = {'Key': key, 'Id': len(self.relations),
+                    'Endpoints': eps}
+            self.relations[key] = info
+            self._emit('relation', 'change', info)
+            return {e['ServiceName']: e['Relation'] for e in eps}
+
+    # annotations
+    def set_annotations(self, tag, pairs):
+        with self.lock:
+            self.annotations.setdefault(tag, {}).update(pairs)
+
+    def get_annotations(self, tag):
+        with self.lock:
+            return dict(self.annotations.get(tag, {}))
+
+    # bulk setup
+    def populate(self, n_machines=0, n_units=0, n_services=None,
+                 started=True):
+        """ Adds n_machines machines and n_units units, spread round
+        robin over the machines and across n_services services.
+
+        With started=False everything begins 'pending' and goes through
+        the simulated lifecycle.
+        """
+        with self.lock:
+            mids = [self._add_machine(started=started)
+                    for _ in range(n_machines)]
+            if n_units == 0:
+                return
+            if n_services is None:
+                n_services = max(1, n_units // 100)
+            names = ["svc-{}".format(i) for i in range(n_services)]
+            for name in names:
+                self.add_service(name, "cs:trusty/{}-1".format(name), 0)
+            for i in range(n_units):
+                self.add_unit(names[i % n_services],
+                              mids[i % len(mids)] if mids else '')
+            if n_services > 1:
+                for a, b in zip(names, names[1:]):
+                    self.add_relation(a + ":" + b, b + ":" + a)
+
+    # status
+    def _machine_status(self, info):
+        hw = info['HardwareCharacteristics']
+        hardware = ("arch={} cpu-cores={} mem={}M "
+                    "root-disk={}M".format(hw['Arch'], hw['CpuCores'],
+                                           hw['Mem'], hw['RootDisk']))
+        started = info['Status'] == 'started'
+        return {'Id': info['Id'],
+                'InstanceId': info['InstanceId'],
+                'Agent': self._agent_status(info),
+                'AgentState': info['Status'],
+                'AgentStateInfo': info['StatusInfo'],
+                'AgentVersion': '1.24.0',
+                'Life': info['Life'],
+                'Series': info['Series'],
+                'Jobs': info['Jobs'],
+                'DNSName': info['_address'] if started else '',
+                'Hardware': hardware if started else '',
+                'HasVote': info['HasVote'],
+                'WantsVote': info['WantsVote'],
+                'Err': None,
+                'Containers': {}}
+
+    def _agent_status(self, info):
+        return {'Status': info['Status'], 'Info': info['StatusInfo'],
+                'Data': {}, 'Err': None}
+
+    def _unit_status(self, info):
+        return {'Agent': self._agent_status(info),
+                'AgentState': info['Status'],
+                'AgentStateInfo': info['StatusInfo'],
+                'Err': None,
+                'Machine': info['MachineId'],
+                'PublicAddress': info['PublicAddress'],
+                'Charm': info['CharmURL'],
+                'Workload': {'Status': info['WorkloadStatus']['Current'],
+                             'Info': info['WorkloadStatus']['Message']},
+                'UnitAgent': {'Status': info['AgentStatus']['Current']}}
+
+    def _select(self, patterns):
+        """ Returns the (machines, services, units) matching patterns,
+        along with the machines and services of matching units, and the
+        units of matching services and machines.
+        """
+        def match(name):
+            return any(fnmatchcase(name, p) for p in patterns)
+
+        units = {n for n, u in self.units.items()
+                 if match(n) or match(u['Service']) or
+                 match(u['MachineId'])}
+        services = {s for s in self.services if match(s)}
+        services |= {self.units[n]['Service'] for n in units}
+        machines = {m for m in self.machines if match(m)}
+        machines |= {self.units[n]['MachineId'] for n in units}
+        machines |= {m.split('/')[0] for m in machines}
+        return machines, services, units
+
+    def full_status(self, patterns=None):
+        """ Returns the environment as a FullStatus response
+
+        :param list patterns: only include the machines, services and
+                              units matching these globs
+        """
+        with self.lock:
+            if patterns:
+                sel_machines, sel_services, sel_units = \
+                    self._select(patterns)
+            else:
+                sel_machines, sel_services, sel_units = \
+                    self.machines, self.services, self.units
+            machines = {}
+            for mid, info in self.machines.items():
+                if mid not in sel_machines:
+                    continue
+                m = self._machine_status(info)
+                host = mid.split('/')[0]
+                if host == mid:
+                    m['Containers'] = machines.get(mid, {}).get(
+                        'Containers', {})
+                    machines[mid] = m
+                else:
+                    machines[host]['Containers'][mid] = m
+            services = {}
+            for name, info in self.services.items():
+                if name not in sel_services:
+                    continue
+                services[name] = {'Charm': info['CharmURL'],
+                                  'Exposed': info['Exposed'],
+                                  'Life': info['Life'],
+                                  'Networks': {},
+                                  'Units': {},
+                                  'Relations': {}}
+            for name, info in self.units.items():
+                if name not in sel_units:
+                    continue
+                services[info['Service']]['Units'][name] = \
+                    self._unit_status(info)
+            relations = [rel for rel in self.relations.values()
+                         if any(ep['ServiceName'] in services
+                                for ep in rel['Endpoints'])]
+            for rel in relations:
+                for ep in rel['Endpoints']:
+                    if ep['ServiceName'] not in services:
+                        continue
+                    others = [o['ServiceName'] for o in rel['Endpoints']
+                              if o is not ep]
+                    services[ep['ServiceName']]['Relations'].setdefault(
+                        ep['Relation']['Name'], []).extend(others)
+            return {'EnvironmentName': 'fake',
+                    'Machines': machines,
+                    'Services': services,
+                    'Relations': relations,
+                    'Networks': {}}
+
+    # AllWatcher
+    def watch(self):
+        """ Returns a new AllWatcher id """
+        with self.lock:
+            self._next_watcher += 1
+            watcher_id = str(self._next_watcher)
+            self.watchers[watcher_id] = None
+            return watcher_id
+
+    def _snapshot_deltas(self):
+        rv = [['machine', 'change', self._public(m)]
+              for m in self.machines.values()]
+        rv += [['service', 'change', dict(s)]
+               for s in self.services.values()]
+        rv += [['unit', 'change', dict(u)] for u in self.units.values()]
+        rv += [['relation', 'change', dict(r)]
+               for r in self.relations.values()]
+        return rv
+
+    def next(self, watcher_id, timeout=None):
+        """ Blocks until there are deltas for watcher_id
+
+        The first call returns the whole environment. Later calls
+        return what changed since the previous one, latest state of
+        each entity only.
+        """
+        deadline = timeout and time.time() + timeout
+        with self.lock:
+            if watcher_id not in self.watchers:
+                raise FakeJujuError("unknown watcher id")
+            while not self.stopped and watcher_id in self.watchers:
+                self.tick()
+                cursor = self.watchers[watcher_id]
+                if cursor is None:
+                    self.watchers[watcher_id] = len(self.deltas)
+                    return self._snapshot_deltas()
+                if cursor < len(self.deltas):
+                    latest = OrderedDict()
+                    for entity, change, info in self.deltas[cursor:]:
+                        key = (entity, info.get('Id', info.get('Name',
+                                                info.get('Key'))))
+                        latest.pop(key, None)
+                        latest[key] = [entity, change, info]
+                    self.watchers[watcher_id] = len(self.deltas)
+                    return list(latest.values())
+                wait = self.next_due()
+                if wait is None:
+                    wait = 1
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return []
+                    wait = min(wait, remaining)
+                self.changed.wait(wait)
+            raise FakeJujuError("watcher was stopped")
+
+    def stop_watcher(self, watcher_id):
+        with self.lock:
+            self.watchers.pop(watcher_id, None)
+            self.changed.notify_all()
+
+    def stop(self):
+        """ Wakes up and fails blocked AllWatcher calls """
+        with self.lock:
+            self.stopped = True
+            self.changed.notify_all()
+
+
+class FakeJujuAPI:
+
+    """ Answers Juju API requests from a FakeJujuModel
+
+    :param float latency: seconds to sleep before answering each
+                          request
+    """
+
+    # requests that block, so are always answered off the socket thread
+    BLOCKING_REQUESTS = {'Next'}
+
+    def __init__(self, password='pass', latency=0, model=None):
+        self.password = password
+        self.latency = latency
+        self.model = model or FakeJujuModel()
+
+    def handle(self, req):
+        """ Returns the reply message for a decoded request """
+        if self.latency:
+            time.sleep(self.latency)
+        self.model.tick()
+        rv = dict(RequestId=req['RequestId'])
+        handler = getattr(self, 'do_' + req.get('Request', ''), None)
+        if handler is None:
+            rv['Response'] = {}
+            return rv
+        params = req.get('Params') or {}
+        if 'Id' in req:
+            params = dict(params, Id=req['Id'])
+        try:
+            rv['Response'] = handler(params)
+        except Exception as e:
+            rv['Error'] = str(e)
+            rv['ErrorCode'] = ''
+        return rv
+
+    def blocks(self, req):
+        "whether handle(req) may take a while"
+        return self.latency or req.get('Request') in self.BLOCKING_REQUESTS
+
+    def do_Login(self, params):
+        if params.get('Password') != self.password:
+            raise Exception("invalid entity name or password")
+        return {}
+
+    def do_EnvironmentInfo(self, params):
+        return {'DefaultSeries': 'trusty',
+                'ProviderType': 'local',
+                'Name': 'fake'}
+
+    def do_FullStatus(self, params):
+        return self.model.full_status(params.get('Patterns'))
+
+    def do_WatchAll(self, params):
+        return {'AllWatcherId': self.model.watch()}
+
+    def do_Next(self, params):
+        return {'Deltas': self.model.next(params.get('Id'))}
+
+    def do_Stop(self, params):
+        self.model.stop_watcher(params.get('Id'))
+        return {}
+
+    def do_AddMachines(self, params):
+        return {'Machines': self.model.add_machines(
+            params.get('MachineParams', []))}
+
+    def do_ServiceDeploy(self, params):
+        self.model.add_service(params['ServiceName'], params['CharmUrl'],
+                               params.get('NumUnits', 1),
+                               params.get('ToMachineSpec', ''),
+                               params.get('Constraints'))
+        return {}
+
+    def do_AddServiceUnits(self, params):
+        units = [self.model.add_unit(params['ServiceName'],
+                                     params.get('ToMachineSpec', ''))
+                 for _ in range(params.get('NumUnits', 1))]
+        return {'Units': units}
+
+    def do_AddRelation(self, params):
+        return {'Endpoints': self.model.add_relation(*params['Endpoints'])}
+
+    def do_SetAnnotations(self, params):
+        self.model.set_annotations(params['Tag'], params.get('Pairs', {}))
+        return {}
+
+    def do_GetAnnotations(self, params):
+        return {'Annotations': self.model.get_annotations(params['Tag'])}
+
+    def do_CharmInfo(self, params):
+        return {'URL': params.get('CharmURL'), 'Meta': {}, 'Config': {}}
+
+
+class FakeJujuWebSocket(WebSocket):
+
+    api = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send_lock = threading.Lock()
+
+    def received_message(self, m):
+        req = json.loads(m.data.decode('utf-8'))
+        # the server runs every socket's handlers on one thread, so
+        # anything slow is answered from its own thread instead
+        if self.api.blocks(req):
+            threading.Thread(target=self.reply, args=(req,),
+                             daemon=True).start()
+        else:
+            self.reply(req)
+
+    def reply(self, req):
+        rv = json.dumps(self.api.handle(req))
+        with self.send_lock:
+            if not self.terminated:
+                self.send(rv)
+
+
+class FakeJujuServer:
+
+    """ Serves a FakeJujuAPI over ws:// on a background thread
+
+    Use port 0 to pick a free port, then connect to server.url.
+    """
+
+    def __init__(self, api=None, host='127.0.0.1', port=0):
+        self.api = api or FakeJujuAPI()
+        handler_cls = type('BoundFakeJujuWebSocket',
+                           (FakeJujuWebSocket,), dict(api=self.api))
+        self.server = make_server(
+            host, port, server_class=WSGIServer,
+            handler_class=WebSocketWSGIRequestHandler,
+            app=WebSocketWSGIApplication(protocols=['https-only'],
+                                         handler_cls=handler_cls))
+        self.server.initialize_websockets_manager()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'ws://{}:{}/'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.api.model.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake juju api server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=17070)
+    parser.add_argument('--password', default='pass')
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds to wait before each reply")
+    parser.add_argument('--machines', type=int, default=0,
+                        help="machines to create up front")
+    parser.add_argument('--units', type=int, default=0,
+                        help="units to spread over those machines")
+    parser.add_argument('--services', type=int, default=None,
+                        help="services the units belong to "
+                             "(default: units / 100)")
+    parser.add_argument('--pending', action='store_true',
+                        help="start the initial machines and units "
+                             "pending rather than started")
+    parser.add_argument('--provision-time', type=float, default=5,
+                        help="seconds for a new machine to start")
+    parser.add_argument('--start-time', type=float, default=10,
+                        help="seconds for a unit to start once its "
+                             "machine is up")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="fraction of units that fail")
+    parser.add_argument('--seed', type=int, default=None)
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model = FakeJujuModel(provision_time=opts.provision_time,
+                          start_time=opts.start_time,
+                          error_rate=opts.error_rate, seed=opts.seed)
+    model.populate(opts.machines, opts.units, opts.services,
+                   started=not opts.pending)
+    api = FakeJujuAPI(opts.password, opts.latency, model)
+    server = FakeJujuServer(api, opts.host, opts.port)
+    log.info("serving {} machines, {} units on {}".format(
+        len(model.machines), len(model.units), server.url))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,535 @@
+#
+# fakemaasapi.py - local fake MAAS API HTTP server
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Fake MAAS API server
+
+Serves the subset of the MAAS 1.0 REST API that maasclient uses (node
+listing and lifecycle operations, tags, zones) from an in-memory set of
+nodes, over keep-alive HTTP/1.1, so MaasClient and MaasState can be
+exercised by tests and benchmarks without a MAAS region controller.
+
+Accepted nodes go through a simulated commissioning step, from NEW to
+COMMISSIONING to READY. The server counts the connections and requests
+it sees, and can be told to fail requests, for testing retries.
+
+(test/fakemaas/ is unrelated: it holds canned data for FAKE_API_DATA.)
+
+Run it standalone:
+
+    python3 test/fakemaasapi.py --port 5240 --nodes 500
+"""
+
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from bson import dumps as bson_dumps
+except ImportError:
+    # python3-bson, from pymongo
+    from bson import BSON
+    bson_dumps = BSON.encode
+
+log = logging.getLogger('fakemaasapi')
+
+API_PATH = '/MAAS/api/1.0'
+
+NEW = 0
+COMMISSIONING = 1
+READY = 4
+ALLOCATED = 6
+
+
+class FakeMaasError(Exception):
+
+    "Returned to the client as an HTTP error"
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class FakeMaasModel:
+
+    """ In-memory MAAS nodes and tags
+
+    :param float commission_time: seconds a node spends commissioning
+    """
+
+    def __init__(self, commission_time=0):
+        self.commission_time = commission_time
+        self.lock = threading.RLock()
+        self.nodes = OrderedDict()
+        self.tags = OrderedDict()
+        self.zones = OrderedDict(default={'name': 'default',
+                                          'description': ''})
+        # system_id -> time it finishes commissioning
+        self._commissioning = {}
+
+    def add_node(self, status=NEW, **fields):
+        with self.lock:
+            n = len(self.nodes)
+            system_id = fields.pop('system_id',
+                                   'node-{:05d}'.format(n))
+            node = {'system_id': system_id,
+                    'hostname': '{}.maas'.format(system_id),
+                    'resource_uri': '{}/nodes/{}/'.format(API_PATH,
+                                                          system_id),
+                    'architecture': 'amd64/generic',
+                    'cpu_count': 2 + n % 8,
+                    'memory': 2048 * (1 + n % 4),
+                    'storage': 40960 * (1 + n % 3),
+                    'status': status,
+                    'owner': None,
+                    'power_type': 'virsh',
+                    'tag_names': [],
+                    'zone': {'name': 'default'},
+                    'ip_addresses': [],
+                    'macaddress_set': [
+                        {'mac_address': '52:54:00:{:02x}:{:02x}:{:02x}'
+                         .format(n >> 16 & 255, n >> 8 & 255, n & 255)}]}
+            node.update(fields)
+            self.nodes[system_id] = node
+            return node
+
+    def populate(self, n_nodes, status=READY):
+        for _ in range(n_nodes):
+            self.add_node(status)
+
+    def lshw(self, node):
+        """ lshw -xml output for a node, as commissioning collects """
+        # varies the hardware between nodes
+        n = sum(map(ord, node['system_id']))
+        flags = ['fpu', 'vme', 'sse', 'sse2', 'lm']
+        if n % 2:
+            flags.append('vmx')
+        cpus = ''.join(
+            '<node id="cpu:{i}" class="processor"{disabled}>'
+            '<product>Fake CPU @ 2.40GHz</product>'
+            '<capabilities>{caps}</capabilities></node>'.format(
+                i=i, disabled=' disabled="true"' if i >= 1 + n % 2 else '',
+                caps=''.join('<capability id="{}" />'.format(f)
+                             for f in flags))
+            for i in range(2))
+        disks = ''.join(
+            '<node id="disk:{i}" class="disk">'
+            '<logicalname>/dev/sd{letter}</logicalname>'
+            '<product>FAKEDISK</product><serial>SN{n}{i}</serial>'
+            '<size units="bytes">{size}</size></node>'.format(
+                i=i, letter='abcd'[i], n=n,
+                size=node['storage'] * 1024 * 1024)
+            for i in range(1 + n % 3))
+        nics = ''.join(
+            '<node id="network:{i}" class="network">'
+            '<logicalname>eth{i}</logicalname><vendor>Fake</vendor>'
+            '<product>FakeNIC</product><serial>{mac}</serial>'
+            '<capacity units="bit/s">1000000000</capacity></node>'.format(
+                i=i, mac=m['mac_address'])
+            for i, m in enumerate(node['macaddress_set']))
+        return ('<?xml version="1.0" standalone="yes" ?><list>'
+                '<node id="{}" class="system"><node id="core" class="bus">'
+                '{}<node id="cdrom" class="disk"><logicalname>/dev/cdrom'
+                '</logicalname></node>{}{}</node></node></list>').format(
+                    node['hostname'], cpus, disks, nics).encode('utf-8')
+
+    def details(self, system_id):
+        node = self.node(system_id)
+        return bson_dumps({'lshw': self.lshw(node), 'lldp': b'<lldp />'})
+
+    def tick(self):
+        """ Finishes commissioning that's due """
+        now = time.time()
+        with self.lock:
+            for system_id, t in list(self._commissioning.items()):
+                if t <= now:
+                    del self._commissioning[system_id]
+                    self.nodes[system_id]['status'] = READY
+
+    def node(self, system_id):
+        try:
+            return self.nodes[system_id]
+        except KeyError:
+            raise FakeMaasError("Not Found", 404)
+
+    def _commission(self, node):
+        node['status'] = COMMISSIONING
+        self._commissioning[node['system_id']] = \
+            time.time() + self.commission_time
+
+    # nodes
+    def list_nodes(self, params):
+        with self.lock:
+            nodes = list(self.nodes.values())
+        ids = params.get('id')
+        if ids:
+            nodes = [n for n in nodes if n['system_id'] in ids]
+        hostnames = params.get('hostname')
+        if hostnames:
+            nodes = [n for n in nodes if n['hostname'] in hostnames]
+        zone = params.get('zone')
+        if zone:
+            nodes = [n for n in nodes if n['zone']['name'] == zone[0]]
+        return nodes
+
+    def tag_nodes(self, name):
+        with self.lock:
+            if name not in self.tags:
+                raise FakeMaasError("Not Found", 404)
+            return [n for n in self.nodes.values()
+                    if name in n['tag_names']]
+
+    def accept_all(self):
+        with self.lock:
+            accepted = [n for n in self.nodes.values()
+                        if n['status'] == NEW]
+            for n in accepted:
+                self._commission(n)
+            return accepted
+
+    def accept(self, system_ids):
+        with self.lock:
+            accepted = [self.nodes[i] for i in system_ids
+                        if i in self.nodes and
+                        self.nodes[i]['status'] == NEW]
+            for n in accepted:
+                self._commission(n)
+            return accepted
+
+    def acquire(self, params):
+        with self.lock:
+            for n in self.nodes.values():
+                if n['status'] == READY:
+                    n['status'] = ALLOCATED
+                    n['owner'] = 'root'
+                    return n
+        raise FakeMaasError("No matching node is available.", 409)
+
+    def node_op(self, system_id, op):
+        with self.lock:
+            node = self.node(system_id)
+            if op == 'commission':
+                self._commission(node)
+            elif op == 'release':
+                node['status'] = READY
+                node['owner'] = None
+            elif op == 'start':
+                if node['status'] != ALLOCATED:
+                    raise FakeMaasError("Node isn't allocated", 409)
+            elif op != 'stop':
+                raise FakeMaasError("Unknown op {}".format(op))
+            return node
+
+    def delete_node(self, system_id):
+        with self.lock:
+            self.node(system_id)
+            del self.nodes[system_id]
+
+    # tags
+    def new_tag(self, name):
+        with self.lock:
+            if name in self.tags:
+                raise FakeMaasError("Tag with this Name already exists.")
+            tag = self.tags[name] = {'name': name, 'definition': '',
+                                     'comment': ''}
+            return tag
+
+    def update_tag_nodes(self, name, add, remove):
+        with self.lock:
+            if name not in self.tags:
+                raise FakeMaasError("Not Found", 404)
+            added = removed = 0
+            for system_id in add:
+                tags = self.node(system_id)['tag_names']
+                if name not in tags:
+                    tags.append(name)
+                    added += 1
+            for system_id in remove:
+                tags = self.node(system_id)['tag_names']
+                if name in tags:
+                    tags.remove(name)
+                    removed += 1
+            return {'added': added, 'removed': removed}
+
+    def delete_tag(self, name):
+        with self.lock:
+            if self.tags.pop(name, None) is None:
+                raise FakeMaasError("Not Found", 404)
+            for n in self.nodes.values():
+                if name in n['tag_names']:
+                    n['tag_names'].remove(name)
+
+
+class FakeMaasAPI:
+
+    """ Answers MAAS API requests from a FakeMaasModel
+
+    :param float latency: seconds to sleep before answering each
+                          request
+    """
+
+    def __init__(self, latency=0, model=None):
+        self.latency = latency
+        self.model = model or FakeMaasModel()
+        self.lock = threading.Lock()
+        self.connections = 0
+        # (method, path with ids replaced by '*', op) -> count
+        self.requests = Counter()
+        # [(method, status)] for the next requests with that method
+        self._failures = []
+
+    ROUTES = [
+        ('GET', r'/nodes/', 'nodes_get'),
+        ('POST', r'/nodes/', 'nodes_post'),
+        ('GET', r'/nodes/(?P<system_id>[^/]+)/?', 'node_get'),
+        ('POST', r'/nodes/(?P<system_id>[^/]+)/?', 'node_post'),
+        ('DELETE', r'/nodes/(?P<system_id>[^/]+)/?', 'node_delete'),
+        ('GET', r'/tags/', 'tags_get'),
+        ('POST', r'/tags/', 'tags_post'),
+        ('GET', r'/tags/(?P<name>[^/]+)/?', 'tag_get'),
+        ('POST', r'/tags/(?P<name>[^/]+)/?', 'tag_post'),
+        ('DELETE', r'/tags/(?P<name>[^/]+)/?', 'tag_delete'),
+        ('GET', r'/zones/', 'zones_get'),
+        ('GET', r'/users/', 'users_get'),
+    ]
+
+    def fail(self, method, status=503, count=1):
+        """ Makes the next count requests with method return status """
+        with self.lock:
+            self._failures.extend([(method, status)] * count)
+
+    def _failure(self, method):
+        with self.lock:
+            for i, (m, status) in enumerate(self._failures):
+                if m == method:
+                    del self._failures[i]
+                    return status
+        return None
+
+    def handle(self, method, path, params):
+        """ Returns (HTTP status, body) for a request
+
+        :param dict params: query or form parameters, each a list
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        self.model.tick()
+        op = (params.get('op') or [None])[0]
+        for route_method, pattern, name in self.ROUTES:
+            if route_method != method:
+                continue
+            m = re.fullmatch(pattern, path)
+            if m:
+                break
+        else:
+            return 404, "Not Found"
+        with self.lock:
+            self.requests[(method, re.sub(r'\(.*\)/\?', '*/', pattern),
+                           op)] += 1
+        status = self._failure(method)
+        if status:
+            return status, "Injected failure"
+        try:
+            return 200, getattr(self, name)(op, params, **m.groupdict())
+        except FakeMaasError as e:
+            return e.status, str(e)
+
+    def nodes_get(self, op, params):
+        return self.model.list_nodes(params)
+
+    def nodes_post(self, op, params):
+        if op == 'accept_all':
+            return self.model.accept_all()
+        if op == 'accept':
+            return self.model.accept(params.get('nodes', []))
+        if op == 'acquire':
+            return self.model.acquire(params)
+        raise FakeMaasError("Unknown op {}".format(op))
+
+    def node_get(self, op, params, system_id):
+        if op == 'details':
+            return self.model.details(system_id)
+        return self.model.node(system_id)
+
+    def node_post(self, op, params, system_id):
+        return self.model.node_op(system_id, op)
+
+    def node_delete(self, op, params, system_id):
+        self.model.delete_node(system_id)
+        return ''
+
+    def tags_get(self, op, params):
+        return list(self.model.tags.values())
+
+    def tags_post(self, op, params):
+        return self.model.new_tag(params['name'][0])
+
+    def tag_get(self, op, params, name):
+        if op != 'nodes':
+            raise FakeMaasError("Unknown op {}".format(op))
+        return self.model.tag_nodes(name)
+
+    def tag_post(self, op, params, name):
+        if op != 'update_nodes':
+            raise FakeMaasError("Unknown op {}".format(op))
+        return self.model.update_tag_nodes(name, params.get('add', []),
+                                           params.get('remove', []))
+
+    def tag_delete(self, op, params, name):
+        self.model.delete_tag(name)
+        return ''
+
+    def zones_get(self, op, params):
+        return list(self.model.zones.values())
+
+    def users_get(self, op, params):
+        return [{'username': 'root', 'is_superuser': True}]
+
+
+class FakeMaasRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes; without this, Nagle
+    # and delayed ACKs stall every reply on a kept-alive connection
+    disable_nagle_algorithm = True
+    api = None
+
+    def setup(self):
+        super().setup()
+        with self.api.lock:
+            self.api.connections += 1
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            params.update(parse_qs(body))
+        path = url.path
+        if not path.startswith(API_PATH):
+            status, rv = 404, "Not Found"
+        elif 'oauth_consumer_key' not in params and \
+                'Authorization' not in self.headers:
+            status, rv = 401, "Unauthorised"
+        else:
+            status, rv = self.api.handle(method, path[len(API_PATH):],
+                                         params)
+        if isinstance(rv, bytes):
+            data = rv
+            content_type = 'application/bson'
+        elif isinstance(rv, str):
+            data = rv.encode('utf-8')
+            content_type = 'text/plain'
+        else:
+            data = json.dumps(rv).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out hang up before the reply is written
+        log.debug("error serving {}".format(client_address),
+                  exc_info=True)
+
+
+class FakeMaasServer:
+
+    """ Serves a FakeMaasAPI over http:// on a background thread
+
+    Use port 0 to pick a free port, then point MaasAuth at
+    server.api_url.
+    """
+
+    def __init__(self, api=None, host='127.0.0.1', port=0):
+        self.api = api or FakeMaasAPI()
+        handler_cls = type('BoundFakeMaasRequestHandler',
+                           (FakeMaasRequestHandler,), dict(api=self.api))
+        self.server = ThreadingHTTPServer((host, port), handler_cls)
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, API_PATH)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake maas api server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5240)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds to wait before each reply")
+    parser.add_argument('--nodes', type=int, default=0,
+                        help="nodes to create up front")
+    parser.add_argument('--new', action='store_true',
+                        help="start the nodes NEW rather than READY")
+    parser.add_argument('--commission-time', type=float, default=5,
+                        help="seconds for an accepted node to commission")
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    model = FakeMaasModel(commission_time=opts.commission_time)
+    model.populate(opts.nodes, NEW if opts.new else READY)
+    server = FakeMaasServer(FakeMaasAPI(opts.latency, model),
+                            opts.host, opts.port)
+    log.info("serving {} nodes on {}".format(len(model.nodes),
+                                             server.api_url))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ import pkgutil
 import unittest
 from unittest.mock import ANY, MagicMock, patch
 
+from macumba import ServerError
 import cloudinstall.utils as utils
 import cloudinstall.charms
 from cloudinstall.charms import CharmBase, CharmQueue
@@ -150,7 +151,9 @@ class TestCharmRelations(unittest.TestCase):
         """ Verifies watch_relations croaks on failed add_relation """
         juju = self.mock_jujuclient
 
-        juju.add_relation.side_effect = Exception('Failed to add relations')
+        err = ServerError('Failed to add relations', {})
+        juju.add_relations.return_value = [
+            (None, err) for _ in self.expected_relation]
 
         charm_q = CharmQueue(
             ui=self.mock_ui,
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# tests cloudinstall/constraints.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from cloudinstall.constraints import (MachineTable, compile_constraints)
+from cloudinstall.maas import MaasMachine, satisfies
+
+
+class MachineTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        nodes = [{'memory': 1024 * (1 + i % 8),
+                  'storage': 10240 * (1 + i % 5),
+                  'cpu_count': 1 + i % 6,
+                  'architecture': ['amd64', 'armhf'][i % 2]}
+                 for i in range(40)]
+        nodes.append({'memory': '*', 'storage': '*', 'cpu_count': '*',
+                      'architecture': '*'})
+        nodes.append({'memory': None, 'storage': 'N/A', 'cpu_count': 2,
+                      'architecture': 'amd64'})
+        self.machines = [MaasMachine(str(i), n)
+                         for i, n in enumerate(nodes)]
+        self.table = MachineTable(self.machines)
+        self.constraints = [{},
+                            {'mem': 4096},
+                            {'mem': '4G', 'root-disk': '20G'},
+                            {'arch': 'armhf', 'cpu_cores': 3},
+                            {'storage': 30720, 'arch': 'amd64',
+                             'mem': '2048'}]
+
+    def test_matches_satisfies(self):
+        for cons in self.constraints:
+            result = self.table.evaluate(cons)
+            for m in self.machines[:-1]:
+                sat, failed = satisfies(m, cons)
+                self.assertEqual(result.satisfied(m), sat, (m, cons))
+                self.assertEqual(result.failures(m), failed, (m, cons))
+
+    def test_wildcard_and_unknown(self):
+        result = self.table.evaluate({'mem': 1, 'arch': 'armhf'})
+        self.assertTrue(result.satisfied(self.machines[40]))
+        self.assertEqual(result.failures(self.machines[41]),
+                         ['mem', 'arch'])
+
+    def test_masks_cached(self):
+        a = self.table.evaluate({'mem': '4G'})
+        self.assertIs(self.table.evaluate({'mem': '4G'}), a)
+        self.assertIs(self.table.evaluate(compile_constraints(
+            {'mem': '4G'})), a)
+        self.assertEqual(a.count(), len(a.machines()))
+        self.assertEqual(a.count(), 5 * 5 + 1)
+
+    def test_not_in_table(self):
+        other = MaasMachine('x', {'memory': 8192, 'storage': 0,
+                                  'cpu_count': 1, 'architecture': 'amd64'})
+        result = self.table.evaluate({'mem': '4G', 'root-disk': 1})
+        self.assertTrue(result.satisfied(self.machines[3]))
+        self.assertEqual(result.failures(other), ['root-disk'])
+
+    def test_for_machines(self):
+        t = MachineTable.for_machines(self.machines)
+        self.assertIs(MachineTable.for_machines(list(self.machines)), t)
+        self.assertIsNot(MachineTable.for_machines(self.machines[1:]), t)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -72,3 +72,44 @@ class WaitForDeployedServicesReadyCoreTestCase(unittest.TestCase):
             self.dc.wait_for_deployed_services_ready()
         print(mock_sleep.mock_calls)
         self.assertEqual(len(mock_sleep.mock_calls), 2)
+
+
+class WarmStartCoreTestCase(unittest.TestCase):
+
+    """ Tests that connecting after a warm start leaves the controller's
+    state to the UI loop
+    """
+
+    def setUp(self):
+        self.conf = Config({}, save_backups=False)
+        self.mock_ui = MagicMock(name='ui')
+        self.mock_loop = MagicMock(name='loop')
+        self.dc = Controller(ui=self.mock_ui, config=self.conf,
+                             loop=self.mock_loop)
+        self.cached_state = MagicMock(name='cached juju state')
+        self.dc.juju_state = self.cached_state
+        self.juju, self.juju_state = MagicMock(), MagicMock()
+        self.dc.connect_juju = MagicMock(return_value=(self.juju,
+                                                       self.juju_state))
+        self.dc.initialize_placement = MagicMock()
+
+    def test_swapped_in_on_ui_loop(self):
+        with patch('cloudinstall.core.atexit'):
+            self.dc.initialize_after_warm_start()
+            self.assertIs(self.dc.juju_state, self.cached_state)
+            self.assertFalse(self.dc.initialize_placement.called)
+            self.juju_state.status.assert_called_once_with()
+
+            (connected,), _ = self.mock_loop.call_from_thread.call_args
+            connected()
+        self.assertIs(self.dc.juju_state, self.juju_state)
+        self.assertIs(self.dc.juju, self.juju)
+        self.dc.initialize_placement.assert_called_once_with()
+
+    def test_errors_shown(self):
+        self.dc.initialize_placement.side_effect = Exception("no")
+        with patch('cloudinstall.core.atexit'):
+            self.dc.initialize_after_warm_start()
+            (connected,), _ = self.mock_loop.call_from_thread.call_args
+            connected()
+        self.assertTrue(self.mock_ui.show_exception_message.called)
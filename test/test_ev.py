@@ -15,7 +15,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import logging
+import threading
 import unittest
 import urwid
 from unittest.mock import MagicMock, ANY
@@ -84,6 +86,18 @@ class EventLoopCoreTestCase(unittest.TestCase):
         dc.update(self.conf.node_install_wait_interval, ANY)
         self.mock_loop.set_alarm_in.assert_called_once_with(1, ANY)
 
+    def test_call_from_thread(self):
+        """ Validate callbacks from worker threads run on the loop """
+        ev = self.make_ev()
+        ran = []
+        t = threading.Thread(target=ev.call_from_thread,
+                             args=(lambda: ran.append(1),))
+        t.start()
+        t.join()
+        self.assertEqual(ran, [])
+        ev._aloop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(ran, [1])
+
     def test_validate_exit(self):
         """ Validate error code set with eventloop """
         ev = self.make_ev()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# tests test/fakejuju.py, and JujuWatcher against it
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import unittest
+
+from cloudinstall.juju import JujuState
+from macumba import JujuClient
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fakejuju import FakeJujuAPI, FakeJujuModel, FakeJujuServer  # noqa
+
+
+class FakeJujuTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeJujuModel(provision_time=0.05, start_time=0.05,
+                                   seed=1)
+        self.server = FakeJujuServer(FakeJujuAPI(model=self.model)).start()
+        self.juju = JujuClient(url=self.server.url, password='pass')
+        self.juju.login()
+
+    def tearDown(self):
+        self.juju.close()
+        self.server.stop()
+
+    def _wait_for(self, cond, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            if cond():
+                return True
+            time.sleep(0.02)
+        return False
+
+    def _all_started(self):
+        status = self.juju.status()
+        units = [u for s in status['Services'].values()
+                 for u in s['Units'].values()]
+        return all(u['AgentState'] == 'started' for u in units)
+
+    def test_deploy_lifecycle(self):
+        rv = self.juju.add_machines([self.juju.machine_params()] * 2)
+        mids = [m['Machine'] for m in rv['Machines']]
+        self.assertEqual(mids, ['1', '2'])
+        self.juju.set_annotations_many('machine', [(m, {'instance_id': m})
+                                                   for m in mids])
+        self.assertEqual(self.juju.get_annotations('1', 'machine'),
+                         {'Annotations': {'instance_id': '1'}})
+
+        self.juju.call(self.juju._deploy_params('cs:trusty/mysql-1',
+                                                'mysql', 1,
+                                                machine_spec='lxc:1'))
+        self.juju.call(self.juju._deploy_params('cs:trusty/keystone-1',
+                                                'keystone', 0))
+        self.juju.add_units('keystone', ['2', 'lxc:2'])
+        results = self.juju.add_relations([('keystone', 'mysql')] * 2)
+        self.assertTrue(all(err is None for _, err in results))
+
+        status = self.juju.status()
+        self.assertEqual(status['Services']['mysql']['Units']['mysql/0']
+                         ['AgentState'], 'pending')
+        self.assertIn('1/lxc/0', status['Machines']['1']['Containers'])
+        self.assertEqual(status['Services']['keystone']['Relations'],
+                         {'mysql': ['mysql']})
+
+        self.assertTrue(self._wait_for(self._all_started))
+        status = self.juju.status()
+        self.assertEqual(status['Machines']['2']['AgentState'], 'started')
+        self.assertEqual(len(status['Services']['keystone']['Units']), 2)
+
+    def test_watcher_mirrors_full_status(self):
+        self.model.populate(10, 30, 3, started=False)
+        state = JujuState(self.juju, use_watcher=True)
+        self.assertTrue(self._wait_for(self._all_started))
+        self.assertTrue(self._wait_for(
+            lambda: all(u.agent_state == 'started'
+                        for s in state.services for u in s.units)))
+
+        status = self.juju.status()
+        mirror = state.watcher.status()
+        self.assertEqual(sorted(mirror['Machines']),
+                         sorted(status['Machines']))
+        for name, svc in status['Services'].items():
+            self.assertEqual(mirror['Services'][name]['Units'],
+                             svc['Units'])
+            self.assertEqual(mirror['Services'][name]['Relations'],
+                             svc['Relations'])
+
+        # stopping wakes the thread blocked in Next
+        state.watcher.stop()
+        state.watcher._thread.join(5)
+        self.assertFalse(state.watcher.is_running)
+
+    def test_status_patterns(self):
+        self.model.populate(4, 8, 2)
+        status = self.juju.status(patterns=['svc-1'])
+        self.assertEqual(list(status['Services']), ['svc-1'])
+        self.assertEqual(sorted(status['Services']['svc-1']['Units']),
+                         ['svc-1/0', 'svc-1/1', 'svc-1/2', 'svc-1/3'])
+        self.assertEqual(sorted(status['Machines']), ['2', '4'])
+        self.assertEqual(status['Services']['svc-1']['Relations'],
+                         {'svc-0': ['svc-0']})
+
+        status = self.juju.status(patterns=['3'])
+        self.assertEqual(list(status['Machines']), ['3'])
+        self.assertEqual(sorted(status['Services']), ['svc-0'])
+
+    def test_populate_size(self):
+        model = FakeJujuModel()
+        model.populate(1000, 5000)
+        status = model.full_status()
+        self.assertEqual(len(status['Machines']), 1001)
+        self.assertEqual(sum(len(s['Units'])
+                             for s in status['Services'].values()), 5000)
@@ -16,11 +16,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock, PropertyMock
+from unittest.mock import MagicMock, PropertyMock, patch
 
 from cloudinstall.config import Config
-from cloudinstall.juju import JujuState
+from cloudinstall.juju import (JujuState, JujuStatusChanges,
+                               JujuStatusSnapshot, JujuWatcher)
 from cloudinstall.service import Service
 
 log = logging.getLogger('cloudinstall.test_core')
@@ -58,20 +61,441 @@ class JujuStateTestCase(unittest.TestCase):
     def test_services_ready(self):
         """ Verifies all ready services  """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_ready)
-        type(juju_state).services = services
-
-        not_ready = [(a, b) for a, b in juju_state.get_agent_states()
-                     if b != 'started']
+        with patch.object(JujuState, 'services', new_callable=PropertyMock,
+                          return_value=self.services_ready):
+            not_ready = [(a, b) for a, b in juju_state.get_agent_states()
+                         if b != 'started']
 
         self.assertEqual(len(not_ready), 0)
 
     def test_some_services_ready(self):
         """ Verifies some ready services == not_ready list """
         juju_state = JujuState(juju=MagicMock())
-        services = PropertyMock(return_value=self.services_some_ready)
-        type(juju_state).services = services
-        not_ready = [(a, b) for a, b in juju_state.get_agent_states()
-                     if b != 'started']
-        self.assertEqual(len(not_ready), 2)
-        self.assertFalse(juju_state.all_agents_started())
+        with patch.object(JujuState, 'services', new_callable=PropertyMock,
+                          return_value=self.services_some_ready):
+            not_ready = [(a, b) for a, b in juju_state.get_agent_states()
+                         if b != 'started']
+            self.assertEqual(len(not_ready), 2)
+            self.assertFalse(juju_state.all_agents_started())
+
+
+class JujuWatcherTestCase(unittest.TestCase):
+
+    """ Tests the AllWatcher-driven status mirror
+    """
+
+    def setUp(self):
+        self.watcher = JujuWatcher(juju=MagicMock())
+        # as if start() had been called
+        self.watcher._thread = MagicMock(name='thread')
+        self.watcher.apply([
+            ['machine', 'change', {'Id': '1', 'InstanceId': 'i-1',
+                                   'Status': 'started',
+                                   'HardwareCharacteristics':
+                                   {'Arch': 'amd64', 'CpuCores': 2}}],
+            ['machine', 'change', {'Id': '1/lxc/0', 'Status': 'pending'}],
+            ['service', 'change', {'Name': 'keystone',
+                                   'CharmURL': 'cs:trusty/keystone-1'}],
+            ['service', 'change', {'Name': 'mysql',
+                                   'CharmURL': 'cs:trusty/mysql-1'}],
+            ['unit', 'change', {'Name': 'keystone/0',
+                                'Service': 'keystone',
+                                'MachineId': '1/lxc/0',
+                                'Status': 'pending'}],
+            ['relation', 'change',
+             {'Key': 'keystone:shared-db mysql:shared-db',
+              'Endpoints': [{'ServiceName': 'keystone',
+                             'Relation': {'Name': 'shared-db'}},
+                            {'ServiceName': 'mysql',
+                             'Relation': {'Name': 'shared-db'}}]}]])
+        self.juju_state = JujuState(juju=MagicMock())
+        self.juju_state.watcher = self.watcher
+
+    def test_initial_state(self):
+        m = self.juju_state.machine('1')
+        self.assertEqual(m.instance_id, 'i-1')
+        self.assertEqual(m.arch, 'amd64')
+        self.assertEqual(m.cpu_cores, '2')
+        c = self.juju_state.machine_or_container('1/lxc/0')
+        self.assertEqual(c.agent_state, 'pending')
+        ks = self.juju_state.service('keystone')
+        self.assertEqual(ks.unit('keystone/0').machine_id, '1/lxc/0')
+        self.assertEqual(ks.relation('shared-db').charms, ['mysql'])
+        self.assertFalse(self.juju_state.juju.status.called)
+
+    def test_deltas_update_state(self):
+        before = self.watcher.status()
+        self.watcher.apply([
+            ['unit', 'change', {'Name': 'keystone/0',
+                                'Service': 'keystone',
+                                'MachineId': '1/lxc/0',
+                                'Status': 'started'}],
+            ['service', 'remove', {'Name': 'mysql'}]])
+        self.assertTrue(self.juju_state.all_agents_started())
+        self.assertEqual(len(self.juju_state.services), 1)
+        # earlier snapshots are left alone
+        self.assertIn('mysql', before['Services'])
+
+    def test_machine_removed(self):
+        self.watcher.apply([['machine', 'remove', {'Id': '1/lxc/0'}]])
+        self.assertIsNone(self.juju_state.machine_or_container('1/lxc/0'))
+        self.watcher.apply([['machine', 'remove', {'Id': '1'}]])
+        self.assertEqual(self.juju_state.machines(), [])
+
+    def test_subordinate_units(self):
+        self.watcher.apply([
+            ['service', 'change', {'Name': 'ntp', 'Subordinate': True}],
+            ['relation', 'change',
+             {'Key': 'keystone:juju-info ntp:juju-info',
+              'Endpoints': [{'ServiceName': 'keystone',
+                             'Relation': {'Name': 'juju-info',
+                                          'Scope': 'container'}},
+                            {'ServiceName': 'ntp',
+                             'Relation': {'Name': 'juju-info',
+                                          'Scope': 'container'}}]}],
+            ['unit', 'change', {'Name': 'ntp/0', 'Service': 'ntp',
+                                'MachineId': '1/lxc/0',
+                                'Subordinate': True,
+                                'Status': 'started'}]])
+        status = self.watcher.status()
+        ntp = status['Services']['ntp']
+        self.assertEqual(ntp['Units'], {})
+        self.assertEqual(ntp['SubordinateTo'], ['keystone'])
+        ks0 = status['Services']['keystone']['Units']['keystone/0']
+        self.assertEqual(ks0['Subordinates']['ntp/0']['AgentState'],
+                         'started')
+        # kept when the principal changes, dropped with the subordinate
+        self.watcher.apply([['unit', 'change',
+                             {'Name': 'keystone/0', 'Service': 'keystone',
+                              'MachineId': '1/lxc/0',
+                              'Status': 'started'}]])
+        ks0 = self.watcher.status()['Services']['keystone']['Units'][
+            'keystone/0']
+        self.assertIn('ntp/0', ks0['Subordinates'])
+        self.watcher.apply([['unit', 'remove',
+                             {'Name': 'ntp/0', 'Service': 'ntp'}]])
+        ks0 = self.watcher.status()['Services']['keystone']['Units'][
+            'keystone/0']
+        self.assertNotIn('Subordinates', ks0)
+
+    def test_error_states(self):
+        self.watcher.apply([
+            ['machine', 'change', {'Id': '2', 'Status': 'error',
+                                   'StatusInfo': 'no matching node'}],
+            ['unit', 'change', {'Name': 'keystone/0',
+                                'Service': 'keystone',
+                                'MachineId': '1/lxc/0',
+                                'Status': 'error',
+                                'StatusInfo': 'hook failed: "install"',
+                                'WorkloadStatus': {'Current': 'error'}}]])
+        m = self.juju_state.machine('2')
+        self.assertEqual(m.agent_state, 'error')
+        self.assertEqual(m.agent_state_info, 'no matching node')
+        self.assertEqual(m.agent['Status'], 'error')
+        self.assertIsNone(m.err)
+        unit = self.juju_state.service('keystone').unit('keystone/0')
+        self.assertEqual(unit.agent_state, 'error')
+        self.assertEqual(unit.agent_state_info, 'hook failed: "install"')
+        self.assertEqual(unit.workload_state, 'error')
+        self.assertEqual(unit.unit['Agent']['Info'],
+                         'hook failed: "install"')
+
+    def test_stop_ends_blocking_next(self):
+        self.watcher.watcher_id = '1'
+        self.watcher.stop()
+        self.watcher.juju.stop_watcher.assert_called_once_with('1')
+        self.assertFalse(self.watcher.synced.is_set())
+
+    def test_failed_apply_falls_back(self):
+        juju = MagicMock()
+        juju.status.return_value = {'Machines': {}, 'Services': {},
+                                    'Networks': {}}
+        juju.get_watcher.return_value = {'AllWatcherId': '1'}
+        # a unit delta with no name
+        juju.get_watched_tasks.return_value = {
+            'Deltas': [['unit', 'change', {'Service': 'mysql'}]]}
+        watcher = JujuWatcher(juju)
+        watcher.start()
+        watcher._thread.join(5)
+        self.assertFalse(watcher.is_running)
+        self.assertFalse(watcher.current)
+
+        juju_state = JujuState(juju=juju)
+        juju_state.watcher = watcher
+        watcher.synced.set()
+        juju.status.reset_mock()
+        self.assertEqual(juju_state.status()['Services'], {})
+        self.assertEqual(juju.status.call_count, 1)
+
+
+class JujuStateFilteredStatusTestCase(unittest.TestCase):
+
+    """ Tests narrow status queries
+    """
+
+    def setUp(self):
+        self.full = {'Machines': {'1': {'InstanceId': 'i-1'}},
+                     'Services': {'keystone': {'Units': {}},
+                                  'mysql': {'Units': {}}}}
+        self.narrow = {'Machines': {},
+                       'Services': {'keystone': {'Units': {}}}}
+        self.juju = MagicMock()
+        self.juju_state = JujuState(juju=self.juju)
+
+    def test_service_fetches_only_matching(self):
+        self.juju.status.return_value = self.narrow
+        self.assertTrue(self.juju_state.has_service('keystone'))
+        self.juju_state.service('keystone')
+        self.juju.status.assert_called_once_with(patterns=['keystone'])
+
+        self.juju_state.invalidate_status_cache()
+        self.juju_state.service('keystone')
+        self.assertEqual(self.juju.status.call_count, 2)
+
+    def test_uses_fresh_full_status(self):
+        self.juju.status.return_value = self.full
+        self.juju_state.status()
+        self.assertTrue(self.juju_state.has_service('mysql'))
+        self.assertEqual(self.juju_state.machine('1').instance_id, 'i-1')
+        self.juju.status.assert_called_once_with(patterns=None)
+
+    def test_agent_states_for_services(self):
+        self.juju.status.return_value = {
+            'Services': {'keystone': {'Units': {
+                'keystone/0': {'AgentState': 'started'}}}}}
+        self.assertEqual(self.juju_state.get_agent_states(['keystone']),
+                         [('keystone', 'started')])
+        self.juju.status.assert_called_once_with(patterns=['keystone'])
+
+    def test_narrow_cache_bounded(self):
+        self.juju.status.return_value = self.narrow
+        self.juju_state.STATUS_CACHE_SIZE = 3
+        for i in range(10):
+            self.juju_state.status_matching(['svc-{}'.format(i)])
+        self.assertEqual(list(self.juju_state._status_cache),
+                         [('svc-7',), ('svc-8',), ('svc-9',)])
+
+        # superseded by a full fetch
+        self.juju.status.return_value = self.full
+        self.juju_state.status()
+        self.assertEqual(list(self.juju_state._status_cache), [None])
+
+
+class JujuStatusSnapshotTestCase(unittest.TestCase):
+
+    """ Tests the indexed status snapshot
+    """
+
+    def setUp(self):
+        self.status = {
+            'Machines': {
+                '0': {'InstanceId': 'i-0'},
+                '1': {'InstanceId': 'i-1', 'Hardware': 'arch=amd64',
+                      'Containers': {'1/lxc/0': {'InstanceId': 'c-0'}}}},
+            'Services': {
+                'keystone': {'Units': {
+                    'keystone/0': {'Machine': '1/lxc/0'}}}}}
+        self.juju = MagicMock()
+        self.juju.status.return_value = self.status
+        self.juju_state = JujuState(juju=self.juju)
+
+    def test_indexes(self):
+        snapshot = JujuStatusSnapshot(self.status)
+        self.assertEqual(snapshot.machine('1').arch, 'amd64')
+        self.assertIsNone(snapshot.machine('0'))
+        self.assertEqual(snapshot.machine_or_container('1/lxc/0')
+                         .instance_id, 'c-0')
+        self.assertEqual(snapshot.machine_by_instance_id('i-1').machine_id,
+                         '1')
+        self.assertEqual(snapshot.unit('keystone/0').machine_id, '1/lxc/0')
+        self.assertEqual([m.machine_id for m in snapshot.machines], ['1'])
+
+    def test_built_once_per_status(self):
+        self.juju_state.status()
+        snapshot = self.juju_state.snapshot()
+        self.assertIs(self.juju_state.machine('1'),
+                      snapshot.machine('1'))
+        self.assertIs(self.juju_state.service('keystone'),
+                      snapshot.service('keystone'))
+        self.assertIs(self.juju_state.snapshot(), snapshot)
+        self.assertEqual(self.juju_state.base_machine('1/lxc/0')
+                         .machine_id, '1')
+        self.assertEqual(self.juju_state.machine('7').machine_id, '-')
+
+        self.juju.status.return_value = dict(self.status)
+        self.juju_state.invalidate_status_cache()
+        self.assertIsNot(self.juju_state.snapshot(), snapshot)
+
+
+class JujuStateSharedFetchTestCase(unittest.TestCase):
+
+    """ Tests that concurrent readers share status fetches
+    """
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.n_calls = 0
+
+        def slow_status(patterns=None):
+            self.n_calls += 1
+            self.release.wait(5)
+            return {'Machines': {}, 'Services': {}, 'n': self.n_calls}
+
+        self.juju = MagicMock()
+        self.juju.status.side_effect = slow_status
+        self.juju_state = JujuState(juju=self.juju)
+
+    def _readers(self, n):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.juju_state.status()))
+            for _ in range(n)]
+        for t in threads:
+            t.start()
+        return threads, results
+
+    def test_one_fetch_in_flight(self):
+        threads, results = self._readers(5)
+        time.sleep(0.1)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.juju.status.call_count, 1)
+        self.assertEqual(self.juju_state.status_fetches_saved, 4)
+        self.assertTrue(all(r['n'] == 1 for r in results))
+
+    def test_invalidate_needs_newer_fetch(self):
+        threads, results = self._readers(1)
+        time.sleep(0.05)
+        # this fetch was sent before the invalidation, so readers
+        # after it must wait for a second one
+        self.juju_state.invalidate_status_cache()
+        late, late_results = self._readers(3)
+        time.sleep(0.05)
+        self.release.set()
+        for t in threads + late:
+            t.join()
+        self.assertEqual(results[0]['n'], 1)
+        self.assertEqual([r['n'] for r in late_results], [2, 2, 2])
+        self.assertEqual(self.juju.status.call_count, 2)
+
+    def test_invalidate_does_not_fetch(self):
+        self.release.set()
+        self.juju_state.status()
+        self.juju_state.invalidate_status_cache()
+        self.juju_state.invalidate_status_cache()
+        self.assertEqual(self.juju.status.call_count, 1)
+        self.juju_state.status()
+        self.juju_state.status()
+        self.assertEqual(self.juju.status.call_count, 2)
+
+    def test_narrow_query_waits_on_full_fetch(self):
+        threads, _ = self._readers(1)
+        time.sleep(0.05)
+        svc = threading.Thread(target=self.juju_state.service,
+                               args=('keystone',))
+        svc.start()
+        time.sleep(0.05)
+        self.release.set()
+        for t in threads + [svc]:
+            t.join()
+        self.juju.status.assert_called_once_with(patterns=None)
+
+
+class JujuStatusChangesTestCase(unittest.TestCase):
+
+    """ Tests change sets between status snapshots
+    """
+
+    def setUp(self):
+        self.unit = {'AgentState': 'pending', 'Machine': '1',
+                     'PublicAddress': ''}
+        self.status = {
+            'Machines': {
+                '1': {'AgentState': 'pending', 'DNSName': ''},
+                '2': {'AgentState': 'started', 'DNSName': '10.0.0.2'}},
+            'Services': {
+                'keystone': {'Relations': {},
+                             'Units': {'keystone/0': self.unit}},
+                'mysql': {'Relations': {}, 'Units': {}}}}
+        self.juju = MagicMock()
+        self.juju.status.return_value = self.status
+        self.juju_state = JujuState(juju=self.juju)
+
+    def _status(self, machines=None, services=None):
+        status = dict(self.status)
+        status['Machines'] = dict(self.status['Machines'],
+                                  **(machines or {}))
+        status['Services'] = dict(self.status['Services'],
+                                  **(services or {}))
+        return status
+
+    def test_transitions(self):
+        old = JujuStatusSnapshot(self.status)
+        unit = dict(self.unit, AgentState='started',
+                    PublicAddress='10.0.0.1')
+        new = JujuStatusSnapshot(self._status(
+            machines={'1': {'AgentState': 'started',
+                            'DNSName': '10.0.0.1'}},
+            services={'keystone': {'Relations': {'db': ['mysql']},
+                                   'Units': {'keystone/0': unit}}}))
+        changes = JujuStatusChanges(old, new)
+        self.assertEqual(
+            sorted((c.kind, c.name, c.old, c.new) for c in changes),
+            [('machine-address', '1', '', '10.0.0.1'),
+             ('machine-agent-state', '1', ('pending', None),
+              ('started', None)),
+             ('relations', 'keystone', {}, {'db': ['mysql']}),
+             ('unit-address', 'keystone/0', '', '10.0.0.1'),
+             ('unit-agent-state', 'keystone/0', ('pending', None),
+              ('started', None))])
+        self.assertEqual(changes.affected_units(), {'keystone/0'})
+
+    def test_added_and_removed(self):
+        old = JujuStatusSnapshot(self.status)
+        status = self._status(
+            machines={'3': {}},
+            services={'keystone': {'Units': {'keystone/1': {}}}})
+        del status['Machines']['2']
+        del status['Services']['mysql']
+        changes = JujuStatusChanges(old, JujuStatusSnapshot(status))
+        self.assertEqual(
+            sorted((c.kind, c.name) for c in changes),
+            [('machine-added', '3'), ('machine-removed', '2'),
+             ('service-removed', 'mysql'), ('unit-added', 'keystone/1'),
+             ('unit-removed', 'keystone/0')])
+
+    def test_unchanged_entities_skipped(self):
+        old = JujuStatusSnapshot(self.status)
+        changes = JujuStatusChanges(old, JujuStatusSnapshot(self._status()))
+        self.assertEqual(len(changes), 0)
+
+    def test_publish_to_subscribers(self):
+        everything = []
+        units = []
+        self.juju_state.subscribe(everything.append)
+        self.juju_state.subscribe(units.append,
+                                  [JujuStatusChanges.UNIT_AGENT_STATE])
+        changes = self.juju_state.publish_changes()
+        self.assertEqual(len(changes.of_kind(JujuStatusChanges.UNIT_ADDED,
+                                             JujuStatusChanges.SERVICE_ADDED,
+                                             JujuStatusChanges.MACHINE_ADDED)),
+                         5)
+        self.assertEqual(len(everything), 1)
+        self.assertEqual(units, [])
+
+        self.juju.status.return_value = self._status(
+            services={'keystone': {'Relations': {}, 'Units': {
+                'keystone/0': dict(self.unit, AgentState='started')}}})
+        self.juju_state.invalidate_status_cache()
+        self.juju_state.publish_changes()
+        self.assertEqual(len(everything), 2)
+        self.assertEqual([(c.kind, c.name) for c in units[0]],
+                         [('unit-agent-state', 'keystone/0')])
+
+        self.juju_state.unsubscribe(units.append)
+        self.juju_state.invalidate_status_cache()
+        self.juju.status.return_value = self.status
+        self.juju_state.publish_changes()
+        self.assertEqual(len(units), 1)
+        self.assertEqual(len(everything), 3)
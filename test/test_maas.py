@@ -22,8 +22,12 @@ import unittest
 from unittest.mock import MagicMock, PropertyMock
 import json
 
-from cloudinstall.maas import (MaasMachine, MaasMachineStatus, MaasState,
-                               satisfies)
+import requests
+
+from cloudinstall.maas import (MaasMachine, MaasMachineStatus,
+                               MaasNodesMissingError, MaasReadinessWatcher,
+                               MaasState, satisfies)
+from cloudinstall.polling import PollingPolicy
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'maas-output')
 
@@ -91,12 +95,25 @@ class MaasMachineTestCase(unittest.TestCase):
     def test_empty_machine_unknown_status(self):
         self.assertEqual(self.empty_machine.status, MaasMachineStatus.UNKNOWN)
 
+    def test_unrecognised_status(self):
+        m = MaasMachine(-1, {'status': 99})
+        self.assertEqual(m.status, MaasMachineStatus.UNKNOWN)
+
     def test_new_state(self):
         self.assertEqual(self.m_declared.status, MaasMachineStatus.NEW)
 
     def test_ready_state(self):
         self.assertEqual(self.m_ready.status, MaasMachineStatus.READY)
 
+    def test_hardware_parsed(self):
+        m = MaasMachine(-1, {'cpu_count': 4, 'memory': 4096,
+                             'storage': 20480, 'architecture': 'amd64'})
+        self.assertEqual((m.cpu_count, m.mem_mb, m.storage_mb),
+                         (4, 4096, 20480))
+        self.assertEqual((m.arch, m.mem, m.storage),
+                         ('amd64', '4.0G', '20.00G'))
+        self.assertEqual(self.empty_machine.mem, 'N/A')
+
 
 class MaasMachineStatusTestCase(unittest.TestCase):
     """MaasMachine should use the same labels as MAAS 1.7"""
@@ -160,3 +177,145 @@ class MaasStateTestCase(unittest.TestCase):
         s = MaasState(self.mock_client_oneready)
         ready_machines = s.machines(MaasMachineStatus.READY)
         self.assertEqual(len(ready_machines), 1)
+
+
+class MaasStateNodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [{'system_id': 'n{}'.format(i),
+                       'resource_uri': '/MAAS/api/1.0/nodes/n{}/'.format(i),
+                       'hostname': 'n{}.maas'.format(i),
+                       'architecture': ['amd64/generic',
+                                        'armhf/hwpack'][i % 2],
+                       'tag_names': ['compute'] if i < 4 else [],
+                       'status': [4, 6][i % 2]}
+                      for i in range(6)]
+        self.nodes.append({'system_id': 'bootstrap',
+                           'resource_uri': '/MAAS/api/1.0/nodes/bootstrap/',
+                           'hostname': 'juju-bootstrap.maas',
+                           'architecture': 'amd64/generic',
+                           'tag_names': [], 'status': 6})
+        self.client = MagicMock()
+        self.p = PropertyMock(return_value=self.nodes)
+        type(self.client).nodes = self.p
+        self.s = MaasState(self.client)
+
+    def test_nodes_keyed_by_constraints(self):
+        self.assertEqual(len(self.s.nodes('arch=armhf')), 3)
+        self.assertEqual(len(self.s.nodes('arch=amd64 tags=compute')), 2)
+        self.assertEqual(len(self.s.nodes()), 7)
+        self.assertEqual(len(self.s.machines(constraints='tags=compute')),
+                         4)
+        self.assertEqual(len(self.s.machines(MaasMachineStatus.READY,
+                                             'tags=compute')), 2)
+        self.assertEqual(self.p.call_count, 1)
+
+    def test_lookups(self):
+        m = self.s.machine('/MAAS/api/1.0/nodes/n3/')
+        self.assertEqual(m.hostname, 'n3.maas')
+        self.assertIs(self.s.machine_by_system_id('n3'), m)
+        self.assertIsNone(self.s.machine('/MAAS/api/1.0/nodes/bootstrap/'))
+        self.assertIsNone(self.s.machine('nope'))
+        self.assertIs(self.s.machines(MaasMachineStatus.ALLOCATED)[1], m)
+        self.assertEqual(self.s.machines_summary(),
+                         {MaasMachineStatus.READY: 3,
+                          MaasMachineStatus.ALLOCATED: 4})
+        self.assertEqual(self.p.call_count, 1)
+
+    def test_summary_unknown_status(self):
+        self.nodes[0]['status'] = 99
+        self.nodes[2]['status'] = 98
+        self.assertEqual(self.s.machines_summary(),
+                         {MaasMachineStatus.READY: 1,
+                          MaasMachineStatus.ALLOCATED: 4,
+                          MaasMachineStatus.UNKNOWN: 2})
+
+    def test_invalidate(self):
+        machines = self.s.machines()
+        machines.remove(machines[0])
+        self.assertEqual(len(self.s.machines()), 6)
+        self.s.invalidate_nodes_cache()
+        self.s.machines()
+        self.assertEqual(self.p.call_count, 2)
+
+
+class MaasReadinessWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.status = {'a': 0, 'b': 1, 'c': 4, 'd': 0}
+        self.tags = {}
+        self.requested = []
+
+        def iter_node_pages(system_ids):
+            self.requested.append(sorted(system_ids))
+            yield [{'system_id': i, 'status': self.status[i],
+                    'architecture': 'amd64/generic',
+                    'tag_names': self.tags.get(i, [])}
+                   for i in sorted(system_ids) if i in self.status]
+
+        self.client = MagicMock()
+        self.client.iter_node_pages.side_effect = iter_node_pages
+        self.on_ready = MagicMock()
+        self.watcher = MaasReadinessWatcher(self.client, ['a', 'b', 'c'],
+                                            on_ready=self.on_ready,
+                                            polling=PollingPolicy(1, 8, 2))
+
+    def test_polls_only_pending(self):
+        self.assertFalse(self.watcher.poll())
+        self.assertEqual(self.watcher.pending, {'a', 'b'})
+        self.assertEqual(self.watcher.summary(),
+                         {MaasMachineStatus.NEW: 1,
+                          MaasMachineStatus.COMMISSIONING: 1,
+                          MaasMachineStatus.READY: 1})
+        self.status['b'] = 4
+        self.assertFalse(self.watcher.poll())
+        self.status['a'] = 6
+        self.assertTrue(self.watcher.poll())
+        self.assertTrue(self.watcher.poll())
+        self.assertEqual(self.requested,
+                         [['a', 'b', 'c'], ['a', 'b'], ['a']])
+        self.on_ready.assert_called_once_with()
+
+    def test_missing_nodes(self):
+        del self.status['b']
+        self.assertFalse(self.watcher.poll())
+        self.assertEqual(self.watcher.pending, {'a'})
+        self.assertEqual(self.watcher.missing, {'b'})
+        self.status['a'] = 4
+        self.assertTrue(self.watcher.poll())
+        self.on_ready.assert_not_called()
+        with self.assertRaises(MaasNodesMissingError) as cm:
+            self.watcher.wait()
+        self.assertEqual(cm.exception.system_ids, ['b'])
+
+    def test_constraints(self):
+        watcher = MaasReadinessWatcher(self.client, ['c', 'd'],
+                                       constraints='arch=amd64 tags=fast')
+        self.status['d'] = 4
+        self.tags['d'] = ['fast']
+        self.assertFalse(watcher.poll())
+        self.assertEqual(watcher.pending, {'c'})
+        self.tags['c'] = ['fast', 'ssd']
+        self.assertTrue(watcher.poll())
+
+    def test_http_error(self):
+        def fail(system_ids):
+            raise requests.HTTPError('500 Server Error')
+            yield
+
+        self.client.iter_node_pages.side_effect = fail
+        self.assertFalse(self.watcher.poll())
+        self.assertEqual(self.watcher.pending, {'a', 'b', 'c'})
+        self.assertEqual(self.watcher.statuses,
+                         {'a': None, 'b': None, 'c': None})
+        self.on_ready.assert_not_called()
+
+    def test_wait_backs_off(self):
+        sleeps = []
+
+        def sleep(s):
+            sleeps.append(s)
+            if len(sleeps) == 4:
+                self.status['a'] = self.status['b'] = 4
+
+        self.watcher.wait(sleep)
+        self.assertEqual(sleeps, [1, 2, 4, 8])
+        self.on_ready.assert_called_once_with()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# tests maasclient/__init__.py against test/fakemaasapi.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from cloudinstall.maas import MaasState
+import maasclient
+from maasclient import MaasClient, RateLimiter
+from maasclient.auth import MaasAuth
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fakemaasapi import (FakeMaasAPI, FakeMaasModel,  # noqa
+                         FakeMaasServer)
+
+
+class MaasClientSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeMaasModel()
+        self.model.populate(5)
+        self.api = FakeMaasAPI(model=self.model)
+        self.server = FakeMaasServer(self.api).start()
+        auth = MaasAuth(api_url=self.server.api_url, api_key='c:t:s')
+        self.client = MaasClient(auth, retries=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_reuses_connection(self):
+        for _ in range(10):
+            self.assertEqual(len(self.client.nodes), 5)
+        self.client.tag_new('compute')
+        self.assertEqual(self.api.connections, 1)
+
+    def test_oauth_reused_until_key_changes(self):
+        oauth = self.client._oauth()
+        self.assertIs(self.client._oauth(), oauth)
+        self.client.auth.api_key = 'c2:t2:s2'
+        self.assertIsNot(self.client._oauth(), oauth)
+
+    def test_get_retried(self):
+        self.api.fail('GET', 503, count=2)
+        self.assertEqual(len(self.client.nodes), 5)
+
+    def test_get_gives_up(self):
+        self.api.fail('GET', 503, count=3)
+        self.assertEqual(self.client.nodes, [])
+
+    def test_post_not_retried(self):
+        self.api.fail('POST', 503)
+        self.assertFalse(self.client.nodes_accept_all())
+        self.assertTrue(self.client.nodes_accept_all())
+
+    def test_timeout(self):
+        self.api.latency = 0.5
+        self.assertRaises(requests.exceptions.Timeout,
+                          self.client.get, '/nodes/', dict(op='list'),
+                          timeout=0.1)
+
+    def test_old_urllib3(self):
+        Retry = maasclient.Retry
+
+        def old_retry(raise_on_status=None, **kwargs):
+            if raise_on_status is not None:
+                raise TypeError('raise_on_status')
+            return Retry(**kwargs)
+
+        with patch('maasclient.Retry', side_effect=old_retry):
+            retry = maasclient._retry(2)
+        self.assertEqual(retry.connect, 2)
+        self.assertFalse(retry.status_forcelist)
+        with patch('maasclient.Retry', None):
+            self.assertEqual(maasclient._retry(2), 2)
+
+
+class MaasClientTaggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeMaasModel()
+        self.api = FakeMaasAPI(model=self.model)
+        self.server = FakeMaasServer(self.api).start()
+        auth = MaasAuth(api_url=self.server.api_url, api_key='c:t:s')
+        self.client = MaasClient(auth, pool_size=4)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def count(self, method, path, op):
+        return self.api.requests[(method, path, op)]
+
+    def test_tag_name(self):
+        self.model.populate(20)
+        self.model.new_tag('node-00000')
+        self.model.update_tag_nodes('node-00000', ['node-00000'], [])
+        self.client.tag_name(self.client.nodes)
+        self.assertEqual(self.count('GET', '/tags/', 'list'), 1)
+        self.assertEqual(self.count('POST', '/tags/', 'new'), 19)
+        self.assertEqual(self.count('POST', '/tags/*/', 'update_nodes'),
+                         19)
+        for system_id, node in self.model.nodes.items():
+            self.assertEqual(node['tag_names'], [system_id])
+
+        self.api.requests.clear()
+        self.client.tag_name(self.client.nodes)
+        self.assertEqual(sum(self.api.requests.values()), 1)
+
+    def test_tag_fpi_batches(self):
+        self.model.populate(150, status=0)
+        self.model.populate(10)
+        self.client.tag_fpi(self.client.nodes)
+        self.assertEqual(self.count('POST', '/tags/', 'new'), 1)
+        self.assertEqual(self.count('POST', '/tags/*/', 'update_nodes'),
+                         2)
+        tagged = [n for n in self.model.nodes.values()
+                  if 'use-fastpath-installer' in n['tag_names']]
+        self.assertEqual(len(tagged), 150)
+
+    def test_tag_new_many(self):
+        self.model.new_tag('a')
+        self.assertEqual(self.client.tag_new_many(['a', 'b', 'b', 'c']),
+                         {'a', 'b', 'c'})
+        self.assertEqual(self.count('POST', '/tags/', 'new'), 2)
+
+
+class MaasClientNodeQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeMaasModel()
+        self.model.populate(30)
+        for i, node in enumerate(self.model.nodes.values()):
+            if i % 3 == 0:
+                node['zone'] = {'name': 'openstack'}
+            if i % 5 == 0:
+                node['architecture'] = 'armhf/hwpack'
+            if i < 6:
+                node['status'] = 0
+        self.model.new_tag('compute')
+        self.model.update_tag_nodes('compute', ['node-00000', 'node-00003',
+                                                'node-00004'], [])
+        self.api = FakeMaasAPI(model=self.model)
+        self.server = FakeMaasServer(self.api).start()
+        auth = MaasAuth(api_url=self.server.api_url, api_key='c:t:s')
+        self.client = MaasClient(auth)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def ids(self, nodes):
+        return [n['system_id'] for n in nodes]
+
+    def test_zone_arch_status(self):
+        nodes = self.client.nodes_matching(zone='openstack')
+        self.assertEqual(len(nodes), 10)
+        nodes = self.client.nodes_matching(zone='openstack', arch='armhf',
+                                           status=[4])
+        self.assertEqual(self.ids(nodes), ['node-00015'])
+        machines = self.client.nodes_V2(arch='amd64/generic', state=0)
+        self.assertEqual(len(machines), 4)
+
+    def test_tag(self):
+        nodes = self.client.nodes_matching(tag='compute', zone='openstack')
+        self.assertEqual(self.ids(nodes), ['node-00000', 'node-00003'])
+        self.assertEqual(self.api.requests[('GET', '/nodes/', 'list')], 0)
+
+    def test_pages(self):
+        wanted = ['node-{:05d}'.format(i) for i in range(0, 30, 2)]
+        pages = list(self.client.iter_node_pages(system_ids=wanted,
+                                                 page_size=4))
+        self.assertEqual([len(p) for p in pages], [4, 4, 4, 3])
+        self.assertEqual(self.ids(n for p in pages for n in p), wanted)
+        self.assertEqual(self.api.requests[('GET', '/nodes/', 'list')], 4)
+
+    def test_page_error(self):
+        self.api.fail('GET', 404)
+        self.assertRaises(requests.HTTPError, self.client.nodes_matching,
+                          zone='openstack')
+        self.api.fail('GET', 404)
+        state = MaasState(self.client, {'zone': 'openstack'})
+        self.assertEqual(state.machines(), [])
+
+    def test_accept_only_given(self):
+        self.assertTrue(self.client.nodes_accept(['node-00001',
+                                                  'node-00002']))
+        self.assertTrue(self.client.nodes_accept([]))
+        self.assertEqual(self.ids(self.client.nodes_matching(status=[0])),
+                         ['node-00000', 'node-00003', 'node-00004',
+                          'node-00005'])
+        self.assertEqual(self.api.requests[('POST', '/nodes/', 'accept')],
+                         1)
+
+    def test_maas_state_node_filter(self):
+        state = MaasState(self.client, {'zone': 'openstack', 'tag':
+                                        'compute'})
+        self.assertEqual([m.system_id for m in state.machines()],
+                         ['node-00000', 'node-00003'])
+
+
+class MaasClientBulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeMaasModel(commission_time=60)
+        self.model.populate(20)
+        self.api = FakeMaasAPI(model=self.model)
+        self.server = FakeMaasServer(self.api).start()
+        auth = MaasAuth(api_url=self.server.api_url, api_key='c:t:s')
+        self.client = MaasClient(auth, pool_size=4)
+        self.ids = list(self.model.nodes)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_commission_many(self):
+        results = self.client.commission_many(self.ids)
+        self.assertEqual(list(results), self.ids)
+        self.assertEqual(results.succeeded, self.ids)
+        self.assertEqual(set(n['status'] for n in self.model.nodes.values()),
+                         {1})
+
+    def test_per_node_errors(self):
+        self.model.acquire({})
+        results = self.client.start_many(self.ids + ['nope'])
+        self.assertEqual(results.succeeded, ['node-00000'])
+        self.assertEqual(len(results.failed), 20)
+        self.assertTrue(results['node-00001'].error.startswith('409'))
+        self.assertTrue(results['nope'].error.startswith('404'))
+
+        results = self.client.remove_many(self.ids[:5])
+        self.assertEqual(len(results.succeeded), 5)
+        self.assertEqual(len(self.model.nodes), 15)
+
+    def test_on_result(self):
+        seen = []
+        results = self.client.node_details_many(
+            self.ids, lambda r: seen.append(len(r.response.content)))
+        self.assertEqual(len(seen), 20)
+        self.assertEqual(results.succeeded, self.ids)
+        self.assertTrue(all(r.response is None for r in results.values()))
+
+    def test_rate_limit(self):
+        self.client.rate_limiter = RateLimiter(100)
+        start = time.time()
+        self.client.release_many(self.ids)
+        self.assertGreater(time.time() - start, 0.18)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(None)
+        start = time.time()
+        for _ in range(100):
+            limiter.wait()
+        self.assertLess(time.time() - start, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
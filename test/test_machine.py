@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# tests cloudinstall/machine.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from cloudinstall.machine import Machine
+
+
+class MachineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.machine = Machine('1', {
+            'Hardware': 'arch=amd64 cpu-cores=4 mem=2048M root-disk=8192M',
+            'Containers': {'1/lxc/0': {'InstanceId': 'c-0'}}})
+
+    def test_hardware_parsed(self):
+        m = self.machine
+        self.assertEqual((m.arch, m.cpu_cores, m.mem, m.storage),
+                         ('amd64', '4', '2048M', '8.0G'))
+        self.assertEqual((m.cpu_count, m.mem_mb, m.storage_mb),
+                         (4, 2048, 8192))
+        self.assertEqual(m.hardware('memory'), '2048M')
+        # storage used to change on every read
+        self.assertEqual(m.storage, '8.0G')
+
+    def test_no_hardware(self):
+        m = Machine('2', {})
+        self.assertEqual((m.arch, m.cpu_cores, m.mem, m.storage),
+                         ('N/A', 'N/A', 'N/A', 'N/A'))
+        self.assertEqual((m.cpu_count, m.mem_mb, m.storage_mb),
+                         (None, None, None))
+
+    def test_containers_built_once(self):
+        c = next(self.machine.containers)
+        self.assertIs(next(self.machine.containers), c)
+        self.assertEqual(c.instance_id, 'c-0')
+        self.assertIs(self.machine.container('1/lxc/0'), c)
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            self.machine.extra = 1
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+#
+# tests macumba/__init__.py against test/fakejuju.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from macumba import (CallStats, CharmStore,
+                     ConnectionClosedError, JujuClient, LoginError,
+                     RequestTimeout, ServerError, UnknownRequestError)
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fakejuju import FakeJujuAPI, FakeJujuServer  # noqa
+
+
+class JujuClientCallTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeJujuAPI()
+        self.server = FakeJujuServer(self.api).start()
+        self.juju = JujuClient(url=self.server.url, password='pass')
+        self.juju.login()
+
+    def tearDown(self):
+        self.juju.close()
+        self.server.stop()
+
+    def test_call_wakes_on_reply(self):
+        """ call() should return as soon as the reply arrives """
+        start = time.time()
+        for _ in range(10):
+            self.assertEqual(self.juju.info()['Name'], 'fake')
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_reply_before_receive(self):
+        """ replies that arrive before receive() are kept """
+        req_id = self.juju.conn.do_send(dict(Type="Client",
+                                             Request="EnvironmentInfo"))
+        time.sleep(0.1)
+        self.assertEqual(self.juju.receive(req_id)['Name'], 'fake')
+
+    def test_timeout(self):
+        self.api.latency = 0.5
+        self.assertRaises(RequestTimeout, self.juju.call,
+                          dict(Type="Client", Request="EnvironmentInfo"),
+                          timeout=0.1)
+
+    def test_api_stats(self):
+        self.juju.info()
+        self.juju.status()
+        self.assertRaises(ServerError, self.juju.call,
+                          dict(Type="Admin", Request="Login",
+                               Params=dict(Password='wrong')))
+        stats = self.juju.api_stats.snapshot()
+        self.assertEqual(stats['FullStatus']['count'], 1)
+        self.assertEqual(stats['FullStatus']['ok'], 1)
+        self.assertGreater(stats['FullStatus']['bytes_received'], 0)
+        self.assertGreater(stats['FullStatus']['bytes_sent'], 0)
+        self.assertEqual(stats['Login']['error'], 1)
+        self.assertIn('FullStatus', self.juju.api_stats.summary())
+
+    def test_api_stats_timeout(self):
+        self.api.latency = 0.2
+        self.assertRaises(RequestTimeout, self.juju.call,
+                          dict(Type="Client", Request="EnvironmentInfo"),
+                          timeout=0.05)
+        stats = self.juju.api_stats.snapshot()['EnvironmentInfo']
+        self.assertEqual(stats['timeout'], 1)
+
+
+class CallStatsTestCase(unittest.TestCase):
+
+    def test_histogram_and_dump(self):
+        stats = CallStats()
+        for elapsed in [0.001] * 19 + [2]:
+            stats.record('FullStatus', elapsed, bytes_received=100)
+        snap = stats.snapshot()['FullStatus']
+        self.assertEqual(snap['count'], 20)
+        self.assertEqual(snap['bytes_received'], 2000)
+        self.assertEqual(snap['p50'], 0.001)
+        self.assertEqual(snap['p95'], 0.001)
+        self.assertEqual(snap['max_time'], 2)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'api-stats.json')
+        stats.dump(filename)
+        with open(filename) as f:
+            dumped = json.load(f)
+        self.assertEqual(dumped['requests']['FullStatus']['count'], 20)
+
+
+class JujuWSPendingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeJujuAPI()
+        self.server = FakeJujuServer(self.api).start()
+        self.juju = JujuClient(url=self.server.url, password='pass',
+                               max_pending=4)
+        self.juju.login()
+        self.conn = self.juju.conn
+
+    def tearDown(self):
+        self.juju.close()
+        self.server.stop()
+
+    def _wait_for(self, cond):
+        for _ in range(100):
+            if cond():
+                return
+            time.sleep(0.01)
+
+    def test_timeout_forgets_and_counts_late_reply(self):
+        self.api.latency = 0.2
+        self.assertRaises(RequestTimeout, self.juju.call,
+                          dict(Type="Client", Request="EnvironmentInfo"),
+                          timeout=0.05)
+        self.assertEqual(len(self.conn.messages), 0)
+        self._wait_for(lambda: self.juju.pending_stats()['late'])
+        stats = self.juju.pending_stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['late'], 1)
+
+    def test_bounded(self):
+        # replies that beat their eviction count as unclaimed instead
+        self.api.latency = 0.2
+        req_ids = [self.conn.do_send(dict(Type="Client",
+                                          Request="EnvironmentInfo"))
+                   for _ in range(6)]
+        self.assertEqual(len(self.conn.messages), 4)
+        self.assertEqual(self.juju.pending_stats()['evicted'], 2)
+        self.assertRaises(UnknownRequestError, self.juju.receive,
+                          req_ids[0])
+        self.assertEqual(self.juju.receive(req_ids[-1])['Name'], 'fake')
+
+    def test_sweep_expires_unclaimed(self):
+        self.conn.unclaimed_ttl = 0
+        req_id = self.conn.do_send(dict(Type="Client",
+                                        Request="EnvironmentInfo"))
+        self._wait_for(lambda: self.conn.pending_reply(req_id).done())
+        self.conn.sweep()
+        self.assertEqual(len(self.conn.messages), 0)
+        self.assertEqual(self.juju.pending_stats()['unclaimed'], 1)
+
+    def test_sweep_expires_overdue(self):
+        self.api.latency = 0.2
+        req_id = self.conn.do_send(dict(Type="Client",
+                                        Request="EnvironmentInfo"),
+                                   timeout=0.01)
+        time.sleep(0.02)
+        self.conn.sweep()
+        self.assertRaises(UnknownRequestError, self.juju.receive, req_id)
+        self.assertEqual(self.juju.pending_stats()['expired'], 1)
+
+
+class JujuClientCallManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeJujuAPI()
+        self.server = FakeJujuServer(self.api).start()
+        self.juju = JujuClient(url=self.server.url, password='pass')
+        self.juju.login()
+
+    def tearDown(self):
+        self.juju.close()
+        self.server.stop()
+
+    def test_results_in_order(self):
+        """ call_many returns per-request results and errors in order """
+        results = self.juju.call_many([
+            dict(Type="Client", Request="EnvironmentInfo"),
+            dict(Type="Admin", Request="Login",
+                 Params=dict(AuthTag='user-admin', Password='wrong')),
+            dict(Type="Client", Request="FullStatus")])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][0]['Name'], 'fake')
+        self.assertIsNone(results[0][1])
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], ServerError)
+        self.assertIn('Machines', results[2][0])
+        self.assertIsNone(results[2][1])
+
+    def test_partial_results_without_reconnect(self):
+        """ replies received before the connection dropped are kept """
+        self.juju.reconnect_attempts = 0
+        conn = self.juju.conn
+        do_receive = conn.do_receive
+
+        def drop_after_first(req_id, timeout=None):
+            if req_id != req_ids[0]:
+                raise ConnectionClosedError
+            return do_receive(req_id, timeout)
+        req_ids = [conn._cur_request_id + 1]
+        with patch.object(conn, 'do_receive', drop_after_first):
+            results = self.juju.call_many([
+                dict(Type="Client", Request="EnvironmentInfo"),
+                dict(Type="Client", Request="FullStatus"),
+                dict(Type="Client", Request="EnvironmentInfo")])
+        self.assertEqual(results[0][0]['Name'], 'fake')
+        self.assertIsNone(results[0][1])
+        for response, error in results[1:]:
+            self.assertIsNone(response)
+            self.assertIsInstance(error, ConnectionClosedError)
+
+
+class JujuClientReconnectTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server_a = FakeJujuServer().start()
+        self.server_b = FakeJujuServer().start()
+        self.juju = JujuClient(url=self.server_a.url, password='pass',
+                               alternate_urls=[self.server_b.url],
+                               reconnect_backoff=0.01)
+        self.juju.login()
+
+    def tearDown(self):
+        self.juju.close()
+        self.server_b.stop()
+
+    def _drop_server_a(self):
+        conn = self.juju.conn
+        self.server_a.stop()
+        for _ in range(50):
+            if conn.terminated:
+                break
+            time.sleep(0.01)
+
+    def test_failover_replays_idempotent(self):
+        self._drop_server_a()
+        self.assertIn('Machines', self.juju.status())
+        self.assertEqual(self.juju.url, self.server_b.url)
+
+    def test_watch_all_not_replayed(self):
+        # a replayed WatchAll would leave the first watcher running
+        self._drop_server_a()
+        self.assertRaises(ConnectionClosedError, self.juju.get_watcher)
+
+    def test_non_idempotent_not_replayed(self):
+        self._drop_server_a()
+        self.assertRaises(ConnectionClosedError, self.juju.add_machines, [])
+        # but the connection is usable again afterwards
+        self.assertEqual(self.juju.info()['Name'], 'fake')
+
+    def test_login_timeout(self):
+        self.addCleanup(self.server_a.stop)
+        self.server_b.api.latency = 0.5
+        juju = JujuClient(url=self.server_b.url, password='pass',
+                          login_timeout=0.05)
+        self.addCleanup(juju.close)
+        self.assertRaises(LoginError, juju.login)
+
+    def test_backoff_without_connlock(self):
+        self.juju.urls = [self.server_a.url]
+        self.juju.reconnect_attempts = 2
+        self.juju.reconnect_backoff = 0.5
+        self._drop_server_a()
+        errors = []
+
+        def status():
+            try:
+                self.juju.status()
+            except ConnectionClosedError as e:
+                errors.append(e)
+        caller = threading.Thread(target=status)
+        caller.start()
+        time.sleep(0.2)
+        self.assertTrue(self.juju.connlock.acquire(timeout=0.1))
+        self.juju.connlock.release()
+        caller.join()
+        self.assertEqual(len(errors), 1)
+
+
+class CharmStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'cs.json')
+        patcher = patch('macumba.fetch_cs',
+                        side_effect=lambda c: {'charm': {'url': 'cs:' + c}})
+        self.mock_fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_and_persisted(self):
+        cs = CharmStore(cache_file=self.cache_file)
+        self.assertEqual(cs.lookup('keystone')['charm']['url'],
+                         'cs:trusty/keystone')
+        cs.lookup('trusty/keystone')
+        self.assertEqual(self.mock_fetch.call_count, 1)
+
+        cs2 = CharmStore(cache_file=self.cache_file)
+        cs2.lookup('keystone')
+        self.assertEqual(self.mock_fetch.call_count, 1)
+
+    def test_stale_while_revalidate(self):
+        cs = CharmStore(cache_file=self.cache_file, ttl=0)
+        cs.lookup('keystone')
+        cs.lookup('keystone-19')
+        self.assertEqual(cs.lookup('keystone')['charm']['url'],
+                         'cs:trusty/keystone')
+        # pinned revisions never expire
+        cs.lookup('keystone-19')
+        for _ in range(50):
+            if len(cs._refreshing) == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.mock_fetch.call_count, 3)
+
+    def test_prefetch(self):
+        self.mock_fetch.side_effect = None
+        self.mock_fetch.return_value = {}
+        cs = CharmStore()
+        errors = cs.prefetch(['keystone', 'mysql', 'glance', 'mysql'])
+        self.assertEqual(errors, {})
+        self.assertEqual(self.mock_fetch.call_count, 3)
+
+    def test_prefetch_persists_every_lookup(self):
+        cs = CharmStore(cache_file=self.cache_file)
+        charms = ['charm{}'.format(i) for i in range(32)]
+        self.assertEqual(cs.prefetch(charms), {})
+        with open(self.cache_file) as f:
+            self.assertEqual(len(json.load(f)), 32)
+        self.assertFalse(os.path.exists(self.cache_file + '.tmp'))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# tests cloudinstall/maas/details.py against test/fakemaasapi.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from cloudinstall.maas import MaasState
+from cloudinstall.maas.details import (NodeDetailsCache,
+                                       commissioning_stamp,
+                                       hardware_facts)
+from maasclient import MaasClient
+from maasclient.auth import MaasAuth
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fakemaasapi import (FakeMaasAPI, FakeMaasModel,  # noqa
+                         FakeMaasServer)
+
+DETAILS = ('GET', '/nodes/*/', 'details')
+
+
+class HardwareFactsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeMaasModel()
+        # node-00000 has two sockets with vmx, node-00001 one without
+        self.model.populate(2)
+
+    def facts(self, system_id):
+        node = self.model.node(system_id)
+        return hardware_facts({'lshw': self.model.lshw(node)})
+
+    def test_facts(self):
+        facts = self.facts('node-00000')
+        self.assertEqual(facts['numa_nodes'], 2)
+        self.assertEqual(facts['cpu_model'], 'Fake CPU @ 2.40GHz')
+        self.assertIn('vmx', facts['cpu_flags'])
+        self.assertEqual(facts['cpu_flags'], sorted(facts['cpu_flags']))
+        self.assertEqual([d['name'] for d in facts['disks']],
+                         ['/dev/sda', '/dev/sdb', '/dev/sdc'])
+        self.assertEqual(facts['disks'][0]['size_mb'], 40960)
+        self.assertEqual(facts['nics'], [{'name': 'eth0',
+                                          'mac': '52:54:00:00:00:00',
+                                          'speed_mbps': 1000,
+                                          'vendor': 'Fake',
+                                          'product': 'FakeNIC'}])
+
+        facts = self.facts('node-00001')
+        self.assertEqual(facts['numa_nodes'], 1)
+        self.assertNotIn('vmx', facts['cpu_flags'])
+        self.assertEqual(len(facts['disks']), 1)
+
+    def test_no_lshw(self):
+        for details in (None, {}, {'lshw': b'<list><node'}):
+            facts = hardware_facts(details)
+            self.assertEqual(facts['disks'], [])
+            self.assertEqual(facts['numa_nodes'], 0)
+
+    def test_stamp(self):
+        node = dict(self.model.node('node-00000'))
+        stamp = commissioning_stamp(node)
+        node['status'] = 6
+        node['tag_names'] = ['compute']
+        self.assertEqual(commissioning_stamp(node), stamp)
+        node['memory'] *= 2
+        self.assertNotEqual(commissioning_stamp(node), stamp)
+
+
+class NodeDetailsCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.model = FakeMaasModel()
+        self.model.populate(20)
+        self.api = FakeMaasAPI(model=self.model)
+        self.server = FakeMaasServer(self.api).start()
+        auth = MaasAuth(api_url=self.server.api_url, api_key='c:t:s')
+        self.client = MaasClient(auth, pool_size=4)
+        self.nodes = self.client.nodes
+        self.cache = NodeDetailsCache(self.tmpdir, self.client)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def fetched(self):
+        return self.api.requests[DETAILS]
+
+    def test_details_cached(self):
+        node = self.nodes[0]
+        details = self.cache.details(node)
+        self.assertEqual(details['lshw'], self.model.lshw(
+            self.model.node(node['system_id'])).decode('utf-8'))
+        self.assertEqual(details['lldp'], '<lldp />')
+        self.assertEqual(self.cache.details(node), details)
+        self.assertEqual(self.fetched(), 1)
+
+        # survives a restart
+        cache = NodeDetailsCache(self.tmpdir, self.client)
+        self.assertEqual(cache.details(node), details)
+        self.assertEqual(cache.facts(node), hardware_facts(details))
+        self.assertEqual(self.fetched(), 1)
+
+    def test_recommissioned(self):
+        node = self.nodes[0]
+        self.cache.facts(node)
+        node = dict(node, storage=node['storage'] * 2)
+        self.model.nodes[node['system_id']]['storage'] = node['storage']
+        facts = self.cache.facts(node)
+        self.assertEqual(self.fetched(), 2)
+        self.assertEqual(facts['disks'][0]['size_mb'], node['storage'])
+
+    def test_prefetch(self):
+        self.cache.facts(self.nodes[0])
+        facts = self.cache.prefetch(self.nodes + [{'system_id': 'nope'}])
+        self.assertEqual(self.fetched(), 21)
+        self.assertEqual(set(facts),
+                         set(n['system_id'] for n in self.nodes))
+
+        cache = NodeDetailsCache(self.tmpdir, self.client)
+        self.assertEqual(cache.prefetch(self.nodes), facts)
+        self.assertEqual(self.fetched(), 21)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         sorted(['index.json'] +
+                                [n['system_id'] + '.json.gz'
+                                 for n in self.nodes]))
+
+    def test_failed_refetch_dropped(self):
+        self.cache.prefetch(self.nodes)
+        node = dict(self.nodes[0], memory=self.nodes[0]['memory'] * 2)
+        system_id = node['system_id']
+        self.api.fail('GET', 404)
+        facts = self.cache.prefetch([node] + self.nodes[1:])
+        self.assertNotIn(system_id, facts)
+        self.assertEqual(len(facts), 19)
+        self.assertIsNone(self.cache.cached_facts(node))
+        self.assertIsNone(self.cache.cached_facts(self.nodes[0]))
+        self.assertNotIn(system_id + '.json.gz', os.listdir(self.tmpdir))
+
+        cache = NodeDetailsCache(self.tmpdir, self.client)
+        self.assertNotIn(system_id, cache.index())
+
+    def test_maas_state(self):
+        state = MaasState(self.client, details_cache=self.cache)
+        machine = state.machines()[0]
+        self.assertIsNone(state.hardware_facts(machine))
+        facts = state.prefetch_node_details()
+        self.assertEqual(len(facts), 20)
+        self.assertEqual(state.hardware_facts(machine),
+                         facts[machine.machine['system_id']])
+        self.assertIsNone(MaasState(self.client).hardware_facts(machine))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,7 +20,7 @@
 import logging
 import os
 import unittest
-from unittest.mock import call, MagicMock, PropertyMock, patch
+from unittest.mock import call, MagicMock, PropertyMock
 import yaml
 from tempfile import NamedTemporaryFile, TemporaryFile
 
@@ -32,6 +32,7 @@ from cloudinstall.charms.ceph import CharmCeph
 from cloudinstall.charms.ceph_osd import CharmCephOSD
 from cloudinstall.maas import MaasMachineStatus
 from cloudinstall.config import Config
+from cloudinstall.constraints import MachineTable, compile_constraints
 from cloudinstall.state import CharmState
 import cloudinstall.utils as utils
 
@@ -139,13 +140,22 @@ class PlacementControllerTestCase(unittest.TestCase):
                          {AssignmentType.LXC: [self.mock_machine_2]})
 
     def test_gen_defaults(self):
-        satisfies_importstring = 'cloudinstall.placement.controller.satisfies'
-        with patch(satisfies_importstring) as mock_satisfies:
-            mock_satisfies.return_value = (True, )
+        # only the first machine is big enough for nova-compute
+        self.mock_machine.machine = {'memory': 8192, 'storage': 81920,
+                                     'cpu_count': 4,
+                                     'architecture': 'amd64/generic'}
+        self.mock_machine_2.machine = {'memory': 2048, 'storage': 20480,
+                                       'cpu_count': 2,
+                                       'architecture': 'amd64/generic'}
+        table = MachineTable(self.mock_machines)
+        compute = compile_constraints(CharmNovaCompute.constraints)
+        self.assertEqual(table.evaluate(compute).mask, [True, False])
+
+        for machines in [[self.mock_machine, self.mock_machine_2],
+                         [self.mock_machine_2, self.mock_machine]]:
             defs = self.pc.gen_defaults(charm_classes=[CharmNovaCompute,
                                                        CharmKeystone],
-                                        maas_machines=[self.mock_machine,
-                                                       self.mock_machine_2])
+                                        maas_machines=machines)
             m1_as = defs[self.mock_machine.instance_id]
             m2_as = defs[self.mock_machine_2.instance_id]
             self.assertEqual(m1_as[AssignmentType.BareMetal],
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# tests cloudinstall/polling.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+from cloudinstall.juju import JujuState
+from cloudinstall.polling import PollingPolicy
+
+
+class PollingPolicyTestCase(unittest.TestCase):
+
+    def test_backs_off_while_unchanged(self):
+        p = PollingPolicy(1, 10, 2)
+        self.assertTrue(p.observe('a'))
+        self.assertEqual(p.interval, 1)
+        self.assertFalse(p.observe('a'))
+        self.assertEqual(p.interval, 2)
+        p.observe('a')
+        self.assertEqual(p.interval, 4)
+
+    def test_capped_at_max(self):
+        p = PollingPolicy(1, 5, 3)
+        for _ in range(5):
+            p.observe('a')
+        self.assertEqual(p.interval, 5)
+
+    def test_change_resets(self):
+        p = PollingPolicy(1, 10, 2)
+        for _ in range(4):
+            p.observe('a')
+        self.assertTrue(p.observe('b'))
+        self.assertEqual(p.interval, 1)
+
+    def test_copy_starts_over(self):
+        p = PollingPolicy(1, 10, 2)
+        for _ in range(4):
+            p.observe('a')
+        c = p.copy()
+        self.assertEqual(c.interval, 1)
+        self.assertTrue(c.observe('a'))
+
+    def test_from_config(self):
+        config = MagicMock()
+        config.getopt.side_effect = {'poll_interval_min': 3,
+                                     'poll_interval_max': 30,
+                                     'poll_backoff': 2}.get
+        p = PollingPolicy.from_config(config)
+        self.assertEqual((p.min_interval, p.max_interval, p.backoff),
+                         (3, 30, 2))
+
+
+class JujuStatePollingTestCase(unittest.TestCase):
+
+    @patch('cloudinstall.juju.time')
+    def test_status_ttl_follows_interval(self, mock_time):
+        juju = MagicMock()
+        juju.status.return_value = {'Machines': {}, 'Services': {}}
+        mock_time.time.return_value = 100
+        state = JujuState(juju, polling=PollingPolicy(2, 60, 2))
+        state.status()
+        mock_time.time.return_value = 103
+        state.status()
+        self.assertEqual(juju.status.call_count, 2)
+
+        # status came back the same, so it is now kept for 4 seconds
+        mock_time.time.return_value = 106
+        state.status()
+        self.assertEqual(juju.status.call_count, 2)
+        mock_time.time.return_value = 108
+        state.status()
+        self.assertEqual(juju.status.call_count, 3)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# tests cloudinstall/statuscache.py
+#
+# Copyright 2015 Canonical, Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudinstall.statuscache import (CachedJujuState, CachedMaasState,
+                                      StatusCache)
+
+STATUS = {'Machines': {'1': {'InstanceId': '/MAAS/api/1.0/nodes/n1/',
+                             'AgentState': 'started'}},
+          'Services': {'keystone': {'Units': {
+              'keystone/0': {'AgentState': 'started', 'Machine': '1'}}}}}
+NODES = [{'resource_uri': '/MAAS/api/1.0/nodes/n1/', 'hostname': 'n1',
+          'status': 6, 'memory': 2048}]
+
+
+class StatusCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, 'status-cache.json.gz')
+        self.cache = StatusCache(self.filename)
+
+    def test_round_trip(self):
+        self.cache.save(STATUS, NODES)
+        status, nodes, saved = self.cache.load()
+        self.assertEqual(status, STATUS)
+        self.assertEqual(nodes, NODES)
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+
+    def test_missing(self):
+        self.assertIsNone(self.cache.load())
+
+    def test_other_version_ignored(self):
+        with gzip.open(self.filename, 'wt') as f:
+            json.dump({'version': 0, 'juju': STATUS}, f)
+        self.assertIsNone(self.cache.load())
+
+    def test_corrupt_ignored(self):
+        with open(self.filename, 'w') as f:
+            f.write("not gzip")
+        self.assertIsNone(self.cache.load())
+
+    def test_cached_states(self):
+        juju_state = CachedJujuState(STATUS, 1000)
+        self.assertEqual(juju_state.stale_since, 1000)
+        self.assertEqual(juju_state.unit('keystone/0').agent_state,
+                         'started')
+        self.assertEqual(juju_state.machine('1').agent_state, 'started')
+        self.assertEqual(len(juju_state.publish_changes()), 3)
+
+        maas_state = CachedMaasState(NODES, 1000)
+        self.assertEqual(maas_state.machine('/MAAS/api/1.0/nodes/n1/')
+                         .hostname, 'n1')